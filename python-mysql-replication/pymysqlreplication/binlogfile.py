@@ -0,0 +1,107 @@
+import os
+import mmap
+import struct
+
+from .binlogstream import BinLogStreamReader
+from .packet import StringPacket
+
+# Every binlog file starts with these 4 bytes, then its first event
+BINLOG_MAGIC = b'\xfebin'
+# Offset of the event size in the 19 byte event header
+EVENT_SIZE_OFFSET = 9
+EVENT_HEADER_SIZE = 19
+
+
+class FilePacket(StringPacket):
+    '''An event read from a binlog file, laid out like the packets of a
+    replication stream: an OK byte followed by the event'''
+
+    def is_ok_packet(self):
+        return True
+
+
+class BinLogFileReader(BinLogStreamReader):
+    '''Read events from binlog files on local disk rather than from a
+    replication stream. The files are memory mapped and read in order,
+    the first one from `log_pos`, the others from their first event.
+
+    Events are the same as those of BinLogStreamReader, and filtered the
+    same way. The control connection is still needed, for the column
+    metadata of the tables (see SchemaCache), but no event goes through
+    the server'''
+
+    def __init__(self, log_files, connection_settings = {}, log_pos = None, **kwargs):
+        '''
+        log_files: Paths of the binlog files to read, in binlog order
+        log_pos: Position in the first file to start at, by default its first event
+        Other arguments are those of BinLogStreamReader, except for the
+        ones about the stream connection (blocking, resume_stream,
+        server_id, heartbeat_period)
+        '''
+        super(BinLogFileReader, self).__init__(connection_settings, **kwargs)
+        self.__log_files = list(log_files)
+        self.__start_log_pos = log_pos
+        self.__file_index = -1
+        self.__map = None
+        self.__offset = None
+
+    @staticmethod
+    def index_files(index_path):
+        '''Return the paths of the binlog files listed in a binlog index
+        file (mysql-bin.index), relative to the directory of the index'''
+        directory = os.path.dirname(index_path)
+        with open(index_path) as index:
+            return [os.path.join(directory, os.path.basename(line.strip()))
+                    for line in index if line.strip()]
+
+    def connect_to_stream(self, custom_log_pos=None, custom_log_file=None):
+        '''Open the next file, at `custom_log_pos` if given. Return False
+        once every file was read'''
+        self.__close_map()
+        self.__file_index += 1
+        if self.__file_index >= len(self.__log_files):
+            return False
+        path = self.__log_files[self.__file_index]
+        with open(path, 'rb') as log_file:
+            if os.fstat(log_file.fileno()).st_size < len(BINLOG_MAGIC):
+                raise ValueError('%s is not a binlog file' % path)
+            self.__map = mmap.mmap(log_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.__map[:len(BINLOG_MAGIC)] != BINLOG_MAGIC:
+            self.__close_map()
+            raise ValueError('%s is not a binlog file' % path)
+        if custom_log_pos is None:
+            custom_log_pos = len(BINLOG_MAGIC)
+        self.__offset = custom_log_pos
+        # Rotates at the end of a file name the next one, like those of
+        # a stream; this covers files given without one in between
+        self.log_file = os.path.basename(path)
+        self.log_pos = custom_log_pos
+        return True
+
+    def read_packet(self):
+        '''Read the next event off the mapped files. Return None once
+        every file was read. An event cut short at the end of a file
+        (still being written) ends that file'''
+        while True:
+            if self.__map is None:
+                log_pos = self.__start_log_pos if self.__file_index < 0 else None
+                if not self.connect_to_stream(log_pos):
+                    return None
+            header_end = self.__offset + EVENT_HEADER_SIZE
+            if header_end <= len(self.__map):
+                event_size = struct.unpack_from('<I', self.__map, self.__offset + EVENT_SIZE_OFFSET)[0]
+                event_end = self.__offset + event_size
+                if event_size >= EVENT_HEADER_SIZE and event_end <= len(self.__map):
+                    data = b'\x00' + self.__map[self.__offset:event_end]
+                    self.__offset = event_end
+                    return FilePacket(data)
+            self.__close_map()
+
+    def __close_map(self):
+        if self.__map is not None:
+            self.__map.close()
+            self.__map = None
+
+    def close(self):
+        self.__close_map()
+        super(BinLogFileReader, self).close()
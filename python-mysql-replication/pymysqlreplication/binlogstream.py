@@ -5,19 +5,31 @@ import pymysql.cursors
 from pymysql.constants.COMMAND import *
 from pymysql.util import byte2int, int2byte
 from .packet import BinLogPacketWrapper
-from .constants.BINLOG import TABLE_MAP_EVENT
-from row_event import RowsEvent
+from .schema_cache import SchemaCache
+from .constants.BINLOG import TABLE_MAP_EVENT, ROTATE_EVENT, HEARTBEAT_LOG_EVENT
+from row_event import RowsEvent, TableMapEvent
 from event import QueryEvent
 
+# Offsets in a binlog packet, which starts with an OK byte followed by
+# the 19 byte event header
+EVENT_TYPE_OFFSET = 5
+EVENT_SIZE_OFFSET = 10
+POST_HEADER_OFFSET = 20
+
 
 class BinLogStreamReader(object):
     '''Connect to replication stream and read event'''
 
-    def __init__(self, connection_settings = {}, resume_stream = False, blocking = False, only_events = None, server_id = 255):
+    def __init__(self, connection_settings = {}, resume_stream = False, blocking = False, only_events = None, server_id = 255, row_decoder_pool = None, only_schemas = None, schema_state_file = None, heartbeat_period = None, tuple_rows = False):
         '''
         resume_stream: Start for latest event of binlog or from older available event
         blocking: Read on stream is blocking
         only_events: Array of allowed events
+        only_schemas: Schemas whose events are read, by default just the connection database
+        row_decoder_pool: RowDecoderPool decoding the rows of row events in other processes
+        schema_state_file: File the schema cache is saved to on close and loaded from, if still valid, on start
+        heartbeat_period: Seconds of silence after which the master sends a HeartbeatLogEvent
+        tuple_rows: Decode row images as tuples in column order rather than dicts (see RowsEvent)
         '''
         self.__connection_settings = connection_settings
         self.__connection_settings['charset'] = 'utf8'
@@ -29,8 +41,40 @@ class BinLogStreamReader(object):
         self.__resume_stream = resume_stream
         self.__blocking = blocking
         self.__only_events = only_events
+        if only_schemas is None:
+            only_schemas = [connection_settings['db']]
+        self.__only_schemas = frozenset(only_schemas)
+        # The same names encoded like in events, for __skip_packet to
+        # compare the raw bytes with
+        self.__only_schema_names = frozenset(
+            schema.encode('utf-8') if isinstance(schema, type(u'')) else schema
+            for schema in only_schemas)
+        # Column metadata of the tables, fetched for all of only_schemas
+        # at once rather than table by table in the middle of the stream
+        self.schema_cache = SchemaCache(self.__ctl_connection)
+        self.__schema_state_file = schema_state_file
+        self.schema_state_loaded = schema_state_file is not None and \
+            self.schema_cache.load(schema_state_file, self.__only_schemas)
+        if not self.schema_state_loaded:
+            if schema_state_file is not None:
+                # DDL logged from here on may or may not show in what
+                # is fetched
+                self.schema_cache.ddl_log_pos = self.get_master_binlog_pos()
+            self.schema_cache.prefetch(self.__only_schemas)
         self.__server_id = server_id
+        self.__heartbeat_period = heartbeat_period
+        self.row_decoder_pool = row_decoder_pool
+        self.__tuple_rows = tuple_rows
+        # Binlog file and position after the last event returned. Events
+        # carry the file they were read from as log_file
+        self.log_file = None
         self.log_pos = None
+        # File and position after the last packet read, to reconnect from
+        self.__read_log_file = None
+        self.__read_log_pos = None
+        # Position read_packet skips to while the schema cache catches up
+        # with the DDL logged since it was saved
+        self.__ddl_catch_up_pos = None
         self.starting_binlog_pos = 4 # Position in the binlog-file to start the stream with
 
         #Store table meta informations
@@ -40,35 +84,89 @@ class BinLogStreamReader(object):
         if self.__connected:
             self._stream_connection.close()
             self.__connected = False
+        if self.__schema_state_file is not None:
+            # Every DDL up to the last event returned went through the
+            # schema cache
+            if self.log_file is not None:
+                self.schema_cache.ddl_log_pos = (self.log_file, self.log_pos)
+            self.schema_cache.save(self.__schema_state_file, self.__only_schemas)
+            self.__schema_state_file = None
         self.__ctl_connection.close()
+        if self.row_decoder_pool is not None:
+            self.row_decoder_pool.close()
 
     def get_master_binlog_pos(self):
-        cur = pymysql.connect(**self.__connection_settings).cursor()
-        cur.execute("FLUSH TABLES WITH READ LOCK")
+        '''Return the current binlog file and position of the master. No
+        lock is taken, so the master may be past them by the time they
+        are used, which is fine to start streaming from'''
+        cur = self.__ctl_connection.cursor()
         cur.execute("SHOW MASTER STATUS")
-        ret = cur.fetchone()[:2]
-        cur.execute("UNLOCK TABLES")
+        row = cur.fetchone()
+        cur.close()
+        return (row["File"], row["Position"])
+
+    def connect_to_stream(self, custom_log_pos=None, custom_log_file=None):
+        '''Start streaming from `custom_log_file` at `custom_log_pos`, or
+        from where the stream was. The master is only asked for its
+        current file if no file is known yet'''
+        if custom_log_pos is not None:
+            self.log_pos = custom_log_pos
+        if custom_log_file is not None:
+            self.log_file = custom_log_file
+        log_file, log_pos = self.log_file, self.log_pos
+        if log_file is None:
+            (log_file, master_log_pos) = self.get_master_binlog_pos()
+            if log_pos is None:
+                log_pos = master_log_pos if self.__resume_stream else self.starting_binlog_pos
+        elif log_pos is None:
+            log_pos = self.starting_binlog_pos
+        if self.schema_state_loaded and self.__read_log_file is None:
+            (log_file, log_pos) = self.__catch_up_schema_cache(log_file, log_pos)
+        (self.__read_log_file, self.__read_log_pos) = (log_file, log_pos)
+        self.__dump(log_file, log_pos)
+
+    def __catch_up_schema_cache(self, log_file, log_pos):
+        '''Return where to stream from for the schema cache loaded from the
+        state file to see the DDL logged between where it was saved and
+        `log_file` at `log_pos`, which read_packet then skips to. Only the
+        tables named by that DDL are fetched again. If that part of the
+        binlog was purged, the whole cache is'''
+        ddl_log_pos = self.schema_cache.ddl_log_pos
+        if ddl_log_pos >= (log_file, log_pos):
+            return (log_file, log_pos)
+        cur = self.__ctl_connection.cursor()
+        cur.execute("SHOW BINARY LOGS")
+        log_files = [row["Log_name"] for row in cur.fetchall()]
         cur.close()
-        return ret
+        if ddl_log_pos[0] not in log_files:
+            self.schema_cache.tables.clear()
+            self.schema_cache.ddl_log_pos = (log_file, log_pos)
+            self.schema_cache.prefetch(self.__only_schemas)
+            return (log_file, log_pos)
+        # The events skipped don't go through decode_packet, which would
+        # follow their rotates
+        (self.log_file, self.log_pos) = (log_file, log_pos)
+        self.__ddl_catch_up_pos = (log_file, log_pos)
+        return ddl_log_pos
 
-    def connect_to_stream(self, custom_log_pos=None):
+    def __dump(self, log_file, log_pos):
+        '''Open the stream connection and ask for the binlog from
+        `log_file` at `log_pos`. Unlike connect_to_stream, this leaves
+        log_file and log_pos alone, which may lag behind what was read
+        when reading and decoding run in different threads'''
         self._stream_connection = pymysql.connect(**self.__connection_settings)
-        (log_file, log_pos) = self.get_master_binlog_pos()
+        if self.__heartbeat_period:
+            # Read by the master's dump thread, in nanoseconds
+            cur = self._stream_connection.cursor()
+            cur.execute("SET @master_heartbeat_period = %d" % int(self.__heartbeat_period * 1000000000))
+            cur.close()
         # flags (2) BINLOG_DUMP_NON_BLOCK (0 or 1)
         # server_id (4) -- server id of this slave
         # binlog-filename (string.EOF) -- filename of the binlog on the master
-        if custom_log_pos is not None:
-            self.log_pos = custom_log_pos
         command = COM_BINLOG_DUMP
         prelude = struct.pack('<i', len(log_file) + 11) \
                 + int2byte(command)
-        if self.log_pos is None:
-            if self.__resume_stream:
-                prelude += struct.pack('<I', log_pos)
-            else:
-                prelude += struct.pack('<I', self.starting_binlog_pos)
-        else:
-            prelude += struct.pack('<I', self.log_pos)
+        prelude += struct.pack('<I', log_pos)
         if self.__blocking:
             prelude += struct.pack('<h', 0)
         else:
@@ -79,9 +177,25 @@ class BinLogStreamReader(object):
         self.__connected = True
         
     def fetchone(self):
+        while True:
+            pkt = self.read_packet()
+            if pkt is None:
+                return None
+            binlog_event = self.decode_packet(pkt)
+            if binlog_event is not None:
+                return binlog_event
+
+    def read_packet(self):
+        '''Read the next raw packet from the stream, reconnecting if the
+        connection was lost. Return None at the end of the stream. Together
+        with decode_packet, it lets reading and decoding run in different
+        threads'''
         while True:
             if self.__connected == False:
-                self.connect_to_stream()
+                if self.__read_log_file is None:
+                    self.connect_to_stream()
+                else:
+                    self.__dump(self.__read_log_file, self.__read_log_pos)
             pkt = None
             try:
                 pkt = self._stream_connection.read_packet()
@@ -91,30 +205,134 @@ class BinLogStreamReader(object):
                     continue
             if not pkt.is_ok_packet():
                 return None
-            # When reading TableMapEvents from the stream, this line can throw an error
-            # if we are running a query on a modified version of a table. For example, if
-            # we originally had a table with two columns, wrote to it, then modified it to
-            # remove a column, then the TableMapEvent constructor would throw an error because
-            # it uses the current table schema. Thus we continue the loop if we get an error
-            try:
-                binlog_event = BinLogPacketWrapper(pkt, self.table_map, self.__ctl_connection)
-            except:
-                continue
-            if binlog_event.event_type == TABLE_MAP_EVENT:
-                self.table_map[binlog_event.event.table_id] = binlog_event.event
-            if self.__filter_event(binlog_event.event):
-                continue
+            # Position of the next event, from the event header. Fake
+            # events sent on connect carry 0
+            data = pkt.get_all_data()
+            event_type = byte2int(data[EVENT_TYPE_OFFSET])
+            log_pos = struct.unpack_from('<I', data, 14)[0]
+            if log_pos > 0 and event_type != HEARTBEAT_LOG_EVENT:
+                self.__read_log_pos = log_pos
+            if event_type == ROTATE_EVENT:
+                (self.__read_log_file, self.__read_log_pos) = self.__peek_rotate(data)
+            if self.__ddl_catch_up_pos is not None:
+                if (self.__read_log_file, self.__read_log_pos) <= self.__ddl_catch_up_pos:
+                    if BinLogPacketWrapper.event_class(event_type) is QueryEvent:
+                        (schema, query) = self.__peek_query(data)
+                        self.schema_cache.invalidate_query(schema.decode('utf-8', 'replace'),
+                                                           query.decode('utf-8', 'replace'))
+                    continue
+                self.__ddl_catch_up_pos = None
+            return pkt
+
+    def decode_packet(self, pkt):
+        '''Turn a packet from read_packet into an event. Return None if
+        the event is filtered out or can't be decoded'''
+        data = pkt.get_all_data()
+        if byte2int(data[EVENT_TYPE_OFFSET]) == ROTATE_EVENT:
+            # Followed whatever only_events says, for log_file
+            (self.log_file, self.log_pos) = self.__peek_rotate(data)
+        if self.__skip_packet(pkt):
+            return None
+        # When reading TableMapEvents from the stream, this line can throw an error
+        # if we are running a query on a modified version of a table. For example, if
+        # we originally had a table with two columns, wrote to it, then modified it to
+        # remove a column, then the TableMapEvent constructor would throw an error because
+        # it uses the current table schema. Thus we skip the event if we get an error
+        try:
+            binlog_event = BinLogPacketWrapper(pkt, self.table_map, self.__ctl_connection,
+                                               self.schema_cache, self.__tuple_rows)
+        except:
+            return None
+        if binlog_event.event_type == TABLE_MAP_EVENT:
+            self.table_map[binlog_event.event.table_id] = binlog_event.event
+        elif isinstance(binlog_event.event, QueryEvent):
+            self.schema_cache.invalidate_query(binlog_event.event.schema, binlog_event.event.query)
+        if self.__filter_event(binlog_event.event):
+            return None
+        if self.row_decoder_pool is not None and isinstance(binlog_event.event, RowsEvent):
+            self.row_decoder_pool.submit(binlog_event.event)
+        binlog_event.event.log_file = self.log_file
+        # Heartbeats carry the position of the master, not of an event,
+        # and rotates the end of the previous file
+        if binlog_event.log_pos > 0 and \
+                binlog_event.event_type not in (HEARTBEAT_LOG_EVENT, ROTATE_EVENT):
             self.log_pos = binlog_event.log_pos
-            return binlog_event.event
+        return binlog_event.event
+
+    def __skip_packet(self, pkt):
+        '''Tell from the header of the event in `pkt` (and for table maps,
+        row events and queries, the table or schema) whether the event
+        would be filtered out, without decoding it. Unsupported events are
+        skipped too. TableMapEvents and statements are kept for the schemas
+        in only_schemas whatever only_events says, since their row events
+        need the former and the schema cache the latter. Statements run
+        from other schemas are skipped once the schema cache saw them'''
+        data = pkt.get_all_data()
+        event_class = BinLogPacketWrapper.event_class(byte2int(data[EVENT_TYPE_OFFSET]))
+        if event_class is None:
+            return True
+        if event_class is TableMapEvent:
+            table_id = self.__peek_table_id(data)
+            schema_length = byte2int(data[POST_HEADER_OFFSET + 8])
+            schema_offset = POST_HEADER_OFFSET + 9
+            if data[schema_offset:schema_offset + schema_length] not in self.__only_schema_names:
+                # Row events of this table are then skipped as well
+                self.table_map.pop(table_id, None)
+                return True
+            return False
+        wanted = self.__only_events is None or \
+            issubclass(event_class, tuple(self.__only_events))
+        if event_class is QueryEvent:
+            (schema, query) = self.__peek_query(data)
+            if query in (b'BEGIN', b'COMMIT', b'ROLLBACK'):
+                return not wanted
+            if schema in self.__only_schema_names:
+                return False
+            # DDL run from another default database may still name tables
+            # of only_schemas qualified with their schema
+            self.schema_cache.invalidate_query(schema.decode('utf-8', 'replace'),
+                                               query.decode('utf-8', 'replace'))
+            return True
+        if not wanted:
+            return True
+        if issubclass(event_class, RowsEvent):
+            return self.__peek_table_id(data) not in self.table_map
+        return False
+
+    def __peek_rotate(self, data):
+        '''Return the file and position a RotateEvent points to'''
+        position = struct.unpack_from('<Q', data, POST_HEADER_OFFSET)[0]
+        event_end = 1 + struct.unpack_from('<I', data, EVENT_SIZE_OFFSET)[0]
+        return (data[POST_HEADER_OFFSET + 8:event_end].decode(), position)
+
+    def __peek_query(self, data):
+        '''Return the default database and the statement of a QueryEvent,
+        as bytes'''
+        # slave_proxy_id (4), execution_time (4), schema_length (1),
+        # error_code (2), status_vars_length (2), status_vars, schema,
+        # a 0 byte, then the query
+        schema_length = byte2int(data[POST_HEADER_OFFSET + 8])
+        status_vars_length = struct.unpack_from('<H', data, POST_HEADER_OFFSET + 11)[0]
+        schema_offset = POST_HEADER_OFFSET + 13 + status_vars_length
+        query_end = 1 + struct.unpack_from('<I', data, EVENT_SIZE_OFFSET)[0]
+        return (data[schema_offset:schema_offset + schema_length],
+                data[schema_offset + schema_length + 1:query_end])
+
+    def __peek_table_id(self, data):
+        low, high = struct.unpack_from('<IH', data, POST_HEADER_OFFSET)
+        return low + (high << 32)
 
     def __filter_event(self, event):
-        # If it's a RowsEvent or QueryEvent, the event database must match the
-        # connection database
+        # If it's a RowsEvent or QueryEvent, the event database must be one
+        # of only_schemas. BEGIN, COMMIT and ROLLBACK are let through regardless,
+        # since they carry the session's default database rather than the
+        # one being written to, and are needed to find transaction boundaries
         if isinstance(event, RowsEvent) and \
-                self.__connection_settings['db'] != self.table_map[event.table_id].schema:
+                self.table_map[event.table_id].schema not in self.__only_schemas:
                     return True
         elif isinstance(event, QueryEvent) and \
-                self.__connection_settings['db'] != event.schema:
+                event.query not in ('BEGIN', 'COMMIT', 'ROLLBACK') and \
+                event.schema not in self.__only_schemas:
                     return True
         elif self.__only_events is not None:
             for allowed_event in self.__only_events:
@@ -3,8 +3,32 @@ from pymysql.constants import FIELD_TYPE
 from pymysql.util import byte2int, int2byte 
 import csv
 
+# Parses the quoted values of ENUM and SET column types
+csv.register_dialect('column_schema', quotechar="'", doublequote="''")
+
+def parse_column_schema(column_schema):
+    '''Add what Column takes from the COLUMN_TYPE of a row of
+    information_schema.columns to the row, as UNSIGNED and, for ENUM and
+    SET columns, VALUES. Done once per column when the row is fetched,
+    rather than for every Column built from it'''
+    column_type = column_schema["COLUMN_TYPE"]
+    column_schema["UNSIGNED"] = column_type.find("unsigned") != -1
+    if column_type.startswith("enum("):
+        column_schema["VALUES"] = csv.reader([column_type[5:-1]], dialect='column_schema').next()
+    elif column_type.startswith("set("):
+        column_schema["VALUES"] = csv.reader([column_type[4:-1]], dialect='column_schema').next()
+    return column_schema
+
 class Column(object):
-    '''Definition of a column'''
+    '''Definition of a column. Only some of the metadata attributes are
+    set, depending on the type'''
+
+    __slots__ = ('type', 'name', 'collation_name', 'character_set_name', 'comment',
+                 'unsigned', 'max_length', 'length_size', 'precision', 'decimals',
+                 'size', 'bits', 'bytes', 'enum_values', 'set_values')
+    # Slots that aren't read from the binlog metadata of the column
+    __schema_slots = ('type', 'name', 'collation_name', 'character_set_name',
+                      'comment', 'unsigned')
 
     def __init__(self, column_type, column_schema, packet):
         self.type = column_type
@@ -12,14 +36,11 @@ class Column(object):
         self.collation_name = column_schema["COLLATION_NAME"]
         self.character_set_name = column_schema["CHARACTER_SET_NAME"]
         self.comment = column_schema["COLUMN_COMMENT"]
-        self.unsigned = False
-
-        if column_schema["COLUMN_TYPE"].find("unsigned") != -1:
-            self.unsigned = True
+        self.unsigned = column_schema["UNSIGNED"]
         if self.type == FIELD_TYPE.VAR_STRING or self.type == FIELD_TYPE.STRING:
             self.__read_string_metadata(packet, column_schema)
         elif self.type == FIELD_TYPE.VARCHAR:
-            self.max_length = struct.unpack('<H', packet.read(2))[0]
+            self.max_length = packet.read_uint16()
         elif self.type == FIELD_TYPE.BLOB:
             self.length_size = packet.read_uint8()
         elif self.type == FIELD_TYPE.GEOMETRY:
@@ -48,10 +69,20 @@ class Column(object):
             self.max_length = (((metadata >> 4) & 0x300) ^ 0x300) + (metadata & 0x00ff)
 
     def __read_enum_metadata(self, column_schema):
-        # Creates a csv dialect for parsing column schema strings
-        csv.register_dialect('column_schema', quotechar="'", doublequote="''")
-        enums = column_schema["COLUMN_TYPE"]
         if self.type == FIELD_TYPE.ENUM:
-            self.enum_values = csv.reader([enums[5:-1]], dialect='column_schema').next()
+            self.enum_values = column_schema["VALUES"]
         else:
-            self.set_values = csv.reader([enums[4:-1]], dialect='column_schema').next()
+            self.set_values = column_schema["VALUES"]
+
+    def metadata(self):
+        '''Return the (name, value) pairs of the metadata attributes that
+        are set'''
+        return [(key, getattr(self, key)) for key in self.__slots__
+                if key not in self.__schema_slots and hasattr(self, key)]
+
+    def __getstate__(self):
+        return dict((key, getattr(self, key)) for key in self.__slots__ if hasattr(self, key))
+
+    def __setstate__(self, state):
+        for key, value in state.items():
+            setattr(self, key, value)
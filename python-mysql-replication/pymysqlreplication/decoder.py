@@ -0,0 +1,43 @@
+import multiprocessing
+import signal
+
+from .packet import BinLogPacketReader, StringPacket
+from .row_event import RowDecoder
+
+# RowDecoders built in this process, by column layout
+_row_decoders = {}
+
+
+def decode_rows(job):
+    '''Decode the rows of a row event from a RowsEvent.rows_job() tuple'''
+    event_class, state, body = job
+    event = event_class.__new__(event_class)
+    event.__dict__.update(state)
+    layout = (RowDecoder.layout(event.columns), event.column_index is not None)
+    if layout not in _row_decoders:
+        _row_decoders[layout] = RowDecoder(event.columns, event.column_index is not None)
+    event.row_decoder = _row_decoders[layout]
+    event.packet = BinLogPacketReader(StringPacket(body))
+    event.event_size = len(body)
+    return event.rows
+
+
+def _ignore_sigint():
+    # The parent process decides what to do on SIGINT
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+class RowDecoderPool(object):
+    '''Decode the rows of row events in a pool of worker processes, so
+    that decoding isn't bound to one core. Events keep their order: each
+    one waits for its own rows when they are first accessed'''
+
+    def __init__(self, processes=None):
+        self.__pool = multiprocessing.Pool(processes, _ignore_sigint)
+
+    def submit(self, event):
+        '''Send the rows of a RowsEvent to be decoded'''
+        event.set_rows_future(self.__pool.apply_async(decode_rows, (event.rows_job(),)))
+
+    def close(self):
+        self.__pool.terminate()
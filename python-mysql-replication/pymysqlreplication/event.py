@@ -11,13 +11,13 @@ class BinLogEvent(object):
         self.table_map = table_map
         self.event_type = self.packet.event_type
         self.timestamp = self.packet.timestamp
+        self.log_pos = self.packet.log_pos
         self.event_size = event_size
         self._ctl_connection = ctl_connection
 
     def _read_table_id(self):
         # Table ID is 6 byte
-        table_id = self.packet.read(6) + int2byte(0) + int2byte(0)   # pad little-endian number
-        return struct.unpack('<Q', table_id)[0]
+        return self.packet.read_uint48()
 
     def dump(self):
         print("=== %s ===" % (self.__class__.__name__))
@@ -33,13 +33,50 @@ class BinLogEvent(object):
 
 
 class RotateEvent(BinLogEvent):
-    pass
+    """
+        Sent when the master moves on to another binlog file, and on
+        connect with the file the stream starts in
+
+        Attributes:
+            position: Position of the first event in the next file
+            next_binlog: Name of the next file
+    """
+
+    def __init__(self, from_packet, event_size, table_map, ctl_connection):
+        super(RotateEvent, self).__init__(from_packet, event_size, table_map, ctl_connection)
+        self.position = self.packet.read_uint64()
+        self.next_binlog = self.packet.read(event_size - 8).decode()
+
+    def _dump(self):
+        super(RotateEvent, self)._dump()
+        print("Position: %d" % (self.position))
+        print("Next binlog file: %s" % (self.next_binlog))
 
 
 class FormatDescriptionEvent(BinLogEvent):
     pass
 
 
+class HeartbeatLogEvent(BinLogEvent):
+    """
+        Sent by the master instead of events when it had nothing to send
+        for the heartbeat period. Its timestamp is 0 and its log_pos is
+        the position the master is at, so it tells that the stream caught
+        up rather than stalled
+
+        Attributes:
+            ident: Name of the binlog file the master is at
+    """
+
+    def __init__(self, from_packet, event_size, table_map, ctl_connection):
+        super(HeartbeatLogEvent, self).__init__(from_packet, event_size, table_map, ctl_connection)
+        self.ident = self.packet.read(event_size).decode()
+
+    def _dump(self):
+        super(HeartbeatLogEvent, self)._dump()
+        print("Current binlog file: %s" % (self.ident))
+
+
 class XidEvent(BinLogEvent):
     """
         A COMMIT event
@@ -50,7 +87,7 @@ class XidEvent(BinLogEvent):
 
     def __init__(self, from_packet, event_size, table_map, ctl_connection):
         super(XidEvent, self).__init__(from_packet, event_size, table_map, ctl_connection)
-        self.xid = struct.unpack('<Q', self.packet.read(8))[0]
+        self.xid = self.packet.read_uint64()
 
     def _dump(self):
         super(XidEvent, self)._dump()
@@ -16,83 +16,76 @@ UNSIGNED_SHORT_LENGTH = 2
 UNSIGNED_INT24_LENGTH = 3
 UNSIGNED_INT64_LENGTH = 8
 
-class BinLogPacketWrapper(object):
+# Precompiled structs for the fixed size values read off packets
+EVENT_HEADER = struct.Struct('<IBIIIH')
+UINT8 = struct.Struct('<B')
+UINT16 = struct.Struct('<H')
+UINT32 = struct.Struct('<I')
+INT64 = struct.Struct('<q')
+UINT64 = struct.Struct('<Q')
+UINT8_UINT16 = struct.Struct('<BH')
+UINT8_UINT32 = struct.Struct('<BI')
+UINT16_UINT16_UINT16 = struct.Struct('<HHH')
+UINT8_UINT16_UINT32 = struct.Struct('<BHI')
+BE_INT8 = struct.Struct('>b')
+BE_INT16 = struct.Struct('>h')
+BE_INT8_UINT16 = struct.Struct('>bH')
+BE_INT32 = struct.Struct('>i')
+BE_INT64 = struct.Struct('>q')
+
+class StringPacket(object):
     """
-    Bin Log Packet Wrapper. It uses an existing packet object, and wraps
-    around it, exposing useful variables while still providing access
-    to the original packet objects variables and methods.
+    A packet over a plain string, for decoding data that was already
+    read off the stream (for example in another process). Only provides
+    what BinLogPacketReader uses.
     """
 
-    __event_map = {
-        QUERY_EVENT: QueryEvent,
-        UPDATE_ROWS_EVENT: UpdateRowsEvent,
-        WRITE_ROWS_EVENT: WriteRowsEvent,
-        DELETE_ROWS_EVENT: DeleteRowsEvent,
-        TABLE_MAP_EVENT: TableMapEvent,
-        ROTATE_EVENT: RotateEvent,
-        FORMAT_DESCRIPTION_EVENT: FormatDescriptionEvent,
-        XID_EVENT: XidEvent
-    }
+    def __init__(self, data):
+        self.__data = data
 
-    def __init__(self, from_packet, table_map, ctl_connection):
-        if not from_packet.is_ok_packet():
-            raise ValueError('Cannot create ' + str(self.__class__.__name__)
-                + ' object from invalid packet type')
-       
-        self.read_bytes = 0 #-1 because we ignore the ok byte
-        self.__data_buffer = b'' #Used when we want to override a value in the data buffer 
+    def get_all_data(self):
+        return self.__data
 
-        # Ok Value
+
+class BinLogPacketReader(object):
+    """
+    Reads binlog data types off a packet object, keeping count of the
+    bytes read, while still providing access to the original packet
+    objects variables and methods.
+
+    The whole payload of the packet is kept as one string and read with
+    a moving offset: fixed size values are unpacked in place, and only
+    the values themselves get copied out.
+    """
+
+    def __init__(self, from_packet, offset=0):
         self.packet = from_packet
-        self.packet.advance(1)
-        self.charset = ctl_connection.charset
-  
-        # Header
-        self.timestamp = struct.unpack('<I', self.packet.read(4))[0]
-        self.event_type = byte2int(self.packet.read(1))
-        self.server_id = struct.unpack('<I', self.packet.read(4))[0]
-        self.event_size = struct.unpack('<I', self.packet.read(4))[0]
-        # position of the next event
-        self.log_pos = struct.unpack('<I', self.packet.read(4))[0]
-        self.flags = self.flags = struct.unpack('<H', self.packet.read(2))[0]
-        
+        self.__data = from_packet.get_all_data()
+        self.__start = offset
+        self.__offset = offset
 
-        event_size_without_header = self.event_size - 19
-        try:
-            event_class = self.__event_map[self.event_type]
-        except KeyError:
-            raise NotImplementedError("Unknown MySQL bin log event type: " + hex(self.event_type))
-        self.event = event_class(self, event_size_without_header, table_map, ctl_connection)
+    @property
+    def read_bytes(self):
+        return self.__offset - self.__start
 
     def read(self, size):
         size = int(size)
-        self.read_bytes += size
-        if len(self.__data_buffer) > 0:
-            data = self.__data_buffer[:size]
-            self.__data_buffer = self.__data_buffer[size:]
-            if len(data) == size:
-                return data
-            else:
-                return data + self.packet.read(size - len(data))
-        return self.packet.read(size)
-
-    def unread(self, data):
-        '''Push again data in data buffer. It's use when you want
-        to extract a bit from a value a let the rest of the code normally
-        read the datas'''
-        self.read_bytes -= len(data)
-        self.__data_buffer += data
+        offset = self.__offset
+        self.__offset += size
+        return self.__data[offset:self.__offset]
+
+    def unpack(self, fmt):
+        '''Read the values of a struct.Struct, without copying the data'''
+        values = fmt.unpack_from(self.__data, self.__offset)
+        self.__offset += fmt.size
+        return values
 
     def advance(self, size):
-        size = int(size)
-        self.read_bytes += size
-        buffer_len = len(self.__data_buffer)
-        if buffer_len > 0:
-            self.__data_buffer = self.__data_buffer[size:]
-            if size > buffer_len:
-                self.packet.advance(size - buffer_len)
-        else:
-            self.packet.advance(size)
+        self.__offset += int(size)
+
+    def rewind(self, read_bytes):
+        '''Go back to where `read_bytes` bytes had been read'''
+        self.__offset = self.__start + read_bytes
 
     def read_length_coded_binary(self):
         """Read a 'Length Coded Binary' number from the data buffer.
@@ -102,17 +95,17 @@ class BinLogPacketWrapper(object):
 
         From PyMYSQL source code
         """
-        c = byte2int(self.read(1))
+        c = self.read_uint8()
         if c == NULL_COLUMN:
           return None
         if c < UNSIGNED_CHAR_COLUMN:
           return c
         elif c == UNSIGNED_SHORT_COLUMN:
-            return unpack_int16(self.read(UNSIGNED_INT16_LENGTH))
+            return self.read_uint16()
         elif c == UNSIGNED_INT24_COLUMN:
-          return unpack_int24(self.read(UNSIGNED_INT24_LENGTH))
+          return self.read_uint24()
         elif c == UNSIGNED_INT64_COLUMN:
-          return unpack_int64(self.read(UNSIGNED_INT64_LENGTH))
+          return self.read_uint64()
 
     def read_length_coded_string(self):
         """Read a 'Length Coded String' from the data buffer.
@@ -138,17 +131,16 @@ class BinLogPacketWrapper(object):
     def read_int_be_by_size(self, size):
         '''Read a big endian integer values based on byte number'''
         if size == 1:
-            return struct.unpack('>b', self.read(size))[0]
+            return self.unpack(BE_INT8)[0]
         elif size == 2:
-            return struct.unpack('>h', self.read(size))[0]
-        # Taken from http://stackoverflow.com/questions/3783677/how-to-read-integers-from-a-file-that-are-24bit-and-little-endian-using-python, modified for big-endian integers
+            return self.unpack(BE_INT16)[0]
         elif size == 3:
-            bytes = self.read(size)
-            return struct.unpack('>i', ('\0' if bytes[2] < '\x80' else '\xff') + bytes)[0]
+            a, b = self.unpack(BE_INT8_UINT16)
+            return (a << 16) + b
         elif size == 4:
-            return struct.unpack('>i', self.read(size))[0]
+            return self.unpack(BE_INT32)[0]
         elif size == 8:
-            return struct.unpack('>l', self.read(size))[0]
+            return self.unpack(BE_INT64)[0]
 
     def read_uint_by_size(self, size):
         '''Read a little endian integer values based on byte number'''
@@ -174,37 +166,87 @@ class BinLogPacketWrapper(object):
         length = self.read_uint_by_size(size)
         return self.read(length)
 
-    # Taken from http://stackoverflow.com/questions/3783677/how-to-read-integers-from-a-file-that-are-24bit-and-little-endian-using-python
     def read_int24(self):
-        bytes = self.read(3)
-        return struct.unpack('<i', bytes + ('\0' if bytes[2] < '\x80' else '\xff'))[0]
+        value = self.read_uint24()
+        if value & 0x800000:
+            value -= 1 << 24
+        return value
 
     def read_uint8(self):
-        return struct.unpack('<B', self.read(1))[0]
+        return self.unpack(UINT8)[0]
 
     def read_uint16(self):
-        return struct.unpack('<H', self.read(2))[0]
+        return self.unpack(UINT16)[0]
 
     def read_uint24(self, unsigned = False):
-        return struct.unpack('<I', self.read(3) + '\0')[0]
+        a, b = self.unpack(UINT8_UINT16)
+        return a + (b << 8)
 
     def read_uint32(self):
-        return struct.unpack('<I', self.read(4))[0]
+        return self.unpack(UINT32)[0]
 
     def read_uint40(self):
-      a, b = struct.unpack("<BI", self.read(5))
+      a, b = self.unpack(UINT8_UINT32)
       return a + (b << 8)
 
     def read_uint48(self):
-      a, b, c = struct.unpack("<HHH", self.read(6))
+      a, b, c = self.unpack(UINT16_UINT16_UINT16)
       return a + (b << 16) + (c << 32)
 
     def read_uint56(self):
-      a, b, c = struct.unpack("<BHI", self.read(7))
+      a, b, c = self.unpack(UINT8_UINT16_UINT32)
       return a + (b << 8) + (c << 24)
 
     def read_uint64(self):
-        return struct.unpack('<Q', self.read(8))[0]
+        return self.unpack(UINT64)[0]
 
     def read_int64(self):
-        return struct.unpack('<q', self.read(8))[0]
+        return self.unpack(INT64)[0]
+
+
+class BinLogPacketWrapper(BinLogPacketReader):
+    """
+    Bin Log Packet Wrapper. It uses an existing packet object, and wraps
+    around it, exposing useful variables while still providing access
+    to the original packet objects variables and methods.
+    """
+
+    __event_map = {
+        QUERY_EVENT: QueryEvent,
+        UPDATE_ROWS_EVENT: UpdateRowsEvent,
+        WRITE_ROWS_EVENT: WriteRowsEvent,
+        DELETE_ROWS_EVENT: DeleteRowsEvent,
+        TABLE_MAP_EVENT: TableMapEvent,
+        ROTATE_EVENT: RotateEvent,
+        FORMAT_DESCRIPTION_EVENT: FormatDescriptionEvent,
+        XID_EVENT: XidEvent,
+        HEARTBEAT_LOG_EVENT: HeartbeatLogEvent
+    }
+
+    def __init__(self, from_packet, table_map, ctl_connection, schema_cache, tuple_rows=False):
+        if not from_packet.is_ok_packet():
+            raise ValueError('Cannot create ' + str(self.__class__.__name__)
+                + ' object from invalid packet type')
+
+        # The Ok Value and the header aren't counted in read_bytes
+        super(BinLogPacketWrapper, self).__init__(from_packet, 1 + EVENT_HEADER.size)
+        self.charset = ctl_connection.charset
+        self.schema_cache = schema_cache
+        self.tuple_rows = tuple_rows
+
+        # Header. log_pos is the position of the next event
+        (self.timestamp, self.event_type, self.server_id, self.event_size,
+         self.log_pos, self.flags) = EVENT_HEADER.unpack_from(from_packet.get_all_data(), 1)
+
+
+        event_size_without_header = self.event_size - 19
+        event_class = self.event_class(self.event_type)
+        if event_class is None:
+            raise NotImplementedError("Unknown MySQL bin log event type: " + hex(self.event_type))
+        self.event = event_class(self, event_size_without_header, table_map, ctl_connection)
+
+    @classmethod
+    def event_class(cls, event_type):
+        '''Return the class of the events of type `event_type`, or None if
+        that type isn't supported'''
+        return cls.__event_map.get(event_type)
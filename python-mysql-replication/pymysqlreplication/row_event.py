@@ -2,6 +2,7 @@ import struct
 import decimal
 import datetime
 import csv
+import copy
 
 from .event import BinLogEvent
 from pymysql.util import byte2int, int2byte
@@ -9,13 +10,24 @@ from pymysql.constants import FIELD_TYPE
 from .column import Column
 
 class RowsEvent(BinLogEvent):
+    '''Rows changed by a statement on one table. Each row is a dict with
+    the row image under "values" (or "before_values" and "after_values"
+    for updates), the image being a dict by column name. When the stream
+    decodes tuple rows, images are instead tuples in column order, whose
+    positions are given by column_index (shared by the events of the
+    table), and each row is the image itself, or a (before, after) pair
+    for updates'''
+
     def __init__(self, from_packet, event_size, table_map, ctl_connection):
         super(RowsEvent, self).__init__(from_packet, event_size, table_map, ctl_connection)
         self.__rows = None
+        self.__rows_future = None
+        # Bytes read before the first row, to decode the rows again from
+        self.__rows_start = None
 
         #Header
         self.table_id = self._read_table_id()
-        self.flags = struct.unpack('<H', self.packet.read(2))[0]
+        self.flags = self.packet.read_uint16()
 
         #Body
         self.number_of_columns = self.packet.read_length_coded_binary()
@@ -24,88 +36,40 @@ class RowsEvent(BinLogEvent):
         #Aditionnal informations
         self.schema = self.table_map[self.table_id].schema
         self.table = self.table_map[self.table_id].table
-
-    def __is_null(self, null_bitmap, position):
-        bit = null_bitmap[int(position / 8)]
-        if type(bit) is str:
-            bit = ord(bit)
-        return bit & (1 << (position % 8))
+        self.primary_key = self.table_map[self.table_id].primary_key
+        self.row_decoder = self.table_map[self.table_id].row_decoder
+        self.column_index = self.table_map[self.table_id].column_index
 
     def _read_column_data(self, null_bitmap):
         '''Use for WRITE, UPDATE and DELETE events. Return an array of column data'''
-        values = {}
-
-        nb_columns = len(self.columns)
-        for i in range(0, nb_columns):
-            column = self.columns[i]
-            name = self.table_map[self.table_id].columns[i].name
-            unsigned = self.table_map[self.table_id].columns[i].unsigned
-            if self.__is_null(null_bitmap, i):
-                values[name] = None
-            elif column.type == FIELD_TYPE.TINY:
-                if unsigned:
-                    values[name] = struct.unpack("<B", self.packet.read(1))[0]
-                else:
-                    values[name] = struct.unpack("<b", self.packet.read(1))[0]
-            elif column.type == FIELD_TYPE.SHORT:
-                if unsigned:
-                    values[name] = struct.unpack("<H", self.packet.read(2))[0]
-                else:
-                    values[name] = struct.unpack("<h", self.packet.read(2))[0]
-            elif column.type == FIELD_TYPE.LONG:
-                if unsigned:
-                    values[name] = struct.unpack("<I", self.packet.read(4))[0]
-                else:
-                    values[name] = struct.unpack("<i", self.packet.read(4))[0]
-            elif column.type == FIELD_TYPE.INT24:
-                if unsigned:
-                    values[name] = self.packet.read_uint24()
-                else:
-                    values[name] = self.packet.read_int24()
-            elif column.type == FIELD_TYPE.FLOAT:
-                values[name] = struct.unpack("<f", self.packet.read(4))[0]
-            elif column.type == FIELD_TYPE.DOUBLE:
-                values[name] = struct.unpack("<d", self.packet.read(8))[0]
-            elif column.type == FIELD_TYPE.VARCHAR or column.type == FIELD_TYPE.STRING:
-                if column.max_length > 255:
-                    values[name] = self.__read_string(2, column)
-                else:
-                    values[name] = self.__read_string(1, column)
-            elif column.type == FIELD_TYPE.NEWDECIMAL:
-                values[name] = self.__read_new_decimal(column)
-            elif column.type == FIELD_TYPE.BLOB:
-                values[name] = self.__read_string(column.length_size, column)
-            elif column.type == FIELD_TYPE.DATETIME:
-                values[name] = self.__read_datetime()
-            elif column.type == FIELD_TYPE.TIME:
-                values[name] = self.__read_time()
-            elif column.type == FIELD_TYPE.DATE:
-                values[name] = self.__read_date()
-            elif column.type == FIELD_TYPE.TIMESTAMP:
-                values[name] = datetime.datetime.fromtimestamp(self.packet.read_uint32())
-            elif column.type == FIELD_TYPE.LONGLONG:
-                if unsigned:
-                    values[name] = self.packet.read_uint64()
-                else:
-                    values[name] = self.packet.read_int64()
-            elif column.type == FIELD_TYPE.YEAR:
-                values[name] = self.packet.read_uint8() + 1900
-            elif column.type == FIELD_TYPE.ENUM:
-                values[name] = column.enum_values[self.packet.read_uint_by_size(column.size) - 1]
-            elif column.type == FIELD_TYPE.SET:
-                # reads a bitmask of the set items to include (ex. 1101 would
-                # mean the first, third, and fourth items)
-                bytes = self.packet.read_uint_by_size(column.size)
-                bits = [1 if digit=='1' else 0 for digit in bin(bytes)[2:]]
-                bits.reverse()
-                values[name] = ','.join([column.set_values[i] for i,b in enumerate(bits) if b==1])
-            elif column.type == FIELD_TYPE.BIT:
-                values[name] = self.__read_bit(column)
-            elif column.type == FIELD_TYPE.GEOMETRY:
-                values[name] = self.packet.read_length_coded_pascal_string(column.length_size)
-            else:
-                raise NotImplementedError("Unknown MySQL column type: %d" % (column.type))
-        return values
+        return self.row_decoder.decode(self, null_bitmap)
+
+    def __read_int24(self, column):
+        if column.unsigned:
+            return self.packet.read_uint24()
+        return self.packet.read_int24()
+
+    def __read_varchar(self, column):
+        if column.max_length > 255:
+            return self.__read_string(2, column)
+        return self.__read_string(1, column)
+
+    def __read_blob(self, column):
+        return self.__read_string(column.length_size, column)
+
+    def __read_enum(self, column):
+        return column.enum_values[self.packet.read_uint_by_size(column.size) - 1]
+
+    def __read_set(self, column):
+        # reads a bitmask of the set items to include (ex. 1101 would
+        # mean the first, third, and fourth items)
+        bytes = self.packet.read_uint_by_size(column.size)
+        bits = [1 if digit=='1' else 0 for digit in bin(bytes)[2:]]
+        bits.reverse()
+        return ','.join([column.set_values[i] for i,b in enumerate(bits) if b==1])
+
+    def __read_geometry(self, column):
+        return self.packet.read_length_coded_pascal_string(column.length_size)
 
     def __read_string(self, size, column):
         str = self.packet.read_length_coded_pascal_string(size)
@@ -136,7 +100,7 @@ class RowsEvent(BinLogEvent):
             resp += current_byte[::-1]
         return resp
 
-    def __read_time(self):
+    def __read_time(self, column):
         time = self.packet.read_uint24()
         date = datetime.time(
             hour = int(time / 10000),
@@ -144,7 +108,7 @@ class RowsEvent(BinLogEvent):
             second = int(time % 100))
         return date
 
-    def __read_date(self):
+    def __read_date(self, column):
         time = self.packet.read_uint24()
 
         year = (time & ((1 << 15) - 1) << 9) >> 9
@@ -163,33 +127,6 @@ class RowsEvent(BinLogEvent):
             )
             return date
 
-    def __read_datetime(self):
-        value = self.packet.read_uint64()
-        date = value / 1000000
-        time = value % 1000000
-
-        year = int(date / 10000)
-        month = int((date % 10000) / 100)
-        day = int(date % 100)
-        hour = int(time / 10000)
-        minute = int((time % 10000) / 100)
-        second = int(time % 100)
-
-        # Same problem as with date
-        if year == 0:
-            return '{0}-{1}-{2} {3}:{4}:{5}'.format(year, month, day,
-                    hour, minute, second)
-        else:
-            date = datetime.datetime(
-                    year=year,
-                    month=month,
-                    day=day,
-                    hour=hour,
-                    minute=minute,
-                    second=second
-                    )
-            return date
-    
     def __read_new_decimal(self, column):
         '''Read MySQL's new decimal format introduced in MySQL 5'''
         
@@ -207,36 +144,40 @@ class RowsEvent(BinLogEvent):
 
         # Support negative
         # The sign is encoded in the high bit of the the byte
-        # But this bit can also be used in the value
-        value = self.packet.read_uint8()
-        if value & 0x80 != 0:
+        # But this bit can also be used in the value, so it is flipped
+        # on a copy of the bytes of the value
+        comp_integral_size = compressed_bytes[comp_integral]
+        comp_fractional_size = compressed_bytes[comp_fractional]
+        data = bytearray(self.packet.read(comp_integral_size + 4 * uncomp_integral
+                                          + 4 * uncomp_fractional + comp_fractional_size))
+        if data[0] & 0x80 != 0:
             res = ""
             mask = 0
         else:
             mask = -1
             res = "-"
-        self.packet.unread(struct.pack('<B', value ^ 0x80))
+        data[0] ^= 0x80
+        offset = 0
 
-
-        size = compressed_bytes[comp_integral]
-
-        if size > 0:
-            value = self.packet.read_int_be_by_size(size) ^ mask 
+        if comp_integral_size > 0:
+            value = _int_be(data, offset, comp_integral_size) ^ mask
             res += str(value)
+            offset += comp_integral_size
 
         for i in range(0, uncomp_integral):
-            value = struct.unpack('>i', self.packet.read(4))[0] ^ mask
+            value = _int_be(data, offset, 4) ^ mask
             res += str(value)
+            offset += 4
 
         res += "."
 
         for i in range(0, uncomp_fractional):
-            value = struct.unpack('>i', self.packet.read(4))[0] ^ mask
+            value = _int_be(data, offset, 4) ^ mask
             res += str(value)
+            offset += 4
 
-        size = compressed_bytes[comp_fractional]
-        if size > 0:
-            value = self.packet.read_int_be_by_size(size) ^ mask
+        if comp_fractional_size > 0:
+            value = _int_be(data, offset, comp_fractional_size) ^ mask
             res += str(value)
 
         return decimal.Decimal(res)
@@ -247,16 +188,224 @@ class RowsEvent(BinLogEvent):
         print("Affected columns: %d" % (self.number_of_columns))
         print("Changed rows: %d" % (len(self.rows)))
 
+    def _named_values(self, row, image):
+        '''Return an image ("values", "before_values" or "after_values") of
+        a row as a dict by column name, whichever form the rows take'''
+        if self.column_index is None:
+            return row[image]
+        if image != "values":
+            row = row[0 if image == "before_values" else 1]
+        return dict((column.name, row[i]) for i, column in enumerate(self.columns))
+
     def _fetch_rows(self):
-        self.__rows = []
+        self.__rows = list(self.__decode_rows())
+
+    def __decode_rows(self):
+        if self.__rows_start is None:
+            self.__rows_start = self.packet.read_bytes
+        else:
+            self.packet.rewind(self.__rows_start)
         while self.packet.read_bytes < self.event_size:
-            self.__rows.append(self._fetch_one_row())
-    
+            yield self._fetch_one_row()
+
+    def iter_rows(self):
+        '''Iterate over the rows. Unless they were decoded already (through
+        `rows` or a RowDecoderPool), each row is decoded from the packet as
+        it is reached and isn't kept, so that memory doesn't grow with the
+        size of the event. Every call decodes the rows again, and since
+        iterations share the packet, they must not be interleaved'''
+        if self.__rows is None and self.__rows_future is not None:
+            self.__rows = self.__rows_future.get()
+        if self.__rows is not None:
+            return iter(self.__rows)
+        return self.__decode_rows()
+
     def __getattr__(self, name):
         if name == "rows":
-            if self.__rows is None:
+            if self.__rows is None and self.__rows_future is not None:
+                self.__rows = self.__rows_future.get()
+            elif self.__rows is None:
                 self._fetch_rows()
             return self.__rows
+        raise AttributeError(str(self.__class__)
+            + " instance has no attribute '" + name + "'")
+
+    def rows_job(self):
+        '''Read the undecoded rows out of the packet. Return them along with
+        the state of the event needed to decode them, in a form that can be
+        sent to another process (see decoder.decode_rows)'''
+        state = dict((key, value) for key, value in self.__dict__.items()
+                     if key not in ('packet', 'table_map', '_ctl_connection', 'row_decoder'))
+        body = self.packet.read(self.event_size - self.packet.read_bytes)
+        return (self.__class__, state, body)
+
+    def set_rows_future(self, future):
+        '''Have the rows come from `future` (anything with a get() method
+        returning them) instead of being decoded from the packet'''
+        self.__rows_future = future
+
+    def copy_with_rows(self, rows):
+        '''Return a copy of the event that only carries the given rows.
+        Used to split the rows of an event between several consumers'''
+        event = copy.copy(self)
+        event.__rows = rows
+        return event
+
+    # Readers of the columns that aren't fixed width, by column type (see
+    # RowDecoder for the others)
+    column_readers = {
+        FIELD_TYPE.INT24: __read_int24,
+        FIELD_TYPE.VARCHAR: __read_varchar,
+        FIELD_TYPE.STRING: __read_varchar,
+        FIELD_TYPE.NEWDECIMAL: __read_new_decimal,
+        FIELD_TYPE.BLOB: __read_blob,
+        FIELD_TYPE.TIME: __read_time,
+        FIELD_TYPE.DATE: __read_date,
+        FIELD_TYPE.ENUM: __read_enum,
+        FIELD_TYPE.SET: __read_set,
+        FIELD_TYPE.BIT: __read_bit,
+        FIELD_TYPE.GEOMETRY: __read_geometry,
+    }
+
+
+def _int_be(data, offset, size):
+    '''Read a signed big endian integer of `size` bytes from a bytearray'''
+    value = 0
+    for byte in data[offset:offset + size]:
+        value = (value << 8) | byte
+    if data[offset] & 0x80:
+        value -= 1 << (8 * size)
+    return value
+
+
+def _read_unknown_column(event, column):
+    raise NotImplementedError("Unknown MySQL column type: %d" % (column.type))
+
+
+def _datetime(value):
+    '''Convert MySQL's packed DATETIME integer'''
+    date = value / 1000000
+    time = value % 1000000
+
+    year = int(date / 10000)
+    month = int((date % 10000) / 100)
+    day = int(date % 100)
+    hour = int(time / 10000)
+    minute = int((time % 10000) / 100)
+    second = int(time % 100)
+
+    # In python, the year can't be zero, so if it is, then we'll just
+    # create a MySQL string ourselves
+    if year == 0:
+        return '{0}-{1}-{2} {3}:{4}:{5}'.format(year, month, day,
+                hour, minute, second)
+    else:
+        return datetime.datetime(
+                year=year,
+                month=month,
+                day=day,
+                hour=hour,
+                minute=minute,
+                second=second
+                )
+
+
+def _year(value):
+    return value + 1900
+
+
+# Struct format and conversion of the fixed width columns, by column type
+# and signedness
+FIXED_WIDTH_COLUMNS = {}
+for _unsigned in (False, True):
+    FIXED_WIDTH_COLUMNS.update({
+        (FIELD_TYPE.TINY, _unsigned): ('B' if _unsigned else 'b', None),
+        (FIELD_TYPE.SHORT, _unsigned): ('H' if _unsigned else 'h', None),
+        (FIELD_TYPE.LONG, _unsigned): ('I' if _unsigned else 'i', None),
+        (FIELD_TYPE.LONGLONG, _unsigned): ('Q' if _unsigned else 'q', None),
+        (FIELD_TYPE.FLOAT, _unsigned): ('f', None),
+        (FIELD_TYPE.DOUBLE, _unsigned): ('d', None),
+        (FIELD_TYPE.TIMESTAMP, _unsigned): ('I', datetime.datetime.fromtimestamp),
+        (FIELD_TYPE.DATETIME, _unsigned): ('Q', _datetime),
+        (FIELD_TYPE.YEAR, _unsigned): ('B', _year),
+    })
+
+
+class RowDecoder(object):
+    '''Decode the column data of the rows of one table layout. It is built
+    once per layout (see TableMapEvent) rather than working out how to
+    read each column for every row: runs of adjacent fixed width columns
+    are read with a single precompiled struct when none of them is NULL,
+    and the other columns go through a prebuilt list of readers'''
+
+    def __init__(self, columns, tuple_rows=False):
+        # Each step is a run of fixed width columns, as (struct, [(index,
+        # key, struct, conversion)]), or another column, as (None,
+        # (index, key, column, reader)). Values are stored under their key
+        # in the image: the column name, or with tuple_rows, the index
+        self.tuple_rows = tuple_rows
+        self.size = len(columns)
+        self.steps = []
+        run = []
+        for i, column in enumerate(columns):
+            key = i if tuple_rows else column.name
+            fixed = FIXED_WIDTH_COLUMNS.get((column.type, column.unsigned))
+            if fixed is not None:
+                fmt, convert = fixed
+                run.append((i, key, struct.Struct('<' + fmt), convert))
+                continue
+            self.__add_run(run)
+            run = []
+            reader = RowsEvent.column_readers.get(column.type, _read_unknown_column)
+            self.steps.append((None, (i, key, column, reader)))
+        self.__add_run(run)
+
+    def __add_run(self, run):
+        if run:
+            fmt = '<' + ''.join(s.format[1:] for i, name, s, convert in run)
+            self.steps.append((struct.Struct(fmt), run))
+
+    @staticmethod
+    def layout(columns):
+        '''Return what the decoder of `columns` depends on, to tell
+        whether a decoder can be reused for another TableMapEvent'''
+        return tuple((c.name, c.type, c.unsigned, c.character_set_name) +
+                     tuple((key, tuple(value) if isinstance(value, list) else value)
+                           for key, value in c.metadata())
+                     for c in columns)
+
+    def decode(self, event, null_bitmap):
+        if self.tuple_rows:
+            values = [None] * self.size
+        else:
+            values = {}
+        packet = event.packet
+        null_bitmap = bytearray(null_bitmap)
+        for run_struct, run in self.steps:
+            if run_struct is None:
+                i, key, column, reader = run
+                if null_bitmap[i >> 3] & (1 << (i & 7)):
+                    values[key] = None
+                else:
+                    values[key] = reader(event, column)
+                continue
+            for i, key, column_struct, convert in run:
+                if null_bitmap[i >> 3] & (1 << (i & 7)):
+                    break
+            else:
+                data = packet.unpack(run_struct)
+                for (i, key, column_struct, convert), value in zip(run, data):
+                    values[key] = value if convert is None else convert(value)
+                continue
+            for i, key, column_struct, convert in run:
+                if null_bitmap[i >> 3] & (1 << (i & 7)):
+                    values[key] = None
+                    continue
+                value = packet.unpack(column_struct)[0]
+                values[key] = value if convert is None else convert(value)
+        if self.tuple_rows:
+            return tuple(values)
+        return values
 
 
 class DeleteRowsEvent(RowsEvent):
@@ -265,9 +414,10 @@ class DeleteRowsEvent(RowsEvent):
         self.columns_present_bitmap = self.packet.read((self.number_of_columns + 7) / 8)
 
     def _fetch_one_row(self):
-        row = {}
-
         null_bitmap = self.packet.read((self.number_of_columns + 7) / 8)
+        if self.column_index is not None:
+            return self._read_column_data(null_bitmap)
+        row = {}
         row["values"] = self._read_column_data(null_bitmap)
         return row
 
@@ -276,8 +426,9 @@ class DeleteRowsEvent(RowsEvent):
         print("Values:")
         for row in self.rows:
             print("--")
-            for key in row["values"]:
-                print("*", key, ":", row["values"][key])
+            values = self._named_values(row, "values")
+            for key in values:
+                print("*", key, ":", values[key])
 
 
 class WriteRowsEvent(RowsEvent):
@@ -286,9 +437,10 @@ class WriteRowsEvent(RowsEvent):
         self.columns_present_bitmap = self.packet.read((self.number_of_columns + 7) / 8)
 
     def _fetch_one_row(self):
-        row = {}
-
         null_bitmap = self.packet.read((self.number_of_columns + 7) / 8)
+        if self.column_index is not None:
+            return self._read_column_data(null_bitmap)
+        row = {}
         row["values"] = self._read_column_data(null_bitmap)
         return row
 
@@ -297,8 +449,9 @@ class WriteRowsEvent(RowsEvent):
         print("Values:")
         for row in self.rows:
             print("--")
-            for key in row["values"]:
-                print("*", key, ":", row["values"][key])
+            values = self._named_values(row, "values")
+            for key in values:
+                print("*", key, ":", values[key])
 
 
 class UpdateRowsEvent(RowsEvent):
@@ -309,13 +462,16 @@ class UpdateRowsEvent(RowsEvent):
         self.columns_present_bitmap2 = self.packet.read((self.number_of_columns + 7) / 8)
 
     def _fetch_one_row(self):
-        row = {}
         null_bitmap = self.packet.read((self.number_of_columns + 7) / 8)
-
-        row["before_values"] = self._read_column_data(null_bitmap)
+        before_values = self._read_column_data(null_bitmap)
 
         null_bitmap = self.packet.read((self.number_of_columns + 7) / 8)
-        row["after_values"] = self._read_column_data(null_bitmap)
+        after_values = self._read_column_data(null_bitmap)
+        if self.column_index is not None:
+            return (before_values, after_values)
+        row = {}
+        row["before_values"] = before_values
+        row["after_values"] = after_values
         return row
 
     def _dump(self):
@@ -324,8 +480,10 @@ class UpdateRowsEvent(RowsEvent):
         print("Values:")
         for row in self.rows:
             print("--")
-            for key in row["before_values"]:
-                print("*", key, ":", row["before_values"][key], "=>", row["after_values"][key])
+            before_values = self._named_values(row, "before_values")
+            after_values = self._named_values(row, "after_values")
+            for key in before_values:
+                print("*", key, ":", before_values[key], "=>", after_values[key])
 
 
 class TableMapEvent(BinLogEvent):
@@ -337,7 +495,7 @@ class TableMapEvent(BinLogEvent):
 
         # Post-Header
         self.table_id = self._read_table_id() 
-        self.flags = struct.unpack('<H', self.packet.read(2))[0]
+        self.flags = self.packet.read_uint16()
 
 
         # Payload
@@ -351,10 +509,12 @@ class TableMapEvent(BinLogEvent):
 
         self.columns = []
 
-        if self.table_id in table_map:
-            self.column_schemas = table_map[self.table_id].column_schemas
-        else:
-            self.column_schemas = self.__get_table_informations(self.schema, self.table)
+        self.column_schemas = from_packet.schema_cache.columns(self.schema, self.table)
+        if len(self.column_schemas) != self.column_count:
+            # Changed by DDL the cache didn't see (one run outside
+            # only_schemas, say); look the table up again
+            from_packet.schema_cache.invalidate(self.schema, self.table)
+            self.column_schemas = from_packet.schema_cache.columns(self.schema, self.table)
 
         #Read columns meta data
         column_types = list(self.packet.read(self.column_count))
@@ -365,14 +525,38 @@ class TableMapEvent(BinLogEvent):
             col = Column(byte2int(column_type), column_schema, from_packet)
             self.columns.append(col)
 
+        self.primary_key = self.__get_primary_key(self.column_schemas)
+
+        # The decoder of the previous map of this table is reused, unless
+        # its columns changed
+        self.layout = RowDecoder.layout(self.columns)
+        if self.table_id in table_map and table_map[self.table_id].layout == self.layout:
+            self.row_decoder = table_map[self.table_id].row_decoder
+        else:
+            self.row_decoder = RowDecoder(self.columns, from_packet.tuple_rows)
+        # Positions of the columns in tuple row images, or None if the
+        # images are dicts
+        self.column_index = None
+        if from_packet.tuple_rows:
+            self.column_index = dict((c.name, i) for i, c in enumerate(self.columns))
+
 
         # TODO: get this informations instead of trashing data
         # n              NULL-bitmask, length: (column-length * 8) / 7
 
-    def __get_table_informations(self, schema, table):
-        cur = self._ctl_connection.cursor()
-        cur.execute("""SELECT * FROM columns WHERE table_schema = %s AND table_name = %s""", (schema, table))
-        return cur.fetchall()
+    def __get_primary_key(self, column_schemas):
+        '''Return the names of the columns that identify a row: the primary
+        key, or else the first unique column that can't be NULL. Empty if
+        the table has neither. Unique keys spanning several columns can't
+        be told apart from plain indexes in information_schema.columns, so
+        they are not used'''
+        primary_key = [c["COLUMN_NAME"] for c in column_schemas if c["COLUMN_KEY"] == "PRI"]
+        if primary_key:
+            return tuple(primary_key)
+        for c in column_schemas:
+            if c["COLUMN_KEY"] == "UNI" and c["IS_NULLABLE"] == "NO":
+                return (c["COLUMN_NAME"],)
+        return ()
 
     def _dump(self):
         super(TableMapEvent, self)._dump()
@@ -380,4 +564,5 @@ class TableMapEvent(BinLogEvent):
         print("Schema: %s" % (self.schema))
         print("Table: %s" % (self.table))
         print("Columns: %s" % (self.column_count))
+        print("Primary key: %s" % (", ".join(self.primary_key)))
 
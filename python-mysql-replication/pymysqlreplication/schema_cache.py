@@ -0,0 +1,149 @@
+import re
+import os
+import json
+
+from .column import parse_column_schema
+
+# Statements that may change the columns or keys of the tables they name
+DDL_STATEMENT = re.compile(r'\s*(ALTER|CREATE|DROP|RENAME|TRUNCATE)\b', re.IGNORECASE)
+# Statements dropping or replacing a whole schema, and its name
+SCHEMA_STATEMENT = re.compile(r'\s*(?:CREATE|DROP)\s+(?:DATABASE|SCHEMA)\s+'
+                              r'(?:IF\s+(?:NOT\s+)?EXISTS\s+)?(`[^`]+`|\w+)', re.IGNORECASE)
+# A comment ahead of a statement, which MySQL keeps in the binlog. The
+# opening of a versioned comment (/*!50100 ...) goes too, as its content
+# is run
+LEADING_COMMENT = re.compile(r'\s*(?:/\*(?!!).*?\*/|/\*!\d*|(?:--\s|#)[^\n]*(?:\n|$))', re.DOTALL)
+# A possibly qualified and quoted name following a keyword that
+# introduces a table in DDL. Anything else caught by this (column names
+# after a comma, index names) costs at most a needless invalidation
+TABLE_NAME = re.compile(r'(?:\bTABLES?|\bEXISTS|\bON|\bTO|,)\s+'
+                        r'(`[^`]+`|\w+)(?:\s*\.\s*(`[^`]+`|\w+))?', re.IGNORECASE)
+
+
+class SchemaCache(object):
+    '''Column metadata of tables, as rows of information_schema.columns
+    (parsed once with parse_column_schema) keyed by (schema, table).
+    TableMapEvents take their columns from it, so information_schema is
+    only queried the first time a table shows up rather than every time
+    MySQL hands out a new table id for it. Whole schemas can be fetched
+    in one query with prefetch. Entries stay until a DDL statement names
+    their table, see invalidate_query.
+
+    The cache can be saved to a file and loaded back on restart, see
+    save and load'''
+
+    def __init__(self, ctl_connection):
+        self.__ctl_connection = ctl_connection
+        self.tables = {}
+        # Binlog file and position up to which every DDL is reflected in
+        # the cache, kept by the stream and saved with it
+        self.ddl_log_pos = None
+
+    def prefetch(self, schemas):
+        '''Load the columns of every table in `schemas` with one query'''
+        schemas = list(schemas)
+        if not schemas:
+            return
+        cur = self.__ctl_connection.cursor()
+        cur.execute("""SELECT * FROM columns WHERE table_schema IN (%s)
+                       ORDER BY table_schema, table_name, ordinal_position"""
+                    % ', '.join(['%s'] * len(schemas)), schemas)
+        tables = {}
+        for column_schema in cur.fetchall():
+            key = (column_schema["TABLE_SCHEMA"], column_schema["TABLE_NAME"])
+            tables.setdefault(key, []).append(parse_column_schema(column_schema))
+        cur.close()
+        self.tables.update(tables)
+
+    def columns(self, schema, table):
+        '''Return the column metadata of `schema`.`table`, querying
+        information_schema if it isn't cached. Tables that don't exist
+        (anymore) aren't cached, so that they are looked up again once
+        they do'''
+        key = (schema, table)
+        if key not in self.tables:
+            cur = self.__ctl_connection.cursor()
+            cur.execute("""SELECT * FROM columns WHERE table_schema = %s AND table_name = %s
+                           ORDER BY ordinal_position""", (schema, table))
+            column_schemas = [parse_column_schema(c) for c in cur.fetchall()]
+            cur.close()
+            if not column_schemas:
+                return column_schemas
+            self.tables[key] = column_schemas
+        return self.tables[key]
+
+    def invalidate(self, schema, table=None):
+        '''Drop `schema`.`table`, or every table of `schema`'''
+        if table is not None:
+            self.tables.pop((schema, table), None)
+            return
+        for key in [key for key in self.tables if key[0] == schema]:
+            del self.tables[key]
+
+    def invalidate_query(self, schema, query):
+        '''Drop the tables a statement run with `schema` as its default
+        database may have changed. Statements that aren't DDL keep
+        everything'''
+        match = LEADING_COMMENT.match(query)
+        while match is not None:
+            query = query[match.end():]
+            match = LEADING_COMMENT.match(query)
+        match = SCHEMA_STATEMENT.match(query)
+        if match is not None:
+            self.invalidate(match.group(1).strip('`'))
+            return
+        if not DDL_STATEMENT.match(query):
+            return
+        for qualifier, name in TABLE_NAME.findall(query):
+            if name:
+                self.invalidate(qualifier.strip('`'), name.strip('`'))
+            else:
+                self.invalidate(schema, qualifier.strip('`'))
+
+    def checksum(self, schemas):
+        '''Return a checksum of the tables in `schemas` and their creation
+        times, which only reads information_schema.tables rather than
+        every column. It notices tables created, dropped or rebuilt while
+        nothing read the binlog, but not ALTERs done in place or
+        instantly, which keep the creation time: those are caught from
+        the binlog instead, as the stream reads the DDL logged after
+        ddl_log_pos before anything else'''
+        schemas = sorted(schemas)
+        cur = self.__ctl_connection.cursor()
+        cur.execute("""SELECT COUNT(*) AS count,
+                              SUM(CRC32(CONCAT_WS('.', table_schema, table_name, create_time))) AS sum
+                       FROM tables WHERE table_schema IN (%s)"""
+                    % ', '.join(['%s'] * len(schemas)), schemas)
+        row = cur.fetchone()
+        cur.close()
+        return '%s:%s:%s' % (','.join(schemas), row["count"], row["sum"])
+
+    def save(self, path, schemas):
+        '''Write the cache, with ddl_log_pos and the checksum of `schemas`
+        it is valid for, to `path`. The file is replaced at once, so that a crash never
+        leaves half of it'''
+        state = {"checksum": self.checksum(schemas),
+                 "ddl_log_pos": self.ddl_log_pos,
+                 "tables": [[schema, table, column_schemas]
+                            for (schema, table), column_schemas in self.tables.items()]}
+        with open(path + '.tmp', 'w') as state_file:
+            json.dump(state, state_file, default=str)
+        os.rename(path + '.tmp', path)
+
+    def load(self, path, schemas):
+        '''Fill the cache from a file written by save, if there is one and
+        the tables in `schemas` didn't change since. Return True if it was
+        loaded, in which case ddl_log_pos is where it was saved at'''
+        try:
+            with open(path) as state_file:
+                state = json.load(state_file)
+        except (IOError, ValueError):
+            return False
+        if not isinstance(state, dict) or not state.get("ddl_log_pos"):
+            return False
+        if state.get("checksum") != self.checksum(schemas):
+            return False
+        for schema, table, column_schemas in state["tables"]:
+            self.tables[(schema, table)] = column_schemas
+        self.ddl_log_pos = tuple(state["ddl_log_pos"])
+        return True
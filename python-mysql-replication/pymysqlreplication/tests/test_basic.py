@@ -1,9 +1,12 @@
 from pymysqlreplication.tests import base
-from pymysqlreplication import BinLogStreamReader
+from pymysqlreplication import BinLogStreamReader, BinLogFileReader
 from pymysqlreplication.event import *
 from pymysqlreplication.constants.BINLOG import *
 from pymysqlreplication.row_event import *
+from pymysqlreplication.decoder import RowDecoderPool
 import time
+import os
+import tempfile
 
 class TestBasicBinLogStreamReader(base.PyMySQLReplicationTestCase):
     def test_read_query_event(self):
@@ -56,6 +59,122 @@ class TestBasicBinLogStreamReader(base.PyMySQLReplicationTestCase):
         self.assertIsInstance(event, QueryEvent)
         self.assertEqual(event.query, query)
 
+    def test_skip_other_schema_events(self):
+        self.execute("DROP DATABASE IF EXISTS pymysqlreplication_other")
+        self.execute("CREATE DATABASE pymysqlreplication_other")
+        self.execute("CREATE TABLE pymysqlreplication_other.test (id INT NOT NULL, PRIMARY KEY (id))")
+        self.execute("INSERT INTO pymysqlreplication_other.test VALUES(1)")
+        self.execute("COMMIT")
+        self.execute("CREATE TABLE test (id INT NOT NULL, PRIMARY KEY (id))")
+        self.execute("INSERT INTO test VALUES(2)")
+        self.execute("COMMIT")
+        self.execute("DROP DATABASE pymysqlreplication_other")
+
+        event = self.stream.fetchone()
+        while not isinstance(event, (TableMapEvent, RowsEvent)):
+            event = self.stream.fetchone()
+        self.assertIsInstance(event, TableMapEvent)
+        self.assertEqual(event.schema, "pymysqlreplication_test")
+
+        event = self.stream.fetchone()
+        self.assertIsInstance(event, WriteRowsEvent)
+        self.assertEqual(event.rows[0]["values"]["id"], 2)
+
+    def test_only_schemas(self):
+        self.stream.close()
+        self.stream = BinLogStreamReader(connection_settings = self.database,
+                                         only_events = [WriteRowsEvent],
+                                         only_schemas = ["pymysqlreplication_test", "pymysqlreplication_other"])
+        self.execute("DROP DATABASE IF EXISTS pymysqlreplication_other")
+        self.execute("CREATE DATABASE pymysqlreplication_other")
+        self.execute("CREATE TABLE pymysqlreplication_other.test (id INT NOT NULL, PRIMARY KEY (id))")
+        self.execute("INSERT INTO pymysqlreplication_other.test VALUES(1)")
+        self.execute("COMMIT")
+        self.execute("CREATE TABLE test (id INT NOT NULL, PRIMARY KEY (id))")
+        self.execute("INSERT INTO test VALUES(2)")
+        self.execute("COMMIT")
+        self.execute("DROP DATABASE pymysqlreplication_other")
+
+        event = self.stream.fetchone()
+        self.assertEqual(event.schema, "pymysqlreplication_other")
+        self.assertEqual(event.rows[0]["values"]["id"], 1)
+
+        event = self.stream.fetchone()
+        self.assertEqual(event.schema, "pymysqlreplication_test")
+        self.assertEqual(event.rows[0]["values"]["id"], 2)
+
+    def test_only_schemas_non_ascii(self):
+        self.stream.close()
+        self.stream = BinLogStreamReader(connection_settings = self.database,
+                                         only_events = [WriteRowsEvent])
+        other = u"`pymysqlreplication_\u00e9`"
+        self.execute(u"DROP DATABASE IF EXISTS %s" % other)
+        self.execute(u"CREATE DATABASE %s" % other)
+        # Statements and table maps of the other schema carry its name
+        self.execute(u"USE %s" % other)
+        self.execute("CREATE TABLE test (id INT NOT NULL, PRIMARY KEY (id))")
+        self.execute("INSERT INTO test VALUES(1)")
+        self.execute("COMMIT")
+        self.execute("USE pymysqlreplication_test")
+        self.execute("CREATE TABLE test (id INT NOT NULL, PRIMARY KEY (id))")
+        self.execute("INSERT INTO test VALUES(2)")
+        self.execute("COMMIT")
+        self.execute(u"DROP DATABASE %s" % other)
+
+        event = self.stream.fetchone()
+        self.assertEqual(event.schema, "pymysqlreplication_test")
+        self.assertEqual(event.rows[0]["values"]["id"], 2)
+
+    def test_log_file_follows_rotation(self):
+        self.execute("CREATE TABLE test (id INT NOT NULL, PRIMARY KEY (id))")
+        self.execute("FLUSH LOGS")
+        self.execute("INSERT INTO test VALUES(1)")
+        self.execute("COMMIT")
+
+        rotations = []
+        event = self.stream.fetchone()
+        while not isinstance(event, WriteRowsEvent):
+            if isinstance(event, RotateEvent):
+                rotations.append(event.next_binlog)
+            event = self.stream.fetchone()
+        self.assertEqual(len(rotations), 2)
+        self.assertNotEqual(rotations[0], rotations[1])
+        self.assertEqual(event.log_file, rotations[1])
+        self.assertEqual(self.stream.log_file, rotations[1])
+
+    def test_heartbeat(self):
+        self.stream.close()
+        self.stream = BinLogStreamReader(connection_settings = self.database, blocking = True,
+                                         only_events = [HeartbeatLogEvent], heartbeat_period = 0.1)
+        event = self.stream.fetchone()
+        self.assertIsInstance(event, HeartbeatLogEvent)
+        self.assertEqual(event.ident, self.stream.log_file)
+
+    def test_read_binlog_files(self):
+        self.execute("CREATE TABLE test (id INT NOT NULL, PRIMARY KEY (id))")
+        self.execute("INSERT INTO test VALUES(1)")
+        self.execute("COMMIT")
+        self.execute("FLUSH LOGS")
+        self.execute("INSERT INTO test VALUES(2)")
+        self.execute("COMMIT")
+        self.execute("FLUSH LOGS")
+
+        # Needs the binlog files of the server on this host
+        cur = self.conn_control.cursor()
+        cur.execute("SHOW VARIABLES LIKE 'log_bin_index'")
+        log_files = BinLogFileReader.index_files(cur.fetchone()[1])
+        self.stream.close()
+        self.stream = BinLogFileReader(log_files, connection_settings = self.database,
+                                       only_events = [WriteRowsEvent])
+
+        event = self.stream.fetchone()
+        self.assertEqual(event.rows[0]["values"]["id"], 1)
+        self.assertEqual(event.log_file, os.path.basename(log_files[0]))
+        event = self.stream.fetchone()
+        self.assertEqual(event.rows[0]["values"]["id"], 2)
+        self.assertEqual(event.log_file, os.path.basename(log_files[1]))
+        self.assertIsNone(self.stream.fetchone())
+
     def test_write_row_event(self):
         query = "CREATE TABLE test (id INT NOT NULL AUTO_INCREMENT, data VARCHAR (50) NOT NULL, PRIMARY KEY (id))"
         self.execute(query)
@@ -85,6 +204,40 @@ class TestBasicBinLogStreamReader(base.PyMySQLReplicationTestCase):
         self.assertEqual(event.table, "test")
         self.assertEqual(event.columns[1].name, 'data')
 
+    def test_iter_rows(self):
+        self.execute("CREATE TABLE test (id INT NOT NULL, PRIMARY KEY (id))")
+        self.execute("INSERT INTO test VALUES(1), (2), (3)")
+        self.execute("COMMIT")
+
+        event = self.stream.fetchone()
+        while not isinstance(event, WriteRowsEvent):
+            event = self.stream.fetchone()
+        rows = event.iter_rows()
+        self.assertEqual(next(rows)["values"]["id"], 1)
+        self.assertEqual([row["values"]["id"] for row in rows], [2, 3])
+        # Decoded again rather than kept
+        self.assertEqual([row["values"]["id"] for row in event.iter_rows()], [1, 2, 3])
+        self.assertEqual([row["values"]["id"] for row in event.rows], [1, 2, 3])
+
+    def test_tuple_rows(self):
+        self.stream.close()
+        self.stream = BinLogStreamReader(connection_settings = self.database,
+                                         only_events = [WriteRowsEvent, UpdateRowsEvent],
+                                         tuple_rows = True)
+        self.execute("CREATE TABLE test (id INT NOT NULL, data VARCHAR (50), PRIMARY KEY (id))")
+        self.execute("INSERT INTO test VALUES(1, 'Hello')")
+        self.execute("UPDATE test SET data = 'World' WHERE id = 1")
+        self.execute("COMMIT")
+
+        event = self.stream.fetchone()
+        self.assertIsInstance(event, WriteRowsEvent)
+        self.assertEqual(event.column_index, {"id": 0, "data": 1})
+        self.assertEqual(event.rows, [(1, "Hello")])
+
+        event = self.stream.fetchone()
+        self.assertIsInstance(event, UpdateRowsEvent)
+        self.assertEqual(event.rows, [((1, "Hello"), (1, "World"))])
+
     def test_delete_row_event(self):
         query = "CREATE TABLE test (id INT NOT NULL AUTO_INCREMENT, data VARCHAR (50) NOT NULL, PRIMARY KEY (id))"
         self.execute(query)
@@ -145,6 +298,206 @@ class TestBasicBinLogStreamReader(base.PyMySQLReplicationTestCase):
         self.assertEqual(event.rows[0]["after_values"]["id"], 1)        
         self.assertEqual(event.rows[0]["after_values"]["data"], "World")
 
+    def test_xid_event(self):
+        query = "CREATE TABLE test (id INT NOT NULL AUTO_INCREMENT, data VARCHAR (50) NOT NULL, PRIMARY KEY (id))"
+        self.execute(query)
+
+        self.resetBinLog()
+
+        query = "INSERT INTO test (data) VALUES('Hello World')"
+        self.execute(query)
+        self.execute("COMMIT")
+
+        #RotateEvent
+        self.stream.fetchone()
+        #FormatDescription
+        self.stream.fetchone()
+
+        #QueryEvent for the BEGIN
+        event = self.stream.fetchone()
+        self.assertEqual(event.query, "BEGIN")
+
+        #TableMapEvent
+        self.stream.fetchone()
+        #WriteRowsEvent
+        self.stream.fetchone()
+
+        event = self.stream.fetchone()
+        self.assertIsInstance(event, XidEvent)
+        self.assertEqual(event.log_pos, self.stream.log_pos)
+
+    def test_table_map_primary_key(self):
+        self.execute("CREATE TABLE test (a INT NOT NULL, b INT NOT NULL, data VARCHAR (50), PRIMARY KEY (a, b))")
+        self.execute("CREATE TABLE test_unique (id INT NOT NULL, data VARCHAR (50), UNIQUE KEY (id))")
+        self.execute("CREATE TABLE test_keyless (id INT, data VARCHAR (50))")
+
+        self.resetBinLog()
+
+        self.execute("INSERT INTO test VALUES(1, 2, 'Hello')")
+        self.execute("INSERT INTO test_unique VALUES(1, 'Hello')")
+        self.execute("INSERT INTO test_keyless VALUES(1, 'Hello')")
+        self.execute("COMMIT")
+
+        primary_keys = {}
+        for i in range(0, 3):
+            event = self.stream.fetchone()
+            while not isinstance(event, WriteRowsEvent):
+                event = self.stream.fetchone()
+            primary_keys[event.table] = event.primary_key
+
+        self.assertEqual(primary_keys["test"], ("a", "b"))
+        self.assertEqual(primary_keys["test_unique"], ("id",))
+        self.assertEqual(primary_keys["test_keyless"], ())
+
+    def test_row_decoder_reuse(self):
+        self.execute("CREATE TABLE test (id INT NOT NULL, data VARCHAR (50), PRIMARY KEY (id))")
+        self.execute("INSERT INTO test VALUES(1, 'Hello')")
+        self.execute("COMMIT")
+        self.execute("INSERT INTO test VALUES(2, NULL)")
+        self.execute("COMMIT")
+
+        table_maps = []
+        while len(table_maps) < 2:
+            event = self.stream.fetchone()
+            if isinstance(event, TableMapEvent):
+                table_maps.append(event)
+            elif isinstance(event, WriteRowsEvent):
+                self.assertIs(event.row_decoder, table_maps[-1].row_decoder)
+        self.assertIsNot(table_maps[0], table_maps[1])
+        self.assertIs(table_maps[0].row_decoder, table_maps[1].row_decoder)
+
+        event = self.stream.fetchone()
+        self.assertIsInstance(event, WriteRowsEvent)
+        self.assertEqual(event.rows[0]["values"], {"id": 2, "data": None})
+
+    def test_schema_cache_invalidation(self):
+        self.execute("CREATE TABLE test (id INT NOT NULL, PRIMARY KEY (id))")
+        self.execute("INSERT INTO test VALUES(1)")
+        self.execute("COMMIT")
+        self.execute("ALTER TABLE test ADD COLUMN data VARCHAR (50)")
+        self.execute("INSERT INTO test VALUES(2, 'Hello')")
+        self.execute("COMMIT")
+
+        key = ("pymysqlreplication_test", "test")
+        event = self.stream.fetchone()
+        while not isinstance(event, WriteRowsEvent):
+            event = self.stream.fetchone()
+        self.assertIn(key, self.stream.schema_cache.tables)
+
+        event = self.stream.fetchone()
+        while not (isinstance(event, QueryEvent) and event.query.startswith("ALTER")):
+            event = self.stream.fetchone()
+        self.assertNotIn(key, self.stream.schema_cache.tables)
+
+        event = self.stream.fetchone()
+        while not isinstance(event, WriteRowsEvent):
+            event = self.stream.fetchone()
+        self.assertEqual(event.rows[0]["values"], {"id": 2, "data": "Hello"})
+
+    def test_schema_cache_commented_ddl(self):
+        self.execute("CREATE TABLE test (id INT NOT NULL, data VARCHAR (50))")
+        self.execute("INSERT INTO test VALUES(1, 'Hello')")
+        self.execute("COMMIT")
+        # Only the key changes, which the column count doesn't tell
+        self.execute("/* pt-osc */ ALTER TABLE test ADD PRIMARY KEY (id)")
+        self.execute("INSERT INTO test VALUES(2, 'Hello')")
+        self.execute("COMMIT")
+
+        key = ("pymysqlreplication_test", "test")
+        event = self.stream.fetchone()
+        while not isinstance(event, WriteRowsEvent):
+            event = self.stream.fetchone()
+        self.assertEqual(event.primary_key, ())
+
+        event = self.stream.fetchone()
+        while not (isinstance(event, QueryEvent) and "ALTER" in event.query):
+            event = self.stream.fetchone()
+        self.assertNotIn(key, self.stream.schema_cache.tables)
+
+        event = self.stream.fetchone()
+        while not isinstance(event, WriteRowsEvent):
+            event = self.stream.fetchone()
+        self.assertEqual(event.primary_key, ("id",))
+
+    def test_schema_cache_qualified_ddl(self):
+        self.stream.close()
+        self.stream = BinLogStreamReader(connection_settings = self.database,
+                                         only_events = [WriteRowsEvent],
+                                         only_schemas = ["pymysqlreplication_other"])
+        self.execute("DROP DATABASE IF EXISTS pymysqlreplication_other")
+        self.execute("CREATE DATABASE pymysqlreplication_other")
+        self.execute("CREATE TABLE pymysqlreplication_other.test (id INT NOT NULL, PRIMARY KEY (id))")
+        self.execute("INSERT INTO pymysqlreplication_other.test VALUES(1)")
+        self.execute("COMMIT")
+        # Run from pymysqlreplication_test, which isn't replicated
+        self.execute("ALTER TABLE pymysqlreplication_other.test ADD COLUMN data VARCHAR (50)")
+        self.execute("INSERT INTO pymysqlreplication_other.test VALUES(2, 'Hello')")
+        self.execute("COMMIT")
+        self.execute("DROP DATABASE pymysqlreplication_other")
+
+        event = self.stream.fetchone()
+        self.assertEqual(event.rows[0]["values"], {"id": 1})
+
+        event = self.stream.fetchone()
+        self.assertEqual(event.rows[0]["values"], {"id": 2, "data": "Hello"})
+
+    def test_schema_state_file(self):
+        self.execute("CREATE TABLE test (id INT NOT NULL, PRIMARY KEY (id))")
+        path = os.path.join(tempfile.mkdtemp(), "schema_state")
+
+        def reopen():
+            self.stream.close()
+            self.stream = BinLogStreamReader(connection_settings = self.database,
+                                             schema_state_file = path)
+
+        reopen()
+        self.assertFalse(self.stream.schema_state_loaded)
+        reopen()
+        self.assertTrue(self.stream.schema_state_loaded)
+        self.assertIn(("pymysqlreplication_test", "test"), self.stream.schema_cache.tables)
+
+        # Streaming from after the ALTER, which may have been done in place,
+        # still reads it for the schema cache
+        self.execute("ALTER TABLE test ADD COLUMN data VARCHAR (50)")
+        self.stream.close()
+        self.stream = BinLogStreamReader(connection_settings = self.database,
+                                         schema_state_file = path, resume_stream = True)
+        self.assertIsNone(self.stream.fetchone())
+        self.assertEqual(len(self.stream.schema_cache.columns("pymysqlreplication_test", "test")), 2)
+
+        self.execute("DROP TABLE test")
+        self.execute("CREATE TABLE test2 (id INT NOT NULL, PRIMARY KEY (id))")
+        reopen()
+        self.assertFalse(self.stream.schema_state_loaded)
+
+    def test_row_decoder_pool(self):
+        self.stream.close()
+        self.stream = BinLogStreamReader(connection_settings = self.database,
+                                         row_decoder_pool = RowDecoderPool(2))
+        query = "CREATE TABLE test (id INT NOT NULL AUTO_INCREMENT, data VARCHAR (50) NOT NULL, PRIMARY KEY (id))"
+        self.execute(query)
+        query = "INSERT INTO test (data) VALUES('Hello World'), ('Hello Again')"
+        self.execute(query)
+        self.execute("COMMIT")
+
+        #RotateEvent
+        self.stream.fetchone()
+        #FormatDescription
+        self.stream.fetchone()
+        #QueryEvent for the Create Table
+        self.stream.fetchone()
+        #QueryEvent for the BEGIN
+        self.stream.fetchone()
+        #TableMapEvent
+        self.stream.fetchone()
+
+        event = self.stream.fetchone()
+        self.assertIsInstance(event, WriteRowsEvent)
+        self.assertEqual(len(event.rows), 2)
+        self.assertEqual(event.rows[0]["values"]["data"], "Hello World")
+        self.assertEqual(event.rows[1]["values"]["data"], "Hello Again")
+
+
 class TestMultipleRowBinLogStreamReader(base.PyMySQLReplicationTestCase):
     def test_insert_multiple_row_event(self):
         query = "CREATE TABLE test (id INT NOT NULL AUTO_INCREMENT, data VARCHAR (50) NOT NULL, PRIMARY KEY (id))"
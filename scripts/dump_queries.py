@@ -30,7 +30,7 @@ logging.debug('listening')
 
 try:
     for binlogevent in stream:
-        queries = process_binlogevent(binlogevent)
+        queries = process_binlogevent(binlogevent, get_apply_settings(args))
         for q in queries:
             query_args = map(lambda obj: dummy_conn.escape(obj), q[1])
             logging.info(q[0] % tuple(query_args))
@@ -0,0 +1,161 @@
+# Copyright 2013 MemSQL, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use
+# this file except in compliance with the License.  You may obtain a copy of the
+# License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations under the License.
+
+# Net-change compaction of the row changes of several source transactions
+
+from replication_utils import *
+import time
+
+class CompactionWindow(object):
+    """Holds the row changes of consecutive source transactions and
+    reduces them to their net effect per (table, key) before they are
+    applied:
+
+    * a row inserted and then updated becomes one upsert of its final image
+    * a row inserted and then deleted disappears
+    * a row updated several times becomes one update to its final image
+    * a row updated or deleted after existing before the window becomes
+      an update from its first before-image, or a delete
+
+    Updates that change a row's key are treated as a delete of the old
+    key and an insert of the new one. Changes to keyless tables can't be
+    told apart, so they are kept as they are, in binlog order.
+
+    The window is meant to be flushed (applied and cleared) once it holds
+    `max_events' row events or is `max_ms' milliseconds old, and before
+    any DDL. Only whole transactions are added, so a flushed window
+    always ends on a commit and its log_pos is a valid checkpoint.
+
+    """
+
+    def __init__(self, max_events, max_ms):
+        self.max_events = max_events
+        self.max_ms = max_ms
+        self.clear()
+
+    def clear(self):
+        # table -> latest row event on it, for its column names and key
+        self.tables = OrderedDict()
+        # table -> key tuple -> [existed before the window, first
+        # before-image, current image or None if deleted]
+        self.changes = {}
+        # table -> row events, for keyless tables
+        self.keyless = {}
+        self.events = 0
+        self.started = None
+        self.log_pos = None
+
+    def __len__(self):
+        return self.events
+
+    @staticmethod
+    def can_compact(binlogevents):
+        """Returns True if the transaction only holds row events. Anything
+        else (statements logged as queries) has to be applied in order"""
+        return all(isinstance(e, RowsEvent) for e in binlogevents)
+
+    def is_full(self):
+        return (self.events >= self.max_events or
+                (time.time() - self.started) * 1000 >= self.max_ms)
+
+    def add_transaction(self, binlogevents, log_pos):
+        """Adds the row events of a committed source transaction. `log_pos'
+        is the position after its commit"""
+        if self.started is None:
+            self.started = time.time()
+        for binlogevent in binlogevents:
+            self.events += 1
+            self.tables[binlogevent.table] = binlogevent
+            if not binlogevent.primary_key:
+                self.keyless.setdefault(binlogevent.table, []).append(binlogevent)
+                continue
+            table = self.changes.setdefault(binlogevent.table, OrderedDict())
+            positions = key_positions(binlogevent)
+            for row in binlogevent.iter_rows():
+                if isinstance(binlogevent, WriteRowsEvent):
+                    self.__insert(table, positions, row)
+                elif isinstance(binlogevent, DeleteRowsEvent):
+                    self.__delete(table, positions, row)
+                elif isinstance(binlogevent, UpdateRowsEvent):
+                    self.__update(table, positions, row[0], row[1])
+        self.log_pos = log_pos
+
+    def __insert(self, table, positions, values):
+        key = key_of(positions, values)
+        change = table.get(key)
+        if change is None:
+            table[key] = [False, None, values]
+        else:
+            change[2] = values
+
+    def __delete(self, table, positions, values):
+        key = key_of(positions, values)
+        change = table.get(key)
+        if change is None:
+            table[key] = [True, values, None]
+        else:
+            change[2] = None
+
+    def __update(self, table, positions, before_values, after_values):
+        key = key_of(positions, before_values)
+        if key != key_of(positions, after_values):
+            self.__delete(table, positions, before_values)
+            self.__insert(table, positions, after_values)
+            return
+        change = table.get(key)
+        if change is None:
+            table[key] = [True, before_values, after_values]
+        else:
+            change[2] = after_values
+
+    def queries(self, settings):
+        """Yields the queries applying the net effect of the window"""
+        for table, queries in self.table_queries(settings):
+            for query in queries:
+                yield query
+
+    def table_queries(self, settings):
+        """Yields a (table, queries) pair for each table in the window,
+        where `queries' yields the queries applying the net effect of the
+        window on that table"""
+        for table in self.tables:
+            yield table, self.__table_queries(table, settings)
+
+    def __table_queries(self, table, settings):
+        """Yields the queries for one table. Deletes come first so that
+        reinserted rows can't collide with rows that are going away"""
+        binlogevent = self.tables[table]
+        if table in self.keyless:
+            for query in process_binlogevents(self.keyless[table], settings):
+                yield query
+            return
+
+        names = column_names(binlogevent)
+        primary_key = binlogevent.primary_key
+        deletes = []
+        updates = []
+        upserts = []
+        for existed, before_values, after_values in self.changes.get(table, {}).values():
+            if existed and after_values is None:
+                deletes.append(before_values)
+            elif existed:
+                updates.append((before_values, after_values))
+            elif after_values is not None:
+                upserts.append(after_values)
+
+        for query in delete_queries(table, primary_key, names, deletes, settings):
+            yield query
+        for query in update_queries(table, primary_key, names, updates, settings):
+            yield query
+        for query in insert_queries(table, names, upserts, settings, upsert=True):
+            yield query
@@ -14,9 +14,14 @@
 # Various globs of code that are shared between replication scripts
 
 from replication_utils import *
+from replication_compaction import CompactionWindow
+from replication_parallel import LaneApplier, WritesetApplier
+from replication_pipeline import Pipeline
+from replication_spool import Spool
 import signal
 import sys
 import logging
+import collections
 
 import MySQLdb
 
@@ -24,9 +29,9 @@ def wrap_execution(function, args, memsql_conn=None, stream=None):
     """Wraps the query execution in a try/except block for handling MySQL
     errors. This should be run around every chunk of code that can run
     queries, preferrably close to the scope where the queries are
-    made. If it gets a 'memsql_conn' argument and a 'stream' argument,
-    it closes those connections if it has to. If it doesn't have the
-    arguments, it won't try to do that.
+    made. If it gets a 'memsql_conn' argument (or a dict of them, by
+    database) and a 'stream' argument, it closes those connections if it
+    has to. If it doesn't have the arguments, it won't try to do that.
 
     """
 
@@ -34,7 +39,10 @@ def wrap_execution(function, args, memsql_conn=None, stream=None):
         try:
             if stream is not None:
                 stream.close()
-            if memsql_conn is not None:
+            if isinstance(memsql_conn, dict):
+                for conn in memsql_conn.values():
+                    unoccupy_ditto_info(conn)
+            elif memsql_conn is not None:
                 unoccupy_ditto_info(memsql_conn)
         except Exception as e:
             logging.warning('Could not release ditto lock or close stream: %s' % e)
@@ -43,9 +51,9 @@ def wrap_execution(function, args, memsql_conn=None, stream=None):
         return function(*args)
     except MySQLdb.DatabaseError as e:
         logging.error(e)
-        # Close connections and exit if it has one of the below exit
-        # codes (so far just 'lost database connection')
-        if e[0] in [2006]:
+        # Close connections and exit if it has one of the fatal exit
+        # codes
+        if e[0] in FATAL_ERROR_CODES:
             logging.debug('exiting')
             handle_closing()
             sys.exit(1)
@@ -57,50 +65,379 @@ def wrap_execution(function, args, memsql_conn=None, stream=None):
         raise
 
 def connect_to_databases(args):
-    """Returns connections to MySQL (as a stream) and MemSQL"""
-    stream = connect_to_mysql_stream(args)
-    memsql_conn = connect_to_memsql(args, stream)
-    memsql_conn.set_print_queries(True)
-    memsql_conn.set_print_function(logging.debug)
-    return stream, memsql_conn
-
-def binlog_listen(memsql_conn, stream):
+    """Returns connections to MySQL (as a single stream holding the events
+    of every replicated database) and MemSQL (a dict of connections by
+    database). The stream starts from the earliest position any database
+    has to resume from
+
+    """
+    databases = get_databases(args)
+    if args.mysqldump_file != '' and len(databases) > 1:
+        sys.exit('--mysqldump-file can only be used to replicate a single database')
+    stream = connect_to_mysql_stream(args, databases)
+    memsql_conns = OrderedDict()
+    log_positions = []
+    for database in databases:
+        memsql_conn, log_pos = connect_to_memsql(database_args(args, database), stream)
+        memsql_conn.set_print_queries(True)
+        memsql_conn.set_print_function(logging.debug)
+        memsql_conns[database] = memsql_conn
+        log_positions.append(log_pos)
+    (log_file, log_pos) = min(log_positions)
+    if args.spool_dir:
+        # The Spool connects the stream once it knows what it holds
+        (stream.log_file, stream.log_pos) = (log_file, log_pos)
+    else:
+        stream.connect_to_stream(custom_log_pos = log_pos, custom_log_file = log_file)
+    return stream, memsql_conns
+
+def apply_event(memsql_conn, stream, binlogevent, settings, checkpointer):
+    """Runs the queries for a single event outside of a transaction, then
+    records the position after it. Used for DDL, which MemSQL won't run
+    inside a transaction, so the position is always recorded right away.
+
+    """
+    for q in process_binlogevent(binlogevent, settings):
+        wrap_execution(memsql_conn.execute, [q[0]] + q[1], memsql_conn, stream)
+    log_pos = event_binlog_pos(binlogevent)
+    wrap_execution(record_binlog_pos, [memsql_conn, log_pos], memsql_conn, stream)
+    checkpointer.committed(1, log_pos, True)
+
+def apply_transaction(memsql_conn, stream, queries, events, log_pos, checkpointer):
+    """Runs the queries for a source transaction of `events' events (or
+    a compaction window of them) inside a single MemSQL transaction. If
+    the checkpointer says so, `log_pos' (the position after the source
+    commit) is recorded as part of the same commit. If ditto dies halfway
+    through, the MemSQL transaction is rolled back together with the
+    position, so the whole source transaction is replayed on resume.
+
+    """
+    wrap_execution(memsql_conn.execute, ['BEGIN'], memsql_conn, stream)
+    for q in queries:
+        wrap_execution(memsql_conn.execute, [q[0]] + q[1], memsql_conn, stream)
+    checkpoint = checkpointer.is_due(events)
+    if checkpoint:
+        wrap_execution(record_binlog_pos, [memsql_conn, log_pos], memsql_conn, stream)
+    wrap_execution(memsql_conn.execute, ['COMMIT'], memsql_conn, stream)
+    checkpointer.committed(events, log_pos, checkpoint)
+
+def record_later_binlog_pos(memsql_conn, checkpointer, log_pos):
+    """Records `log_pos' once anything uncommitted is rolled back, unless
+    a later position was recorded already. ditto_info itself is checked
+    too, since a signal may arrive between committing a transaction
+    along with its position and telling the checkpointer, and recording
+    an earlier position would replay that transaction on resume"""
+    memsql_conn.execute('ROLLBACK')
+    recorded_pos = max(checkpointer.recorded_pos, get_ditto_pos(memsql_conn))
+    if log_pos > recorded_pos:
+        record_binlog_pos(memsql_conn, log_pos)
+        recorded_pos = log_pos
+    checkpointer.committed(0, recorded_pos, True)
+
+def record_final_checkpoint(memsql_conn, checkpointer):
+    """Records the position after the last committed transaction, if the
+    checkpointer held it back. Anything applied after it is rolled back
+    first"""
+    if checkpointer.pending_pos is not None:
+        record_later_binlog_pos(memsql_conn, checkpointer, checkpointer.pending_pos)
+
+class SerialApplier(object):
+    """Applies everything in binlog order on the main MemSQL connection"""
+
+    def __init__(self, memsql_conn, stream, settings, checkpointer):
+        self.memsql_conn = memsql_conn
+        self.stream = stream
+        self.settings = settings
+        self.checkpointer = checkpointer
+        # Position after the last transaction or DDL committed
+        self.applied_pos = None
+
+    def apply_transaction(self, binlogevents, log_pos):
+        apply_transaction(self.memsql_conn, self.stream,
+                          process_binlogevents(binlogevents, self.settings),
+                          len(binlogevents), log_pos, self.checkpointer)
+        self.applied_pos = log_pos
+
+    def apply_window(self, window):
+        apply_transaction(self.memsql_conn, self.stream, window.queries(self.settings),
+                          len(window), window.log_pos, self.checkpointer)
+        self.applied_pos = window.log_pos
+
+    def apply_ddl(self, binlogevent):
+        apply_event(self.memsql_conn, self.stream, binlogevent, self.settings,
+                    self.checkpointer)
+        self.applied_pos = event_binlog_pos(binlogevent)
+
+    def committed_pos(self):
+        """Returns the position after the last transaction or DDL that
+        was committed along with everything before it"""
+        return self.applied_pos
+
+    def checkpoint(self, events, log_pos):
+        """Records `log_pos' on its own, once everything up to it was
+        applied elsewhere"""
+        wrap_execution(record_binlog_pos, [self.memsql_conn, log_pos],
+                       self.memsql_conn, self.stream)
+        self.checkpointer.committed(events, log_pos, True)
+
+    def finish(self):
+        """Records the position of the last committed transaction"""
+        record_final_checkpoint(self.memsql_conn, self.checkpointer)
+
+    def close(self):
+        pass
+
+def get_applier(memsql_conn, stream, args, settings, checkpointer):
+    """Returns the applier binlog_listen hands transactions and DDL to:
+    a SerialApplier, or if more than one parallel lane was asked for, a
+    WritesetApplier or LaneApplier depending on the lane routing"""
+    serial = SerialApplier(memsql_conn, stream, settings, checkpointer)
+    if args.parallel_lanes <= 1:
+        return serial
+    if settings['apply_mode'] != 'upsert':
+        logging.warning('Parallel lanes are used without --apply-mode=upsert, '
+                        'so a crash may apply some changes twice')
+    if args.lane_routing == 'writeset':
+        return WritesetApplier(serial, get_memsql_settings(args), args.parallel_lanes)
+    return LaneApplier(serial, get_memsql_settings(args), args.parallel_lanes,
+                       args.lane_routing == 'key')
+
+class ApplyTarget(object):
+    """Replicates one database from a stream shared with others: its
+    MemSQL connection, the applier and checkpointer behind it, and its
+    compaction window. Transactions and DDL ending at or before the
+    position recorded in its ditto_info when listening starts were
+    already applied (the stream starts from the earliest position of all
+    the databases), so they are skipped.
+
+    """
+
+    def __init__(self, memsql_conn, stream, args, settings):
+        self.memsql_conn = memsql_conn
+        self.stream = stream
+        self.start_pos = get_ditto_pos(memsql_conn)
+        self.checkpointer = Checkpointer(args.checkpoint_events, args.checkpoint_ms,
+                                         self.start_pos)
+        self.applier = get_applier(memsql_conn, stream, args, settings, self.checkpointer)
+        self.window = None
+        if args.compaction_events > 0:
+            self.window = CompactionWindow(args.compaction_events, args.compaction_ms)
+        # Master timestamps of the oldest and newest transaction held in
+        # the window
+        self.held_timestamps = None
+        # Position and master timestamps of the oldest and newest change
+        # of what was handed to the applier and isn't known to be
+        # committed yet, in binlog order
+        self.handed = collections.deque()
+        # Master timestamp of the newest change known to be committed
+        self.committed_timestamp = None
+
+    def flush_window(self):
+        if self.window is not None and len(self.window) > 0:
+            self.handed.append((self.window.log_pos,) + self.held_timestamps)
+            wrap_execution(self.applier.apply_window, [self.window],
+                           self.memsql_conn, self.stream)
+            self.window.clear()
+            self.held_timestamps = None
+
+    def commit(self, transaction, log_pos, timestamp):
+        """Applies the events a source transaction committed at `log_pos'
+        (logged at `timestamp' on the master) has for this database"""
+        if log_pos <= self.start_pos:
+            return
+        if self.window is not None and self.window.can_compact(transaction):
+            self.window.add_transaction(transaction, log_pos)
+            if self.held_timestamps is None:
+                self.held_timestamps = (timestamp, timestamp)
+            else:
+                self.held_timestamps = (self.held_timestamps[0], timestamp)
+            if self.window.is_full():
+                self.flush_window()
+        else:
+            self.flush_window()
+            self.handed.append((log_pos, timestamp, timestamp))
+            wrap_execution(self.applier.apply_transaction, [transaction, log_pos],
+                           self.memsql_conn, self.stream)
+
+    def apply_ddl(self, binlogevent):
+        log_pos = event_binlog_pos(binlogevent)
+        if log_pos <= self.start_pos:
+            return
+        # Held changes never get compacted across DDL
+        self.flush_window()
+        self.handed.append((log_pos, binlogevent.timestamp, binlogevent.timestamp))
+        wrap_execution(self.applier.apply_ddl, [binlogevent], self.memsql_conn, self.stream)
+
+    def lag_timestamps(self):
+        """Returns the master timestamps of the oldest change not committed
+        to MemSQL yet, held in the window or handed to the applier (None
+        if there is none), and of the newest one that is (see
+        ReplicationLag). The applier tells which positions were
+        committed, which with parallel lanes is only once they were
+        applied rather than when they were handed over"""
+        committed_pos = self.applier.committed_pos()
+        while self.handed and self.handed[0][0] <= committed_pos:
+            self.committed_timestamp = self.handed.popleft()[2]
+        pending = []
+        if self.handed:
+            pending.append(self.handed[0][1])
+        held_timestamps = self.held_timestamps
+        if held_timestamps is not None:
+            pending.append(held_timestamps[0])
+        return (min(pending) if pending else None, self.committed_timestamp)
+
+    def idle(self):
+        """Called when the master has nothing to send. Held changes and
+        the position are applied and recorded once they are due by time,
+        rather than waiting for the next transaction to check"""
+        if self.window is not None and len(self.window) > 0 and self.window.is_full():
+            self.flush_window()
+        if self.checkpointer.pending_pos is not None and self.checkpointer.is_due(0):
+            wrap_execution(self.applier.finish, [], self.memsql_conn, self.stream)
+
+    def finish(self, log_pos=None):
+        """Records the position of the last committed transaction. If
+        `log_pos' is given and nothing is held in the compaction window,
+        everything up to it was applied, so it is recorded instead, even
+        if the last transactions didn't touch this database"""
+        self.applier.finish()
+        if log_pos is not None and (self.window is None or len(self.window) == 0):
+            record_later_binlog_pos(self.memsql_conn, self.checkpointer, log_pos)
+
+    def close(self):
+        self.applier.close()
+
+def binlog_listen(memsql_conns, stream, args):
     """Listens to the binlog on stream, executing every query it receives
-on the MemSQL connection. It also updates the binlog position after
-every query so that it can resume in case of interruption. Upon
-receiving a SIGINT, it closes the stream and unoccupies the database.
+on the MemSQL connection of its database (`memsql_conns' holds one per
+replicated database, each with an ApplyTarget). The events of each
+source transaction are buffered until its commit and then applied in
+one MemSQL transaction that also updates the binlog position, so that
+it can resume in case of interruption without replaying half a
+transaction (see Checkpointer for recording the position less often).
+Of a transaction that was rolled back, only the changes MySQL kept are
+applied (see nontransactional_changes).
+If compaction is enabled, committed transactions are first gathered in
+a CompactionWindow and only their net effect is applied. The actual
+work is done by the applier from get_applier, which may spread row
+changes over several MemSQL connections. If a pipeline depth is given,
+the binlog is read and decoded ahead in a Pipeline, and with a spool
+directory, it is first written to a Spool and read back from there.
+The replication lag is tracked in a ReplicationLag, and heartbeats
+from an idle master flush what is due by time (see ApplyTarget.idle).
+`args' is used to get the apply settings (see get_apply_settings).
+Upon receiving a SIGINT, it closes the stream and unoccupies the
+database.
 
     """
 
+    settings = get_apply_settings(args)
+    if (args.checkpoint_events or args.checkpoint_ms) and settings['apply_mode'] != 'upsert':
+        logging.warning('Checkpoints are throttled without --apply-mode=upsert, '
+                        'so a crash may apply some changes twice')
+    targets = OrderedDict(
+        (database, ApplyTarget(memsql_conn, stream, database_args(args, database), settings))
+        for database, memsql_conn in memsql_conns.items())
+    # Position after the last commit read, which every database is
+    # caught up to once its target is finished
+    last_commit = [None]
+
+    def lag_timestamps():
+        # The oldest change any database still has to commit, and the
+        # newest one committed
+        timestamps = [target.lag_timestamps() for target in targets.values()]
+        pending = [oldest for oldest, newest in timestamps if oldest is not None]
+        committed = [newest for oldest, newest in timestamps if newest is not None]
+        return (min(pending) if pending else None, max(committed) if committed else None)
+    lag = ReplicationLag(lag_timestamps, args.heartbeat_period)
+
+    def checkpointed():
+        # A restart resumes from the earliest position recorded
+        if spool is not None:
+            spool.checkpointed(min(target.checkpointer.recorded_pos
+                                   for target in targets.values()))
+
+    def finish():
+        lag.close()
+        for target in targets.values():
+            wrap_execution(target.finish, [last_commit[0]])
+            target.close()
+
     # Tries to close the stream and unoccupy the database upon getting
     # SIGTERM, SIGABRT, or SIGINT. On SIGINT, it won't exit the
-    # program, but on SIGTERM and SIGABRT it will.
+    # program, but on SIGTERM and SIGABRT it will. Either way, the
+    # position of the last committed transaction is recorded first.
 
     def signal_handler(signum, frame):
         logging.debug('killed')
-        close_connections(memsql_conn, stream)
+        finish()
+        close_connections(memsql_conns, stream)
         sys.exit(1)
     signal.signal(signal.SIGTERM, signal_handler)
     signal.signal(signal.SIGABRT, signal_handler)
 
+    binlogevents = stream
+    spool = None
+    if args.spool_dir:
+        binlogevents = spool = Spool(stream, args.spool_dir, args.spool_segment_bytes,
+                             args.spool_compress_level, args.spool_retention_bytes,
+                             args.spool_retention_seconds)
+    if args.pipeline_depth > 0:
+        binlogevents = Pipeline(binlogevents, args.pipeline_depth)
+
     try:
         logging.debug('listening')
+        # Events between a BEGIN and its commit, by database. Row events
+        # are always logged inside a transaction, so they are buffered
+        # even if the BEGIN was filtered out
+        transaction = OrderedDict()
+        in_transaction = False
         # Reads the binlog and executes the retrieved queries in MemSQL
-        for binlogevent in stream:
-            queries = process_binlogevent(binlogevent)
-            # Runs the queries in MemSQL. It wraps the query
-            # executions itself, so that they don't raise out of the
-            # scope of this function in case of an exception
-            for q in queries:
-                wrap_execution(memsql_conn.execute, [q[0]] + q[1], memsql_conn, stream)
-            wrap_execution(record_stream_binlog_pos, [memsql_conn, stream], memsql_conn, stream)
+        for binlogevent in binlogevents:
+            lag.received(isinstance(binlogevent, HeartbeatLogEvent))
+            if is_transaction_start(binlogevent):
+                in_transaction = True
+            elif is_transaction_end(binlogevent) or is_transaction_rollback(binlogevent):
+                if is_transaction_rollback(binlogevent):
+                    # Only the changes MySQL couldn't roll back remain
+                    transaction = nontransactional_changes(args, transaction)
+                # Each database applies its share of the transaction on
+                # its own. Databases it didn't touch have nothing to
+                # apply, so they don't cost a round trip
+                log_pos = event_binlog_pos(binlogevent)
+                for database, database_events in transaction.items():
+                    targets[database].commit(database_events, log_pos, binlogevent.timestamp)
+                last_commit[0] = log_pos
+                checkpointed()
+                transaction = OrderedDict()
+                in_transaction = False
+            elif isinstance(binlogevent, HeartbeatLogEvent):
+                for target in targets.values():
+                    target.idle()
+                checkpointed()
+            elif in_transaction or isinstance(binlogevent, RowsEvent):
+                transaction.setdefault(binlogevent.schema, []).append(binlogevent)
+            else:
+                # Runs the queries in MemSQL. It wraps the query
+                # executions itself, so that they don't raise out of the
+                # scope of this function in case of an exception
+                targets[binlogevent.schema].apply_ddl(binlogevent)
+                checkpointed()
 
         # If blocking on the stream is False, the above for loop will
         # exit, and the function will return WITHOUT closing the
-        # stream or memsql_conn
+        # stream or memsql_conns
+        lag.close()
+        for target in targets.values():
+            target.flush_window()
+            wrap_execution(target.finish, [last_commit[0]], memsql_conns, stream)
+            target.close()
+        if spool is not None:
+            spool.close()
 
     except KeyboardInterrupt:
-        close_connections(memsql_conn, stream)
+        finish()
+        close_connections(memsql_conns, stream)
 
 def check_equality(args, memsql_conn):
     """Creates a connection to MySQL and checks that the specified
@@ -126,7 +463,8 @@ def check_equality(args, memsql_conn):
     # All the tables matched
     return True
 
-def close_connections(memsql_conn, stream):
-    """Closes the stream and removes the ditto lock"""
+def close_connections(memsql_conns, stream):
+    """Closes the stream and removes the ditto lock of every database"""
     stream.close()
-    unoccupy_ditto_info(memsql_conn)
+    for memsql_conn in memsql_conns.values():
+        unoccupy_ditto_info(memsql_conn)
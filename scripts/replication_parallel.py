@@ -0,0 +1,385 @@
+# Copyright 2013 MemSQL, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use
+# this file except in compliance with the License.  You may obtain a copy of the
+# License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations under the License.
+
+# Applying row changes and transactions on several MemSQL connections in
+# parallel
+
+from replication_utils import *
+import threading
+import Queue
+import collections
+import logging
+
+import MySQLdb
+
+# Batches of queries a lane can have waiting before the reader blocks
+LANE_QUEUE_SIZE = 64
+
+class ApplyLane(threading.Thread):
+    """A worker thread with its own MemSQL connection. Every item put on
+    its queue is an iterable of queries, run in a MemSQL transaction of
+    its own. Errors are logged and skipped like wrap_execution does, but
+    a fatal one is kept in `error' for the main thread to re-raise, and
+    everything queued after it is dropped. Several lanes can share a
+    `queue'. If `on_applied' is given, it is called with every item once
+    it was committed; it isn't for items that failed or were dropped.
+    Items are counted as they are put with `put' and once committed.
+
+    """
+
+    def __init__(self, memsql_settings, queue=None, on_applied=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.queue = queue or Queue.Queue(LANE_QUEUE_SIZE)
+        self.on_applied = on_applied
+        self.error = None
+        self.queued = 0
+        self.applied = 0
+        self.memsql_conn = memsql_database.Connection(**memsql_settings)
+        self.memsql_conn.set_print_queries(True)
+        self.memsql_conn.set_print_function(logging.debug)
+
+    def run(self):
+        while True:
+            queries = self.queue.get()
+            try:
+                if queries is None:
+                    self.memsql_conn.close()
+                    return
+                if self.error is None:
+                    self.apply(queries)
+                    self.applied += 1
+                    if self.on_applied is not None:
+                        self.on_applied(queries)
+            except:
+                self.error = sys.exc_info()
+            finally:
+                self.queue.task_done()
+
+    def put(self, queries):
+        self.queued += 1
+        self.queue.put(queries)
+
+    def apply(self, queries):
+        self.execute('BEGIN')
+        for q in queries:
+            self.execute(q[0], *q[1])
+        self.execute('COMMIT')
+
+    def execute(self, query, *parameters):
+        try:
+            self.memsql_conn.execute(query, *parameters)
+        except MySQLdb.DatabaseError as e:
+            logging.error(e)
+            if e[0] in FATAL_ERROR_CODES:
+                raise
+
+class LaneApplier(object):
+    """Spreads row changes over `lanes' ApplyLanes, routed by table or,
+    if `route_by_key' is set, by table and primary key, so that changes
+    to the same rows always go through the same lane and stay in order.
+    Each source transaction becomes one MemSQL transaction per lane it
+    touches.
+
+    Anything whose order relative to other lanes matters goes through a
+    barrier, which waits for every lane to drain: DDL, statements logged
+    inside transactions, updates that change a row's key (their old and
+    new keys may belong to different lanes) and recording the binlog
+    position, which is only done once everything before it was applied.
+    Statements and key-changing updates then run alone, in a MemSQL
+    transaction of their own on the first lane, while DDL and recording
+    the position run on the main connection of `serial', a SerialApplier.
+
+    A source transaction is committed once every lane committed what it
+    was given up to it, see committed_pos.
+
+    """
+
+    def __init__(self, serial, memsql_settings, lanes, route_by_key):
+        self.serial = serial
+        self.settings = serial.settings
+        self.checkpointer = serial.checkpointer
+        self.route_by_key = route_by_key
+        self.lanes = [ApplyLane(memsql_settings) for i in range(lanes)]
+        for lane in self.lanes:
+            lane.start()
+        # Position after each transaction, window or DDL handed over and
+        # not known to be committed yet, with how many items each lane
+        # was given by then
+        self.handed = collections.deque()
+        self.applied_pos = None
+
+    def lane_for(self, table, key=None):
+        return self.lanes[hash((table, key)) % len(self.lanes)]
+
+    def barrier(self):
+        """Waits until every lane applied everything it was given, then
+        re-raises the error of a lane that failed"""
+        for lane in self.lanes:
+            lane.queue.join()
+        for lane in self.lanes:
+            if lane.error is not None:
+                error, lane.error = lane.error, None
+                raise error[0], error[1], error[2]
+
+    def submit(self, work):
+        """Hands each lane in `work' (a dict of lane to row events) its
+        share of the transaction"""
+        for lane, binlogevents in work.items():
+            lane.put(process_binlogevents(binlogevents, self.settings))
+        work.clear()
+
+    def apply_transaction(self, binlogevents, log_pos):
+        work = OrderedDict()
+        for binlogevent in binlogevents:
+            if not isinstance(binlogevent, RowsEvent):
+                # A statement may touch anything
+                self.submit(work)
+                self.barrier()
+                self.lanes[0].put(process_binlogevent(binlogevent, self.settings))
+                self.barrier()
+            elif not self.route_by_key or not binlogevent.primary_key:
+                work.setdefault(self.lane_for(binlogevent.table), []).append(binlogevent)
+            else:
+                self.route_rows(work, binlogevent)
+        self.submit(work)
+        self.checkpoint(len(binlogevents), log_pos)
+
+    def route_rows(self, work, binlogevent):
+        """Splits the rows of `binlogevent' by the lane of their key"""
+        positions = key_positions(binlogevent)
+        rows = OrderedDict()
+
+        def add_rows():
+            for lane, lane_rows in rows.items():
+                work.setdefault(lane, []).append(binlogevent.copy_with_rows(lane_rows))
+            rows.clear()
+
+        for row in binlogevent.iter_rows():
+            if isinstance(binlogevent, UpdateRowsEvent):
+                key = key_of(positions, row[0])
+                if key != key_of(positions, row[1]):
+                    add_rows()
+                    self.submit(work)
+                    self.barrier()
+                    self.lanes[0].put(process_binlogevent(
+                        binlogevent.copy_with_rows([row]), self.settings))
+                    self.barrier()
+                    continue
+            else:
+                key = key_of(positions, row)
+            rows.setdefault(self.lane_for(binlogevent.table, key), []).append(row)
+        add_rows()
+
+    def apply_window(self, window):
+        if self.route_by_key:
+            # Earlier changes to a table may still be spread over lanes
+            self.barrier()
+        # The queries are built here, as the window is cleared once it is
+        # handed over, before the lanes get to it
+        for table, queries in window.table_queries(self.settings):
+            self.lane_for(table).put(list(queries))
+        if self.route_by_key:
+            # And later ones will be spread again
+            self.barrier()
+        self.checkpoint(len(window), window.log_pos)
+
+    def apply_ddl(self, binlogevent):
+        self.barrier()
+        self.serial.apply_ddl(binlogevent)
+        self.handed.append((event_binlog_pos(binlogevent), [0] * len(self.lanes)))
+
+    def checkpoint(self, events, log_pos):
+        self.handed.append((log_pos, [lane.queued for lane in self.lanes]))
+        if self.checkpointer.is_due(events):
+            self.barrier()
+            self.serial.checkpoint(events, log_pos)
+        else:
+            self.checkpointer.committed(events, log_pos, False)
+
+    def committed_pos(self):
+        """Returns the position after the last transaction, window or DDL
+        whose changes every lane committed, along with everything before
+        it. Only the thread measuring the lag calls it"""
+        while self.handed and all(lane.applied >= queued for lane, queued
+                                  in zip(self.lanes, self.handed[0][1])):
+            self.applied_pos = self.handed.popleft()[0]
+        return self.applied_pos
+
+    def finish(self):
+        self.barrier()
+        self.serial.finish()
+
+    def close(self):
+        for lane in self.lanes:
+            lane.queue.put(None)
+
+def writeset(binlogevents):
+    """Returns the set of rows written by a source transaction, as
+    (table, key) pairs taken from the before and after images of its row
+    events. Rows of a table without a primary key can't be told apart,
+    so the whole table is taken as (table,). Returns None if the
+    transaction holds statements, which may write anything"""
+    rows = set()
+    for binlogevent in binlogevents:
+        if not isinstance(binlogevent, RowsEvent):
+            return None
+        if not binlogevent.primary_key:
+            rows.add((binlogevent.table,))
+            continue
+        positions = key_positions(binlogevent)
+        for row in binlogevent.rows:
+            # Update rows are (before, after) pairs of images
+            for values in (row if isinstance(binlogevent, UpdateRowsEvent) else (row,)):
+                rows.add((binlogevent.table, key_of(positions, values)))
+    return rows
+
+class ScheduledTransaction(object):
+    """A source transaction handed to a WritesetApplier worker"""
+
+    def __init__(self, queries, writeset, events, log_pos):
+        self.queries = queries
+        self.writeset = writeset
+        self.events = events
+        self.log_pos = log_pos
+        self.applied = False
+
+    def __iter__(self):
+        return iter(self.queries)
+
+class WritesetApplier(object):
+    """Applies whole source transactions on `workers' ApplyLanes at once,
+    as long as their write sets (see writeset) don't overlap. A
+    transaction waits for every running transaction it shares a row
+    with, so conflicting transactions still apply in binlog order, each
+    in one MemSQL transaction.
+
+    Transactions may commit out of order, so the position recorded in
+    ditto_info is the low watermark: the position after the last
+    transaction that was applied together with everything before it.
+    Transactions holding statements, compaction windows and DDL wait for
+    every worker and then run on the main connection of `serial', a
+    SerialApplier, so they are committed once `serial' says so.
+
+    """
+
+    def __init__(self, serial, memsql_settings, workers):
+        self.serial = serial
+        self.settings = serial.settings
+        self.checkpointer = serial.checkpointer
+        self.condition = threading.Condition()
+        # (table, key) -> running transaction writing that row
+        self.writing = {}
+        # Transactions handed to the workers and not yet below the low
+        # watermark, in binlog order
+        self.scheduled = collections.deque()
+        # Position of the low watermark
+        self.applied_pos = None
+        self.queue = Queue.Queue(LANE_QUEUE_SIZE)
+        self.workers = [ApplyLane(memsql_settings, self.queue, self.applied)
+                        for i in range(workers)]
+        for worker in self.workers:
+            worker.start()
+
+    def applied(self, transaction):
+        """Called by the workers once they committed `transaction'"""
+        with self.condition:
+            for row in transaction.writeset:
+                del self.writing[row]
+            transaction.applied = True
+            self.condition.notify_all()
+
+    def committed_pos(self):
+        """Returns the position after the last transaction committed
+        along with everything before it: the low watermark, as far as the
+        workers got even if it wasn't moved yet"""
+        log_pos = None
+        with self.condition:
+            for transaction in self.scheduled:
+                if not transaction.applied:
+                    break
+                log_pos = transaction.log_pos
+        return max(self.serial.committed_pos(), self.applied_pos, log_pos)
+
+    def raise_error(self):
+        for worker in self.workers:
+            if worker.error is not None:
+                error, worker.error = worker.error, None
+                raise error[0], error[1], error[2]
+
+    def barrier(self):
+        """Waits until the workers applied everything they were given,
+        then re-raises the error of a worker that failed"""
+        self.queue.join()
+        self.raise_error()
+        self.advance()
+
+    def advance(self):
+        """Moves the low watermark past every transaction applied along
+        with everything before it, checkpointing it if it is due. A
+        worker's error is re-raised first: the transaction that failed
+        never becomes applied, but neither may anything be recorded
+        while the error is pending"""
+        self.raise_error()
+        events = 0
+        log_pos = None
+        with self.condition:
+            while self.scheduled and self.scheduled[0].applied:
+                transaction = self.scheduled.popleft()
+                events += transaction.events
+                log_pos = transaction.log_pos
+        if log_pos is None:
+            return
+        self.applied_pos = log_pos
+        if self.checkpointer.is_due(events):
+            self.serial.checkpoint(events, log_pos)
+        else:
+            self.checkpointer.committed(events, log_pos, False)
+
+    def apply_transaction(self, binlogevents, log_pos):
+        rows = writeset(binlogevents)
+        if rows is None:
+            self.barrier()
+            self.serial.apply_transaction(binlogevents, log_pos)
+            return
+        transaction = ScheduledTransaction(
+            process_binlogevents(binlogevents, self.settings), rows,
+            len(binlogevents), log_pos)
+        with self.condition:
+            while any(row in self.writing for row in rows):
+                # A transaction that failed keeps its rows, so the
+                # workers' errors are checked while waiting
+                self.condition.wait(1)
+                self.raise_error()
+            for row in rows:
+                self.writing[row] = transaction
+            self.scheduled.append(transaction)
+        self.raise_error()
+        self.queue.put(transaction)
+        self.advance()
+
+    def apply_window(self, window):
+        self.barrier()
+        self.serial.apply_window(window)
+
+    def apply_ddl(self, binlogevent):
+        self.barrier()
+        self.serial.apply_ddl(binlogevent)
+
+    def finish(self):
+        self.barrier()
+        self.serial.finish()
+
+    def close(self):
+        for worker in self.workers:
+            self.queue.put(None)
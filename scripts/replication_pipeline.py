@@ -0,0 +1,107 @@
+# Copyright 2013 MemSQL, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use
+# this file except in compliance with the License.  You may obtain a copy of the
+# License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations under the License.
+
+# Reading and decoding the binlog in threads of their own
+
+from replication_utils import *
+import threading
+import Queue
+import logging
+import time
+
+# Seconds between two reports of the pipeline queue occupancy
+PIPELINE_REPORT_SECONDS = 10
+
+class StageError(object):
+    """Carries an exception from a pipeline stage to the next one"""
+
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+class Pipeline(object):
+    """Iterates over the events of a BinLogStreamReader like the stream
+    itself, but reads and decodes them ahead of the consumer:
+
+    * a reader thread reads raw packets off the network (or a Spool) into
+      `packets'
+    * a decoder thread turns them into events, decoding the rows of row
+      events, into `events'
+    * the consumer (binlog_listen) applies them
+
+    Both queues hold at most `depth' items, so a slow stage holds the
+    ones before it back. Their occupancy is logged every
+    PIPELINE_REPORT_SECONDS: a full `packets' queue means decoding is the
+    bottleneck, a full `events' queue means applying is, and two empty
+    ones mean ditto is waiting on MySQL.
+
+    """
+
+    def __init__(self, stream, depth):
+        self.stream = stream
+        self.packets = Queue.Queue(depth)
+        self.events = Queue.Queue(depth)
+        self.last_report = time.time()
+        for target in (self.read, self.decode):
+            thread = threading.Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def read(self):
+        try:
+            while True:
+                pkt = self.stream.read_packet()
+                self.packets.put(pkt)
+                if pkt is None:
+                    return
+        except:
+            self.packets.put(StageError(sys.exc_info()))
+
+    def decode(self):
+        try:
+            while True:
+                pkt = self.packets.get()
+                if pkt is None or isinstance(pkt, StageError):
+                    self.events.put(pkt)
+                    return
+                binlogevent = self.stream.decode_packet(pkt)
+                if binlogevent is None:
+                    continue
+                # Rows sent to a RowDecoderPool are decoded there
+                if isinstance(binlogevent, RowsEvent) and self.stream.row_decoder_pool is None:
+                    binlogevent.rows
+                self.events.put(binlogevent)
+        except:
+            self.events.put(StageError(sys.exc_info()))
+
+    def occupancy(self):
+        """Returns the number of items in each queue and its capacity"""
+        return OrderedDict([('packets', (self.packets.qsize(), self.packets.maxsize)),
+                            ('events', (self.events.qsize(), self.events.maxsize))])
+
+    def report(self):
+        if time.time() - self.last_report >= PIPELINE_REPORT_SECONDS:
+            self.last_report = time.time()
+            logging.info('Pipeline queues: ' + ', '.join(
+                    '%s %d/%d' % (name, used, size)
+                    for name, (used, size) in self.occupancy().items()))
+
+    def __iter__(self):
+        while True:
+            binlogevent = self.events.get()
+            if binlogevent is None:
+                return
+            if isinstance(binlogevent, StageError):
+                error = binlogevent.exc_info
+                raise error[0], error[1], error[2]
+            self.report()
+            yield binlogevent
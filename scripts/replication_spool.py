@@ -0,0 +1,387 @@
+# Copyright 2013 MemSQL, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use
+# this file except in compliance with the License.  You may obtain a copy of the
+# License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations under the License.
+
+# Spooling the binlog to local disk ahead of applying it
+
+from replication_utils import *
+from replication_pipeline import StageError
+from pymysqlreplication.packet import StringPacket
+from pymysqlreplication.constants.BINLOG import ROTATE_EVENT, HEARTBEAT_LOG_EVENT
+import threading
+import struct
+import gzip
+import io
+import logging
+import time
+
+# Segment files, numbered in binlog order. Sealed segments may be gzipped
+SEGMENT_NAME = '%08d.spool'
+COMPRESSED_SUFFIX = '.gz'
+# A segment starts with the binlog position of its first record (and the
+# length of the file name, which follows), then holds records made of
+# the length of a packet and the packet
+SEGMENT_HEADER = struct.Struct('<QH')
+RECORD_LENGTH = struct.Struct('<I')
+# Seconds between checks for segments past their retention
+EXPIRE_SECONDS = 1
+
+class SpoolPacket(StringPacket):
+    """A packet read back from the spool"""
+
+    def is_ok_packet(self):
+        return True
+
+def next_binlog_pos(data, log_pos):
+    """Returns the binlog position after the event in the packet `data',
+    given the one before it, the way the stream tracks it
+
+    """
+    event_type = ord(data[5])
+    if event_type == ROTATE_EVENT:
+        event_end = 1 + struct.unpack_from('<I', data, 10)[0]
+        return (data[28:event_end], struct.unpack_from('<Q', data, 20)[0])
+    next_pos = struct.unpack_from('<I', data, 14)[0]
+    # Fake events sent on connect carry 0
+    if next_pos > 0:
+        return (log_pos[0], next_pos)
+    return log_pos
+
+class Spool(object):
+    """Sits between a BinLogStreamReader and whatever applies its events,
+    like the stream itself. A writer thread appends every packet read off
+    the network to segment files in `directory', as fast as the master
+    sends them, and read_packet reads them back in order, however far
+    behind. A slow or unavailable MemSQL then doesn't hold back reading
+    the binlog, so the master can purge its logs without losing events
+    ditto still has to apply.
+
+    Segments are sealed once they reach `segment_bytes' and, if
+    `compress_level' isn't 0, gzipped. Segments whose every event is
+    before the position passed to checkpointed are kept until the spool
+    grows past `retention_bytes' or they get older than
+    `retention_seconds' (0 meaning no limit), so that a restarted ditto
+    can resume from its recorded position out of the spool (see resume).
+    Segments holding anything past that position, read or not, are never
+    deleted, as a restart would still need them. A thread of its own
+    checks for segments to delete every EXPIRE_SECONDS.
+
+    Heartbeats aren't spooled: the latest one is handed over once every
+    spooled packet was read, so that they still tell an idle master.
+
+    """
+
+    def __init__(self, stream, directory, segment_bytes, compress_level,
+                 retention_bytes, retention_seconds):
+        self.stream = stream
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.compress_level = compress_level
+        self.retention_bytes = retention_bytes
+        self.retention_seconds = retention_seconds
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.__changed = threading.Condition()
+        # Segment and offset after the last whole record written
+        self.__end = None
+        self.__finished = False
+        self.__error = None
+        self.__heartbeat = None
+        self.__segment = None
+        self.__segment_number = None
+        # Binlog position after the last record written
+        self.__write_pos = None
+        self.__read_file = None
+        self.__read_number = None
+        self.__read_offset = None
+        # Binlog position recorded as applied, see checkpointed
+        self.__checkpoint_pos = None
+        self.__closed = threading.Event()
+
+        start = (stream.log_file, stream.log_pos)
+        (log_file, log_pos) = self.resume(start)
+        stream.connect_to_stream(custom_log_pos = log_pos, custom_log_file = log_file)
+        # The stream connection picks up after the spool, decoding where
+        # reading it resumes
+        (stream.log_file, stream.log_pos) = start
+        thread = threading.Thread(target=self.write)
+        thread.daemon = True
+        thread.start()
+        self.__expire_thread = threading.Thread(target=self.expire_periodically)
+        self.__expire_thread.daemon = True
+        self.__expire_thread.start()
+
+    def __getattr__(self, key):
+        # Anything else (decode_packet, row_decoder_pool...) is the stream's
+        return getattr(self.stream, key)
+
+    def segment_numbers(self):
+        """Returns the numbers of the segments in the spool, in order"""
+        numbers = set()
+        for name in os.listdir(self.directory):
+            if name.endswith(COMPRESSED_SUFFIX):
+                name = name[:-len(COMPRESSED_SUFFIX)]
+            if name.endswith('.spool') and name[:-len('.spool')].isdigit():
+                numbers.add(int(name[:-len('.spool')]))
+        return sorted(numbers)
+
+    def segment_path(self, number):
+        """Returns the path of a segment, gzipped or not"""
+        path = os.path.join(self.directory, SEGMENT_NAME % number)
+        if os.path.exists(path):
+            return path
+        return path + COMPRESSED_SUFFIX
+
+    def open_segment(self, number):
+        """Opens a segment for reading, past its header. Returns the file
+        and the binlog position of its first record"""
+        path = self.segment_path(number)
+        if path.endswith(COMPRESSED_SUFFIX):
+            segment = gzip.open(path, 'rb')
+        else:
+            # Unlike file objects, io doesn't stop at an end of file
+            # that the writer has since moved
+            segment = io.open(path, 'rb')
+        log_pos, name_length = SEGMENT_HEADER.unpack(segment.read(SEGMENT_HEADER.size))
+        return segment, (segment.read(name_length), log_pos)
+
+    def segment_start(self, number):
+        """Returns the binlog position of the first record of a segment,
+        reading only its header"""
+        segment, log_pos = self.open_segment(number)
+        segment.close()
+        return log_pos
+
+    def records(self, number):
+        """Yields the offset in a segment of each of its records, the
+        packet it holds and the binlog position after it"""
+        segment, log_pos = self.open_segment(number)
+        offset = SEGMENT_HEADER.size + len(log_pos[0])
+        try:
+            data = self.read_record(segment)
+            while data is not None:
+                log_pos = next_binlog_pos(data, log_pos)
+                yield offset, data, log_pos
+                offset += RECORD_LENGTH.size + len(data)
+                data = self.read_record(segment)
+        finally:
+            segment.close()
+
+    def read_record(self, segment):
+        """Returns the next packet in a segment file, or None at its end.
+        A record cut short by a crash ends the segment"""
+        length = segment.read(RECORD_LENGTH.size)
+        if len(length) < RECORD_LENGTH.size:
+            return None
+        data = segment.read(RECORD_LENGTH.unpack(length)[0])
+        if len(data) < RECORD_LENGTH.unpack(length)[0]:
+            return None
+        return data
+
+    def resume(self, start):
+        """Sets reading up to resume at the binlog position `start' and
+        returns the position the stream has to continue from to fill the
+        spool: its end if `start' is in it, `start' otherwise, in which
+        case the spool is emptied first. Besides the segment headers, only
+        the segment holding `start' and the last one are read through
+
+        """
+        numbers = self.segment_numbers()
+        starts = [self.segment_start(number) for number in numbers]
+        # Segment and offset of the first record past `start'
+        found = None
+        log_pos = None
+        if numbers and starts[0] <= start:
+            # The last segment starting at or before `start' holds it,
+            # unless it ends there, in which case the next one starts with
+            # the first record past it
+            index = max(i for i, segment_pos in enumerate(starts) if segment_pos <= start)
+            for offset, data, log_pos in self.records(numbers[index]):
+                if log_pos > start:
+                    found = (numbers[index], offset)
+                    break
+            if found is None and index + 1 < len(numbers):
+                found = (numbers[index + 1], SEGMENT_HEADER.size + len(starts[index + 1][0]))
+            # The spool ends with the last whole record of its last segment
+            log_pos = starts[-1]
+            for offset, data, log_pos in self.records(numbers[-1]):
+                pass
+        if log_pos is None or start > log_pos:
+            if numbers:
+                logging.info('The spool does not hold binlog position %s:%d, emptying it' % start)
+            for number in numbers:
+                os.remove(self.segment_path(number))
+            numbers = []
+            found = None
+            log_pos = start
+        self.open_write_segment(numbers[-1] + 1 if numbers else 1, log_pos)
+        if found is None:
+            # Nothing to read before what the stream brings
+            found = self.__end
+        else:
+            logging.info('Resuming from the spool at binlog position %s:%d' % start)
+        (self.__read_number, self.__read_offset) = found
+        (self.__read_file, _) = self.open_segment(self.__read_number)
+        self.__read_file.seek(self.__read_offset)
+        return log_pos
+
+    def open_write_segment(self, number, log_pos):
+        """Starts a new segment whose first record will follow `log_pos'"""
+        path = os.path.join(self.directory, SEGMENT_NAME % number)
+        self.__segment = open(path, 'wb')
+        self.__segment.write(SEGMENT_HEADER.pack(log_pos[1], len(log_pos[0])) + log_pos[0])
+        self.__segment.flush()
+        self.__segment_number = number
+        self.__write_pos = log_pos
+        with self.__changed:
+            self.__end = (number, self.__segment.tell())
+            self.__changed.notify()
+
+    def seal_segment(self):
+        """Closes the segment being written and compresses it. The
+        compressed file shows up before the plain one goes, so a reader
+        opening the segment always finds one of them, and one that was
+        opening it already keeps reading the plain one"""
+        self.__segment.close()
+        path = os.path.join(self.directory, SEGMENT_NAME % self.__segment_number)
+        if self.compress_level:
+            with open(path, 'rb') as plain:
+                compressed = gzip.open(path + COMPRESSED_SUFFIX + '.tmp', 'wb', self.compress_level)
+                while True:
+                    chunk = plain.read(1 << 20)
+                    if not chunk:
+                        break
+                    compressed.write(chunk)
+                compressed.close()
+            os.rename(path + COMPRESSED_SUFFIX + '.tmp', path + COMPRESSED_SUFFIX)
+            os.remove(path)
+
+    def checkpointed(self, log_pos):
+        """Tells the spool that everything before the binlog position
+        `log_pos' was applied and recorded, so a restart won't resume
+        before it"""
+        with self.__changed:
+            self.__checkpoint_pos = max(self.__checkpoint_pos, log_pos)
+
+    def expire(self):
+        """Deletes the oldest segments that only hold events before the
+        checkpointed position, while the spool is larger than
+        retention_bytes or they are older than retention_seconds"""
+        with self.__changed:
+            read_number = self.__read_number
+            checkpoint_pos = self.__checkpoint_pos
+        numbers = self.segment_numbers()
+        segments = [(number, os.stat(self.segment_path(number))) for number in numbers]
+        total = sum(stat.st_size for number, stat in segments)
+        for (number, stat), next_number in zip(segments, numbers[1:]):
+            if number >= read_number or checkpoint_pos is None:
+                break
+            # A segment ends where the next one starts
+            if self.segment_start(next_number) > checkpoint_pos:
+                break
+            too_large = self.retention_bytes and total > self.retention_bytes
+            too_old = self.retention_seconds and \
+                time.time() - stat.st_mtime > self.retention_seconds
+            if not (too_large or too_old):
+                break
+            os.remove(self.segment_path(number))
+            total -= stat.st_size
+
+    def expire_periodically(self):
+        try:
+            while not self.__closed.wait(EXPIRE_SECONDS):
+                self.expire()
+        except:
+            with self.__changed:
+                self.__error = StageError(sys.exc_info())
+                self.__changed.notify()
+
+    def write(self):
+        try:
+            while True:
+                pkt = self.stream.read_packet()
+                if pkt is None:
+                    with self.__changed:
+                        self.__finished = True
+                        self.__changed.notify()
+                    return
+                data = pkt.get_all_data()
+                if ord(data[5]) == HEARTBEAT_LOG_EVENT:
+                    with self.__changed:
+                        self.__heartbeat = pkt
+                        self.__changed.notify()
+                    continue
+                self.__segment.write(RECORD_LENGTH.pack(len(data)) + data)
+                self.__segment.flush()
+                self.__write_pos = next_binlog_pos(data, self.__write_pos)
+                with self.__changed:
+                    self.__end = (self.__segment_number, self.__segment.tell())
+                    self.__changed.notify()
+                if self.__segment.tell() >= self.segment_bytes:
+                    self.seal_segment()
+                    self.open_write_segment(self.__segment_number + 1, self.__write_pos)
+        except:
+            with self.__changed:
+                self.__error = StageError(sys.exc_info())
+                self.__changed.notify()
+
+    def read_packet(self):
+        """Reads the next packet off the spool, waiting for the writer if
+        it is caught up. Returns None at the end of the stream, once
+        every packet was read"""
+        while True:
+            with self.__changed:
+                while (self.__read_number, self.__read_offset) >= self.__end and \
+                        self.__heartbeat is None and not self.__finished and self.__error is None:
+                    # Timed, so that a KeyboardInterrupt gets through
+                    self.__changed.wait(1)
+                if (self.__read_number, self.__read_offset) < self.__end:
+                    pass
+                elif self.__heartbeat is not None:
+                    pkt = self.__heartbeat
+                    self.__heartbeat = None
+                    return pkt
+                elif self.__error is not None:
+                    error = self.__error.exc_info
+                    raise error[0], error[1], error[2]
+                else:
+                    return None
+            data = self.read_record(self.__read_file)
+            if data is None:
+                # Past the end of a sealed segment
+                self.__read_file.close()
+                (self.__read_file, _) = self.open_segment(self.__read_number + 1)
+                with self.__changed:
+                    self.__read_number += 1
+                    self.__read_offset = self.__read_file.tell()
+                continue
+            with self.__changed:
+                self.__read_offset += RECORD_LENGTH.size + len(data)
+            return SpoolPacket(data)
+
+    def fetchone(self):
+        while True:
+            pkt = self.read_packet()
+            if pkt is None:
+                return None
+            binlogevent = self.stream.decode_packet(pkt)
+            if binlogevent is not None:
+                return binlogevent
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def close(self):
+        self.__closed.set()
+        self.__expire_thread.join()
+        self.__segment.close()
+        self.__read_file.close()
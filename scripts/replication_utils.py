@@ -18,15 +18,20 @@ import MySQLdb.converters
 import memsql_database
 
 from pymysqlreplication import BinLogStreamReader
+from pymysqlreplication.decoder import RowDecoderPool
 from pymysqlreplication.row_event import *
 from pymysqlreplication.event import *
 
 import argparse
+import copy
 import subprocess
+from collections import OrderedDict
 import os
 import binascii
 import re
 import sys
+import threading
+import time
 import logging
 
 def fix_object(value):
@@ -42,6 +47,17 @@ def fix_object(value):
     else:
         return value
 
+def estimate_size(value):
+    """Returns an upper bound on the number of bytes the value takes up
+    once escaped into a query"""
+    if value is None:
+        return 4
+    elif isinstance(value, str):
+        # Every character could need escaping, plus the quotes
+        return 2 * len(value) + 2
+    else:
+        return len(str(value)) + 2
+
 def compare_items((k, v)):
     """Converta a column-value pair to an equality comparison (uses IS for
     NULL)
@@ -52,12 +68,42 @@ def compare_items((k, v)):
     else:
         return '`%s`=%%s'%k
 
+# MySQL error codes after which ditto gives up (so far just 'lost
+# database connection')
+FATAL_ERROR_CODES = [2006]
+
+# Used when the queries aren't generated from command line arguments
+DEFAULT_APPLY_SETTINGS = {
+    'insert_batch_rows': 1000,
+    'max_statement_size': 1024 * 1024,
+    'batch_deletes': False,
+    'delete_batch_size': 1000,
+    'update_batch_size': 1000,
+    'apply_mode': 'plain',
+}
+
+# Seconds between two reports of the replication lag
+LAG_REPORT_SECONDS = 10
+
+# Shortest run of consecutive integer keys that is deleted with a
+# BETWEEN rather than listed in an IN-list
+MIN_KEY_RANGE_LENGTH = 3
+
 def command_line_parser():
         """Returns a command line parser used for ditto scripts"""
 
         parser = argparse.ArgumentParser(
             description='Replicate a MySQL database to MemSQL')
-        parser.add_argument('database', help='Database to use')
+        parser.add_argument('databases', metavar='database', nargs='*',
+                            help='Databases to replicate, all from the same\
+                            binlog stream')
+        parser.set_defaults(database=None)
+        parser.add_argument('--include-databases', dest='include_databases', type=str,
+                            help='Also replicate every MySQL database whose name\
+                            matches this regular expression', default=None)
+        parser.add_argument('--exclude-databases', dest='exclude_databases', type=str,
+                            help="Don't replicate databases whose name matches\
+                            this regular expression", default=None)
         parser.add_argument('--host', dest='host', type=str,
                             help='Host where the MySQL database server is located',
                             default='127.0.0.1')
@@ -105,8 +151,107 @@ def command_line_parser():
                             help='Specify a file to get the mysqldump from, rather\
                             than having ditto running mysqldump itself',
                             default='')
+        parser.add_argument('--insert-batch-rows', dest='insert_batch_rows', type=int,
+                            help='Maximum number of rows coalesced into a single\
+                            multi-row INSERT', default=DEFAULT_APPLY_SETTINGS['insert_batch_rows'])
+        parser.add_argument('--max-statement-size', dest='max_statement_size', type=int,
+                            help='Maximum size in bytes of a single coalesced\
+                            statement. Should be kept below max_allowed_packet on\
+                            MemSQL', default=DEFAULT_APPLY_SETTINGS['max_statement_size'])
+        parser.add_argument('--batch-deletes', dest='batch_deletes', action='store_true',
+                            help="Delete rows of tables with a primary key in\
+                            batches, using key IN-lists and BETWEEN ranges instead\
+                            of one DELETE per row", default=False)
+        parser.add_argument('--delete-batch-size', dest='delete_batch_size', type=int,
+                            help='Maximum number of rows deleted by a single\
+                            batched DELETE', default=DEFAULT_APPLY_SETTINGS['delete_batch_size'])
+        parser.add_argument('--update-batch-size', dest='update_batch_size', type=int,
+                            help='Maximum number of rows updated by a single\
+                            UPDATE, when rows of a table get the same new values',
+                            default=DEFAULT_APPLY_SETTINGS['update_batch_size'])
+        parser.add_argument('--apply-mode', dest='apply_mode', type=str,
+                            choices=['plain', 'upsert'], help="How row changes\
+                            are applied to tables with a primary key. 'upsert'\
+                            turns inserts and updates into INSERT ... ON DUPLICATE\
+                            KEY UPDATE, so that replaying a range of the binlog\
+                            twice is harmless", default=DEFAULT_APPLY_SETTINGS['apply_mode'])
+        parser.add_argument('--checkpoint-events', dest='checkpoint_events', type=int,
+                            help='Only record the binlog position in ditto_info\
+                            once at least this many events were applied since the\
+                            last time. 0 means no event limit', default=0)
+        parser.add_argument('--checkpoint-ms', dest='checkpoint_ms', type=int,
+                            help='Only record the binlog position in ditto_info\
+                            once at least this many milliseconds passed since the\
+                            last time. 0 means no time limit. If neither limit is\
+                            set, the position is recorded with every transaction',
+                            default=0)
+        parser.add_argument('--parallel-lanes', dest='parallel_lanes', type=int,
+                            help='Number of MemSQL connections row changes are\
+                            applied on in parallel. DDL and checkpoints wait for\
+                            all of them', default=1)
+        parser.add_argument('--lane-routing', dest='lane_routing', type=str,
+                            choices=['table', 'key', 'writeset'], help="How row\
+                            changes are spread over the parallel lanes: by table,\
+                            by table and primary key, or as whole transactions\
+                            that don't write the same rows", default='table')
+        parser.add_argument('--pipeline-depth', dest='pipeline_depth', type=int,
+                            help='Read and decode the binlog in threads of their\
+                            own, ahead of applying it, with queues holding up to\
+                            this many packets and events. 0 disables the\
+                            pipeline', default=0)
+        parser.add_argument('--spool-dir', dest='spool_dir', type=str,
+                            help='Spool the binlog to segment files in this\
+                            directory as fast as the master sends it, and apply\
+                            it from there, so that a slow or unavailable MemSQL\
+                            does not hold back reading it', default=None)
+        parser.add_argument('--spool-segment-bytes', dest='spool_segment_bytes', type=int,
+                            help='Size in bytes past which a spool segment is\
+                            sealed', default=64 << 20)
+        parser.add_argument('--spool-compress-level', dest='spool_compress_level', type=int,
+                            help='gzip level sealed spool segments are\
+                            compressed with. 0 disables compression', default=1)
+        parser.add_argument('--spool-retention-bytes', dest='spool_retention_bytes', type=int,
+                            help='Delete the oldest checkpointed spool segments\
+                            while the spool is larger than this many bytes. 0\
+                            means no size limit', default=1 << 30)
+        parser.add_argument('--spool-retention-seconds', dest='spool_retention_seconds', type=int,
+                            help='Delete checkpointed spool segments older than\
+                            this many seconds. 0 means no age limit. Segments\
+                            holding events past the position recorded in\
+                            ditto_info are always kept', default=86400)
+        parser.add_argument('--decode-processes', dest='decode_processes', type=int,
+                            help='Decode the rows of row events in this many\
+                            worker processes. 0 decodes them in ditto itself',
+                            default=0)
+        parser.add_argument('--schema-state-file', dest='schema_state_file', type=str,
+                            help='Save the column metadata of the replicated\
+                            tables to this file on exit, and reuse it on start if\
+                            no table was created or altered in the meantime',
+                            default=None)
+        parser.add_argument('--heartbeat-period', dest='heartbeat_period', type=float,
+                            help='Have the master send a heartbeat after this\
+                            many seconds without events, so that an idle master\
+                            can be told apart from a stalled stream. 0 disables\
+                            heartbeats', default=1)
+        parser.add_argument('--compaction-events', dest='compaction_events', type=int,
+                            help='Hold up to this many row events (from whole\
+                            transactions) and only apply the net change of each\
+                            row. 0 disables compaction', default=0)
+        parser.add_argument('--compaction-ms', dest='compaction_ms', type=int,
+                            help='Maximum time in milliseconds that row changes\
+                            are held for compaction', default=1000)
         return parser
 
+def get_apply_settings(args):
+    """Returns the settings that control how binlog events are turned
+    into queries"""
+    return {'insert_batch_rows': args.insert_batch_rows,
+            'max_statement_size': args.max_statement_size,
+            'batch_deletes': args.batch_deletes,
+            'delete_batch_size': args.delete_batch_size,
+            'update_batch_size': args.update_batch_size,
+            'apply_mode': args.apply_mode}
+
 def get_mysql_settings(args):
     return {'host':args.host, 'user':args.user, 'passwd':args.password,
             'db': args.database, 'port':args.port}
@@ -116,20 +261,60 @@ def get_memsql_settings(args):
     return {'host': args.memsql_host+':'+str(args.memsql_port), 'user': args.memsql_user,
             'database':args.database, 'password': mempassword}
 
+# Databases never picked up by --include-databases
+SYSTEM_DATABASES = ['information_schema', 'mysql', 'performance_schema']
+
+def get_databases(args):
+    """Returns the databases to replicate: the ones named on the command
+    line, then every other MySQL database matching --include-databases.
+    Databases matching --exclude-databases are left out. The patterns
+    must match whole names and are compiled once, here, since the
+    resulting list is all the stream filters on.
+
+    """
+    databases = list(args.databases)
+    if args.include_databases is not None:
+        include = re.compile('(?:%s)$' % args.include_databases)
+        mysql_conn = memsql_database.Connection(
+            host=args.host+':'+str(args.port), user=args.user,
+            password=args.password, database='information_schema')
+        for row in mysql_conn.query('SHOW DATABASES'):
+            database = row['Database']
+            if database not in databases and database not in SYSTEM_DATABASES \
+                    and include.match(database):
+                databases.append(database)
+        mysql_conn.close()
+    if args.exclude_databases is not None:
+        exclude = re.compile('(?:%s)$' % args.exclude_databases)
+        databases = [database for database in databases if not exclude.match(database)]
+    if not databases:
+        sys.exit('No database to replicate')
+    return databases
+
+def database_args(args, database):
+    """Returns a copy of `args' for replicating just `database', as
+    expected by the functions taking the arguments of a single database"""
+    database_args = copy.copy(args)
+    database_args.database = database
+    return database_args
+
 def getbinlogpos(stream):
     return stream.log_pos
 def setbinlogpos(stream, pos):
     stream.log_pos = pos
 
-def connect_to_mysql_stream(args):
-    """Returns an iterator through the latest MySQL binlog
+def connect_to_mysql_stream(args, databases=None):
+    """Returns an iterator through the latest MySQL binlog, holding the
+    events of all the given databases (by default, get_databases)
 
     Expects that the `args' argument was obtained from the
     command_line_parser() parser (or something very similar)
 
     """
 
-    mysql_settings = get_mysql_settings(args)
+    if databases is None:
+        databases = get_databases(args)
+    mysql_settings = get_mysql_settings(database_args(args, databases[0]))
 
     ##server_id is your slave identifier. It should be unique
     ##blocking: True if you want to block and wait for the next event at the end of the stream
@@ -142,29 +327,224 @@ def connect_to_mysql_stream(args):
     if args.resume_from_end and args.resume_from_start:
         sys.exit("Cannot set both --resume_from_end and --resume_from_start")
 
+    # Started before any connection is made, since its workers are forked
+    row_decoder_pool = None
+    if args.decode_processes > 0:
+        row_decoder_pool = RowDecoderPool(args.decode_processes)
+
     stream = BinLogStreamReader(connection_settings = mysql_settings,
                                 resume_stream= args.resume_from_end,
                                 server_id = server_id,
                                 blocking = not args.no_blocking,
                                 only_events = [DeleteRowsEvent, WriteRowsEvent,
-                                               UpdateRowsEvent, QueryEvent])
+                                               UpdateRowsEvent, QueryEvent, XidEvent,
+                                               HeartbeatLogEvent],
+                                row_decoder_pool = row_decoder_pool,
+                                only_schemas = databases,
+                                schema_state_file = args.schema_state_file,
+                                heartbeat_period = args.heartbeat_period,
+                                tuple_rows = True)
+    if stream.schema_state_loaded:
+        logging.info('Reusing the table metadata saved in %s' % args.schema_state_file)
     return stream
 
-def record_stream_binlog_pos(memsql_conn, stream):
-    """Records the binlog position that the stream is currently at"""
-    log_pos = getbinlogpos(stream)
-    memsql_conn.execute('UPDATE ditto_info SET pos=%s', log_pos)
+def event_binlog_pos(binlogevent):
+    """Returns the binlog position after the event. Positions are (file,
+    pos) pairs, which compare in binlog order since binlog file names only
+    differ by their zero-padded sequence number"""
+    return (binlogevent.log_file, binlogevent.log_pos)
+def record_binlog_pos(memsql_conn, log_pos):
+    """Records the given binlog position (a (file, pos) pair)"""
+    memsql_conn.execute('UPDATE ditto_info SET file=%s, pos=%s', *log_pos)
 def record_master_binlog_pos(memsql_conn, stream):
-    """Records the binlog position that the master is currently at"""
-    (_, log_pos) = stream.get_master_binlog_pos()
-    memsql_conn.execute('UPDATE ditto_info SET pos=%s', log_pos)
+    """Records the binlog position that the master is currently at, and
+    returns it"""
+    log_pos = tuple(stream.get_master_binlog_pos())
+    record_binlog_pos(memsql_conn, log_pos)
+    return log_pos
+def get_ditto_pos(memsql_conn):
+    """Returns the binlog position recorded in ditto_info"""
+    row = memsql_conn.get('SELECT file, pos FROM ditto_info')
+    return (row['file'], int(row['pos']))
 def unoccupy_ditto_info(memsql_conn):
     """Sets the in_use value in ditto_info to 0, thereby freeing up the
     database to other ditto processes"""
+    # Throws away any partially applied transaction first, so that the
+    # lock release isn't rolled back along with it when we disconnect
+    memsql_conn.execute("ROLLBACK")
     memsql_conn.execute("UPDATE ditto_info SET in_use=0")
 
+class Checkpointer(object):
+    """Decides when the binlog position is recorded in ditto_info. The
+    position is always recorded at a commit of a source transaction, and
+    by default with every one of them. If `max_events' or `max_ms' is set,
+    it is only recorded once that many events were applied or that many
+    milliseconds passed since the last checkpoint. Everything applied
+    since then is replayed after a crash, which is only harmless in the
+    upsert apply mode.
+
+    """
+
+    def __init__(self, max_events=0, max_ms=0, recorded_pos=None):
+        self.max_events = max_events
+        self.max_ms = max_ms
+        self.events = 0
+        self.last_checkpoint = time.time()
+        # Position after the last committed transaction, if it wasn't
+        # recorded yet
+        self.pending_pos = None
+        # Last position recorded in ditto_info
+        self.recorded_pos = recorded_pos
+
+    def is_due(self, events):
+        """Returns True if the position should be recorded with a
+        transaction of `events' events"""
+        if not self.max_events and not self.max_ms:
+            return True
+        if self.max_events and self.events + events >= self.max_events:
+            return True
+        return bool(self.max_ms) and \
+            (time.time() - self.last_checkpoint) * 1000 >= self.max_ms
+
+    def committed(self, events, log_pos, recorded):
+        """Registers a committed transaction of `events' events ending at
+        `log_pos', and whether its position was recorded"""
+        if recorded:
+            self.events = 0
+            self.last_checkpoint = time.time()
+            self.pending_pos = None
+            self.recorded_pos = max(self.recorded_pos, log_pos)
+        else:
+            self.events += events
+            self.pending_pos = log_pos
+
+class ReplicationLag(object):
+    """Tracks how far MemSQL is behind the master: the time since the
+    master logged the oldest change ditto read but didn't commit to
+    MemSQL yet or, if there is none, the newest change it committed (from
+    the event header timestamps, so the clocks of both hosts should
+    agree). `timestamps' returns both, the first one None if everything
+    read was committed, the second one None until something was. The
+    lag is 0 once a heartbeat shows ditto read everything and nothing is
+    left to commit.
+
+    A thread of its own logs the lag at INFO level every
+    LAG_REPORT_SECONDS, so that it keeps growing while applying is stuck.
+    If nothing, not even a heartbeat, was read for twice
+    `heartbeat_period', replication is reported as stalled instead, as
+    there is no telling what the master logged since.
+
+    """
+
+    def __init__(self, timestamps, heartbeat_period):
+        self.timestamps = timestamps
+        self.heartbeat_period = heartbeat_period
+        self.last_received = time.time()
+        self.caught_up = False
+        self.closed = threading.Event()
+        thread = threading.Thread(target=self.report_periodically)
+        thread.daemon = True
+        thread.start()
+
+    def received(self, heartbeat=False):
+        """Registers that an event was read, or a heartbeat showing that
+        every event the master logged was"""
+        self.last_received = time.time()
+        self.caught_up = heartbeat
+
+    def stalled(self):
+        """Returns for how many seconds nothing was read, if that is more
+        than twice the heartbeat period, and None otherwise"""
+        silence = time.time() - self.last_received
+        if self.heartbeat_period and silence > 2 * self.heartbeat_period:
+            return silence
+        return None
+
+    def lag(self):
+        """Returns the lag in seconds, or None if it isn't known"""
+        (oldest_pending, newest_committed) = self.timestamps()
+        if oldest_pending is not None:
+            return max(0.0, time.time() - oldest_pending)
+        if self.stalled() is not None:
+            return None
+        if self.caught_up:
+            return 0.0
+        if newest_committed is None:
+            return None
+        return max(0.0, time.time() - newest_committed)
+
+    def report(self):
+        lag = self.lag()
+        silence = self.stalled()
+        if silence is not None:
+            logging.info('Replication stalled: nothing read from the master for %.1f seconds'
+                         % silence)
+        if lag is not None:
+            logging.info('Replication lag: %.1f seconds' % lag)
+
+    def report_periodically(self):
+        while not self.closed.wait(LAG_REPORT_SECONDS):
+            try:
+                self.report()
+            except:
+                logging.exception('Failed to measure the replication lag')
+
+    def close(self):
+        self.closed.set()
+
+def is_transaction_start(binlogevent):
+    """Returns True if the event opens a source transaction"""
+    return isinstance(binlogevent, QueryEvent) and binlogevent.query == 'BEGIN'
+
+def is_transaction_end(binlogevent):
+    """Returns True if the event commits a source transaction. InnoDB
+    commits show up as XidEvents, non-transactional engines log a COMMIT
+    query instead"""
+    return isinstance(binlogevent, XidEvent) or \
+        (isinstance(binlogevent, QueryEvent) and binlogevent.query == 'COMMIT')
+
+def is_transaction_rollback(binlogevent):
+    """Returns True if the event ends a source transaction that was rolled
+    back. MySQL only logs those when they changed non-transactional
+    tables, whose changes stay (see nontransactional_changes)"""
+    return isinstance(binlogevent, QueryEvent) and binlogevent.query == 'ROLLBACK'
+
+def nontransactional_changes(args, transaction):
+    """Returns the row events of a rolled back source transaction
+    (`transaction' maps databases to their events) that changed tables
+    of a MySQL engine without transactions, by database. Those are the
+    changes MySQL kept. The engines are looked up on a connection of
+    their own, as rolled back transactions are rare"""
+    tables = set((binlogevent.schema, binlogevent.table)
+                 for database_events in transaction.values()
+                 for binlogevent in database_events if isinstance(binlogevent, RowsEvent))
+    if not tables:
+        return OrderedDict()
+    mysql_conn = memsql_database.Connection(
+        host=args.host+':'+str(args.port), user=args.user,
+        password=args.password, database='information_schema')
+    schemas = sorted(set(schema for schema, table in tables))
+    rows = mysql_conn.query("""SELECT t.table_schema AS table_schema, t.table_name AS table_name
+                               FROM tables t JOIN engines e ON e.engine = t.engine
+                               WHERE e.transactions = 'NO' AND t.table_schema IN (%s)"""
+                            % ', '.join(['%s'] * len(schemas)), *schemas)
+    mysql_conn.close()
+    nontransactional = set((row['table_schema'], row['table_name']) for row in rows)
+    changes = OrderedDict()
+    for database, database_events in transaction.items():
+        kept = [binlogevent for binlogevent in database_events
+                if isinstance(binlogevent, RowsEvent) and
+                (binlogevent.schema, binlogevent.table) in nontransactional]
+        if kept:
+            changes[database] = kept
+    return changes
+
 def connect_to_memsql(args, stream):
-    """Connects to a MemSQL instance to replicate to
+    """Connects to a MemSQL instance to replicate args.database to.
+    Returns the connection and the binlog position replication of that
+    database starts from, which is also recorded in its ditto_info. The
+    stream is left for the caller to connect, since it may be shared by
+    several databases.
 
     Expects that the `args' argument was obtained from the
     command_line_parser() parser (or something very similar)
@@ -190,10 +570,11 @@ def connect_to_memsql(args, stream):
             p2_input = p1.stdout
 
         # Read enough of the input to get the binlog position then terminate
+        binlog_pos = None
         for line in iter(p2_input.readline, ''):
-            match = re.search('MASTER_LOG_POS=(.*);', line)
+            match = re.search("MASTER_LOG_FILE='(.*)', MASTER_LOG_POS=(.*);", line)
             if match is not None:
-                binlog_pos = int(match.group(1))
+                binlog_pos = (match.group(1), int(match.group(2)))
                 break
         if binlog_pos is None:
             sys.exit("Could not find binlog position in mysqldump output. Try running with the --master-data=2 option")
@@ -226,13 +607,18 @@ def connect_to_memsql(args, stream):
     memsql_conn.set_print_queries(True)
     memsql_conn.set_print_function(logging.debug)
 
-    # Creates the ditto_info table that holds the log position of the
-    # next query to be read and a boolean indicating whether the
+    # Creates the ditto_info table that holds the log file and position
+    # of the next query to be read and a boolean indicating whether the
     # database is in use. If the boolean is 0, the database is open,
     # and the function continues. Else, the database is being used by
     # another ditto process, and the current one aborts, provided
     # ignore_ditto_lock isn't True.
-    memsql_conn.execute('CREATE TABLE IF NOT EXISTS ditto_info(pos bigint primary key, in_use int unique key)')
+    memsql_conn.execute('CREATE TABLE IF NOT EXISTS ditto_info(pos bigint primary key, in_use int unique key, file varchar(255))')
+    # ditto_info tables made before the file was recorded get it added.
+    # Their position is taken to be in the current binlog file
+    if 'file' not in [row['Field'] for row in memsql_conn.query('DESCRIBE ditto_info')]:
+        memsql_conn.execute('ALTER TABLE ditto_info ADD COLUMN file varchar(255)')
+    (master_log_file, _) = stream.get_master_binlog_pos()
     # Checks for usage. If it's open, we set in_use to 1
     q = memsql_conn.query('SELECT * FROM ditto_info')
     ditto_lock_errmsg = 'This database is already in use by another ditto process. If you wish to run ditto anyways, run it with the --ignore-ditto-lock flag.'
@@ -248,11 +634,11 @@ def connect_to_memsql(args, stream):
         # behavior as --resume-from-end
         try:
             if len(q) == 0:
-                ditto_pos = stream.starting_binlog_pos
-                memsql_conn.execute("INSERT INTO ditto_info values (%s, 1)", ditto_pos)
+                ditto_pos = (master_log_file, stream.starting_binlog_pos)
+                memsql_conn.execute("INSERT INTO ditto_info (file, pos, in_use) values (%s, %s, 1)", *ditto_pos)
             elif len(q) == 1:
-                ditto_pos = int(q[0]['pos'])
-                memsql_conn.execute("INSERT INTO ditto_info values (%s, 1)", ditto_pos)
+                ditto_pos = (q[0]['file'] or master_log_file, int(q[0]['pos']))
+                memsql_conn.execute("INSERT INTO ditto_info (file, pos, in_use) values (%s, %s, 1)", *ditto_pos)
                 memsql_conn.execute("DELETE FROM ditto_info where in_use=0")
             else:
                 sys.exit('ditto_info table cannot have more than one row')
@@ -266,64 +652,326 @@ def connect_to_memsql(args, stream):
 
     # If the resume_from_end flag is set, record the latest master
     # position. If the resume_from_start flag is set, record the
-    # initial binlog position. If either of these flags were set, the
-    # correct binlog position should have already been set in the
-    # stream by the connect_to_mysql_stream function
+    # initial binlog position.
     if args.resume_from_end:
-        record_master_binlog_pos(memsql_conn, stream)
+        log_pos = record_master_binlog_pos(memsql_conn, stream)
     elif args.resume_from_start:
-        setbinlogpos(stream, stream.starting_binlog_pos)
-        record_stream_binlog_pos(memsql_conn, stream)
+        log_pos = (master_log_file, stream.starting_binlog_pos)
+        record_binlog_pos(memsql_conn, log_pos)
     elif args.no_dump:
         # We look to ditto_info for the binlog position. We should
         # have gotten the ditto_pos value above.
         log_pos = ditto_pos
-        stream.connect_to_stream(
-            custom_log_pos = int(log_pos))
-        record_stream_binlog_pos(memsql_conn, stream)
+        record_binlog_pos(memsql_conn, log_pos)
     else:
         # Record the binlog_pos from mysqldump
-        stream.connect_to_stream(
-            custom_log_pos = binlog_pos)
-        record_stream_binlog_pos(memsql_conn, stream)
+        log_pos = binlog_pos
+        record_binlog_pos(memsql_conn, log_pos)
 
-    return memsql_conn
+    return memsql_conn, log_pos
 
-def process_binlogevent(binlogevent):
+def column_names(binlogevent):
+    """Returns the names of the columns of the event's table, in table order"""
+    return [column.name for column in binlogevent.columns]
+
+# Row images are tuples in table column order (the stream is opened with
+# tuple_rows), so columns are looked up by position
+
+def column_positions(names, columns):
+    """Returns the positions of `columns' in row images of a table with
+    the given column names"""
+    return [names.index(name) for name in columns]
+
+def key_positions(binlogevent):
+    """Returns the positions of the primary key columns in the row images
+    of the event"""
+    return [binlogevent.column_index[name] for name in binlogevent.primary_key]
+
+def where_clause(names, values):
+    """Returns a condition matching the given columns to the given values
+    (in the same order), together with its parameters"""
+    return (' AND '.join(map(compare_items, zip(names, values))),
+            map(fix_object, values))
+
+def insert_queries(table, names, rows, settings, upsert=False):
+    """Yields multi-row INSERTs for the given row values, each holding at
+    most `insert_batch_rows' rows and (approximately) at most
+    `max_statement_size' bytes. With `upsert', rows that already exist
+    are overwritten (using ON DUPLICATE KEY UPDATE)
+
+    """
+    prefix = 'INSERT INTO {0}({1}) VALUES '.format(
+        table, ', '.join(map(lambda k: '`%s`'%k, names)))
+    row_format = '({0})'.format(', '.join(['%s'] * len(names)))
+    suffix = ''
+    if upsert:
+        suffix = ' ON DUPLICATE KEY UPDATE ' + \
+            ', '.join(map(lambda k: '`%s`=VALUES(`%s`)'%(k, k), names))
+
+    batch_rows = 0
+    batch_size = len(prefix) + len(suffix)
+    parameters = []
+    for values in rows:
+        row = map(fix_object, values)
+        row_size = len(row_format) + 2 + sum(map(estimate_size, row))
+        if batch_rows > 0 and (batch_rows >= settings['insert_batch_rows'] or
+                               batch_size + row_size > settings['max_statement_size']):
+            yield (prefix + ', '.join([row_format] * batch_rows) + suffix, parameters)
+            batch_rows = 0
+            batch_size = len(prefix) + len(suffix)
+            parameters = []
+        batch_rows += 1
+        batch_size += row_size
+        parameters.extend(row)
+    if batch_rows > 0:
+        yield (prefix + ', '.join([row_format] * batch_rows) + suffix, parameters)
+
+def key_of(positions, values):
+    """Returns the key tuple of a row image, given the positions of the
+    key columns"""
+    return tuple(map(fix_object, [values[i] for i in positions]))
+
+def key_batches(keys, max_keys, settings):
+    """Yields lists of the given key tuples, each holding at most
+    `max_keys' keys and (approximately) at most `max_statement_size' bytes
+    of parameters"""
+    batch = []
+    batch_size = 0
+    for key in keys:
+        key_size = sum(map(estimate_size, key)) + 2 * len(key) + 2
+        if batch and (len(batch) >= max_keys or
+                      batch_size + key_size > settings['max_statement_size']):
+            yield batch
+            batch = []
+            batch_size = 0
+        batch.append(key)
+        batch_size += key_size
+    if batch:
+        yield batch
+
+def integer_ranges(values):
+    """Splits the values into runs of at least MIN_KEY_RANGE_LENGTH
+    consecutive integers, returned as (low, high) pairs, and a list of all
+    the remaining values"""
+    integers = sorted(set([v for v in values if isinstance(v, (int, long))]))
+    others = [v for v in values if not isinstance(v, (int, long))]
+
+    ranges = []
+    start = 0
+    for i in range(1, len(integers) + 1):
+        if i == len(integers) or integers[i] != integers[i - 1] + 1:
+            if i - start >= MIN_KEY_RANGE_LENGTH:
+                ranges.append((integers[start], integers[i - 1]))
+            else:
+                others.extend(integers[start:i])
+            start = i
+    return ranges, others
+
+def key_set_condition(primary_key, keys):
+    """Returns a condition matching exactly the rows with the given key
+    tuples, together with its parameters. Composite keys are matched with a
+    tuple IN-list. For single column keys, runs of consecutive integers are
+    matched with BETWEEN and the rest with an IN-list
+
+    """
+    if len(keys) == 1:
+        return where_clause(primary_key, keys[0])
+    if len(primary_key) > 1:
+        key_format = '({0})'.format(', '.join(['%s'] * len(primary_key)))
+        return ('({0}) IN ({1})'.format(
+                    ', '.join(map(lambda k: '`%s`'%k, primary_key)),
+                    ', '.join([key_format] * len(keys))),
+                [value for key in keys for value in key])
+
+    column = '`%s`' % primary_key[0]
+    ranges, others = integer_ranges([key[0] for key in keys])
+    conditions = []
+    parameters = []
+    for low, high in ranges:
+        conditions.append('{0} BETWEEN %s AND %s'.format(column))
+        parameters.extend([low, high])
+    if others:
+        conditions.append('{0} IN ({1})'.format(column, ', '.join(['%s'] * len(others))))
+        parameters.extend(others)
+    return ' OR '.join(conditions), parameters
+
+def delete_queries(table, primary_key, names, rows, settings):
+    """Yields DELETEs for the given row images. With `batch_deletes' set,
+    rows of tables that have a key are deleted in batches (see
+    key_batches and key_set_condition), otherwise each row gets its own
+    DELETE
+
+    """
+    positions = column_positions(names, primary_key)
+    if not primary_key:
+        for values in rows:
+            where, parameters = where_clause(names, values)
+            yield ('DELETE FROM {0} WHERE {1} LIMIT 1'.format(table, where), parameters)
+        return
+    if not settings['batch_deletes']:
+        for values in rows:
+            where, parameters = where_clause(primary_key, [values[i] for i in positions])
+            yield ('DELETE FROM {0} WHERE {1} LIMIT 1'.format(table, where), parameters)
+        return
+
+    keys = (key_of(positions, values) for values in rows)
+    for batch in key_batches(keys, settings['delete_batch_size'], settings):
+        where, parameters = key_set_condition(primary_key, batch)
+        yield ('DELETE FROM {0} WHERE {1}'.format(table, where), parameters)
+
+def changed_columns(names, before_values, after_values):
+    """Returns the positions of the columns whose value differs between
+    the two row images"""
+    return [i for i in xrange(len(names)) if before_values[i] != after_values[i]]
+
+def upsert_update_queries(table, primary_key, names, rows, settings):
+    """Yields idempotent queries for the given before/after row image
+    pairs: the after-images are written with multi-row upserts, so
+    applying them twice leaves the same rows. Rows whose key changed also
+    get their old key deleted first. Rows where nothing changed are
+    skipped"""
+    positions = column_positions(names, primary_key)
+    after_images = []
+    for before_values, after_values in rows:
+        if not changed_columns(names, before_values, after_values):
+            continue
+        before_key = key_of(positions, before_values)
+        if before_key != key_of(positions, after_values):
+            for query in insert_queries(table, names, after_images, settings, upsert=True):
+                yield query
+            after_images = []
+            where, where_parameters = key_set_condition(primary_key, [before_key])
+            yield ('DELETE FROM {0} WHERE {1}'.format(table, where), where_parameters)
+        after_images.append(after_values)
+    for query in insert_queries(table, names, after_images, settings, upsert=True):
+        yield query
+
+def update_queries(table, primary_key, names, rows, settings):
+    """Yields UPDATEs for the given before/after row image pairs. Only the
+    columns that actually changed are SET, and rows where nothing changed
+    are skipped.
+
+    On tables with a key, rows that get the same SET payload (e.g. from
+    UPDATE t SET status='archived' WHERE ...) are folded into one UPDATE
+    matching all their keys (see key_set_condition), `update_batch_size'
+    rows at a time. Rows that change the key itself are never folded, and
+    pending folded rows are flushed before a key is updated a second
+    time, so every key still sees its updates in binlog order.
+
+    In the upsert apply mode, rows of tables with a key are written with
+    upsert_update_queries instead.
+
+    """
+    if settings['apply_mode'] == 'upsert' and primary_key:
+        for query in upsert_update_queries(table, primary_key, names, rows, settings):
+            yield query
+        return
+
+    keys = list(primary_key) or names
+    positions = column_positions(names, keys)
+    # (changed columns, new values) -> key tuples, in order of first
+    # appearance
+    folded = OrderedDict()
+    folded_keys = set()
+
+    def single_update(changed, before_values, after_values):
+        where, where_parameters = where_clause(keys, [before_values[i] for i in positions])
+        return ('UPDATE {0} SET {1} WHERE {2} LIMIT 1'.format(
+                    table,
+                    ', '.join(['`%s`=%%s'%names[i] for i in changed]),
+                    where
+                    ),
+                    map(fix_object, [after_values[i] for i in changed]) + where_parameters
+                )
+
+    def flush_folded():
+        for (changed, values), row_keys in folded.items():
+            set_clause = ', '.join(['`%s`=%%s'%names[i] for i in changed])
+            for batch in key_batches(row_keys, settings['update_batch_size'], settings):
+                where, where_parameters = key_set_condition(primary_key, batch)
+                yield ('UPDATE {0} SET {1} WHERE {2}'.format(table, set_clause, where),
+                       list(values) + where_parameters)
+        folded.clear()
+        folded_keys.clear()
+
+    for before_values, after_values in rows:
+        changed = changed_columns(names, before_values, after_values)
+        if not changed:
+            continue
+        if not primary_key or set(changed) & set(positions):
+            for query in flush_folded():
+                yield query
+            yield single_update(changed, before_values, after_values)
+            continue
+
+        key = key_of(positions, before_values)
+        if key in folded_keys:
+            for query in flush_folded():
+                yield query
+        payload = (tuple(changed),
+                   tuple(map(fix_object, [after_values[i] for i in changed])))
+        folded.setdefault(payload, []).append(key)
+        folded_keys.add(key)
+
+    for query in flush_folded():
+        yield query
+
+def process_binlogevent(binlogevent, settings=None):
         """Extracts the query/queries from the given binlogevent"""
+        return list(process_binlogevents([binlogevent], settings))
+
+def process_binlogevents(binlogevents, settings=None):
+        """Yields the queries for a sequence of binlogevents. The rows of
+        consecutive row events of the same type on the same table are put
+        together, so that they can be applied with multi-row statements,
+        since a single statement on the source is split into many small
+        events in the binlog. Rows are decoded as the queries are built
+        (see RowsEvent.iter_rows), so a huge event is never held in
+        memory as a whole
+
+        """
 
         # Each query is a pair with a string and a list of parameters for
         # format specifiers
-        queries = []
-
-        if isinstance(binlogevent, QueryEvent):
-            if binlogevent.query != 'BEGIN': # BEGIN events don't matter
-                queries.append( (binlogevent.query, []) )
-        else:
-            for row in binlogevent.rows:
-                if isinstance(binlogevent, WriteRowsEvent):
-                    query = ('INSERT INTO {0}({1}) VALUES ({2})'.format(
-                                binlogevent.table,
-                                ', '.join(map(lambda k: '`%s`'%k, row['values'].keys())),
-                                ', '.join(['%s'] * len(row['values']))
-                                ),
-                                map(fix_object, row['values'].values())
-                            )
-                elif isinstance(binlogevent, DeleteRowsEvent):
-                    query = ('DELETE FROM {0} WHERE {1} LIMIT 1'.format(
-                                binlogevent.table,
-                                ' AND '.join(map(compare_items, row['values'].items()))
-                                ),
-                                map(fix_object, row['values'].values())
-                            )
-                elif isinstance(binlogevent, UpdateRowsEvent):
-                    query = ('UPDATE {0} SET {1} WHERE {2} LIMIT 1'.format(
-                                binlogevent.table,
-                                ', '.join(['`%s`=%%s'%k for k in row['after_values'].keys()]),
-                                ' AND '.join(map(compare_items, row['before_values'].items()))
-                                ),
-                                map(fix_object, row['after_values'].values() + row['before_values'].values())
-                            )
-                queries.append(query) # It should never be the case that query wasn't created
-
-        return queries
+        settings = settings or DEFAULT_APPLY_SETTINGS
+
+        # Row events waiting to be put together, all of the same type on
+        # the same table with the same columns
+        run = []
+
+        def same_run(binlogevent):
+            return (type(run[0]) == type(binlogevent) and
+                    run[0].table == binlogevent.table and
+                    column_names(run[0]) == column_names(binlogevent))
+
+        def flush_run():
+            if isinstance(run[0], UpdateRowsEvent):
+                rows = (row for e in run for row in e.iter_rows())
+                return update_queries(run[0].table, run[0].primary_key,
+                                      column_names(run[0]), rows, settings)
+            rows = (values for e in run for values in e.iter_rows())
+            if isinstance(run[0], WriteRowsEvent):
+                upsert = settings['apply_mode'] == 'upsert' and bool(run[0].primary_key)
+                return insert_queries(run[0].table, column_names(run[0]), rows, settings,
+                                      upsert=upsert)
+            else:
+                return delete_queries(run[0].table, run[0].primary_key,
+                                      column_names(run[0]), rows, settings)
+
+        for binlogevent in binlogevents:
+            if run and not same_run(binlogevent):
+                for query in flush_run():
+                    yield query
+                run = []
+
+            if isinstance(binlogevent, RowsEvent):
+                run.append(binlogevent)
+            elif isinstance(binlogevent, QueryEvent):
+                # Transaction boundaries are handled by the listener
+                if not is_transaction_start(binlogevent) and not is_transaction_end(binlogevent) \
+                        and not is_transaction_rollback(binlogevent):
+                    yield (binlogevent.query, [])
+
+        if run:
+            for query in flush_run():
+                yield query
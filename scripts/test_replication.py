@@ -29,11 +29,12 @@ if __name__ == '__main__':
                         help="Don't read the binlog at all after connecting")
 
     args = parser.parse_args()
-    stream, memsql_conn = wrap_execution(connect_to_databases, [args])
+    stream, memsql_conns = wrap_execution(connect_to_databases, [args])
 
     def equality_checker():
-        if wrap_execution(check_equality, [args, memsql_conn],
-                          memsql_conn, stream):
+        if all(wrap_execution(check_equality, [database_args(args, database), memsql_conn],
+                              memsql_conns, stream)
+               for database, memsql_conn in memsql_conns.items()):
             logging.info('Replication successful')
         else:
             logging.info('Failure')
@@ -41,12 +42,12 @@ if __name__ == '__main__':
     if not args.no_listen:
         # Since blocking=False, binlog_listen will not close the
         # connections before exiting
-        binlog_listen(memsql_conn, stream)
+        binlog_listen(memsql_conns, stream, args)
         equality_checker()
-        # Doesn't provide stream and memsql_conn, since if
+        # Doesn't provide stream and memsql_conns, since if
         # close_connections fails, it's not going to be able to close
         # connections anyways
-        wrap_execution(close_connections, [memsql_conn, stream])
+        wrap_execution(close_connections, [memsql_conns, stream])
     else:
         equality_checker()
-        wrap_execution(close_connections, [memsql_conn, stream])
+        wrap_execution(close_connections, [memsql_conns, stream])
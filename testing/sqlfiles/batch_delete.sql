@@ -0,0 +1,28 @@
+-- Copyright 2013 MemSQL, Inc.
+
+-- Licensed under the Apache License, Version 2.0 (the "License"); you may not use
+-- this file except in compliance with the License.  You may obtain a copy of the
+-- License at
+
+--     http://www.apache.org/licenses/LICENSE-2.0
+
+-- Unless required by applicable law or agreed to in writing, software distributed
+-- under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+-- CONDITIONS OF ANY KIND, either express or implied.  See the License for the
+-- specific language governing permissions and limitations under the License.
+
+-- Deletes that remove many rows at once, with runs of contiguous keys
+-- and composite keys. Meant to be replayed with --batch-deletes
+drop table if exists batch_delete;
+create table batch_delete (id int primary key, a int);
+drop table if exists batch_delete_composite;
+create table batch_delete_composite (a int, b varchar(10), c int, primary key (a, b));
+
+insert into batch_delete values (1,1), (2,2), (3,3), (4,4), (5,5), (6,6), (7,7), (8,8), (9,9), (10,10);
+insert into batch_delete select id + 10, a from batch_delete;
+insert into batch_delete select id + 20, a from batch_delete;
+insert into batch_delete_composite values (1,'a',1), (1,'b',2), (2,'a',3), (2,'b',4);
+
+delete from batch_delete where id <= 12;
+delete from batch_delete where id in (15, 17, 19, 20, 21, 22, 30);
+delete from batch_delete_composite where b = 'a';
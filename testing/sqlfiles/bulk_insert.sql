@@ -0,0 +1,32 @@
+-- Copyright 2013 MemSQL, Inc.
+
+-- Licensed under the Apache License, Version 2.0 (the "License"); you may not use
+-- this file except in compliance with the License.  You may obtain a copy of the
+-- License at
+
+--     http://www.apache.org/licenses/LICENSE-2.0
+
+-- Unless required by applicable law or agreed to in writing, software distributed
+-- under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+-- CONDITIONS OF ANY KIND, either express or implied.  See the License for the
+-- specific language governing permissions and limitations under the License.
+
+-- A bulk insert large enough to be split across several row events, so
+-- that ditto has to coalesce rows across events
+drop table if exists bulk_insert;
+create table bulk_insert (id int primary key auto_increment, a int, b varchar(200));
+
+insert into bulk_insert (a, b) values (1, repeat('a', 200)), (2, repeat('b', 200)), (3, NULL), (4, 'd');
+insert into bulk_insert (a, b) select a + 4, b from bulk_insert;
+insert into bulk_insert (a, b) select a + 8, b from bulk_insert;
+insert into bulk_insert (a, b) select a + 16, b from bulk_insert;
+insert into bulk_insert (a, b) select a + 32, b from bulk_insert;
+insert into bulk_insert (a, b) select a + 64, b from bulk_insert;
+insert into bulk_insert (a, b) select a + 128, b from bulk_insert;
+insert into bulk_insert (a, b) select a + 256, b from bulk_insert;
+
+start transaction;
+insert into bulk_insert (a, b) values (1000, 'x'), (1001, 'y');
+insert into bulk_insert (a) values (1002);
+insert into bulk_insert (a, b) values (1003, 'z');
+commit;
@@ -0,0 +1,32 @@
+-- Copyright 2013 MemSQL, Inc.
+
+-- Licensed under the Apache License, Version 2.0 (the "License"); you may not use
+-- this file except in compliance with the License.  You may obtain a copy of the
+-- License at
+
+--     http://www.apache.org/licenses/LICENSE-2.0
+
+-- Unless required by applicable law or agreed to in writing, software distributed
+-- under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+-- CONDITIONS OF ANY KIND, either express or implied.  See the License for the
+-- specific language governing permissions and limitations under the License.
+
+-- Updates that give many rows the same new values, interleaved with
+-- updates that hit the same keys again and updates that change keys
+drop table if exists mass_update;
+create table mass_update (id int primary key, status varchar(20), counter int);
+
+insert into mass_update values (1,'new',0), (2,'new',0), (3,'new',0), (4,'new',0), (5,'new',0);
+insert into mass_update select id + 5, status, counter from mass_update;
+insert into mass_update select id + 10, status, counter from mass_update;
+
+update mass_update set status = 'archived' where id <= 12;
+update mass_update set counter = counter where id > 15;
+
+start transaction;
+update mass_update set status = 'open' where id in (13, 14, 15);
+update mass_update set status = 'closed' where id = 14;
+update mass_update set status = 'open' where id = 16;
+update mass_update set id = id + 100 where id = 20;
+update mass_update set status = 'open' where id = 14;
+commit;
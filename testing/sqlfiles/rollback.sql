@@ -0,0 +1,43 @@
+-- Copyright 2013 MemSQL, Inc.
+
+-- Licensed under the Apache License, Version 2.0 (the "License"); you may not use
+-- this file except in compliance with the License.  You may obtain a copy of the
+-- License at
+
+--     http://www.apache.org/licenses/LICENSE-2.0
+
+-- Unless required by applicable law or agreed to in writing, software distributed
+-- under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+-- CONDITIONS OF ANY KIND, either express or implied.  See the License for the
+-- specific language governing permissions and limitations under the License.
+
+-- A transaction that changed a non-transactional table is logged even
+-- when it is rolled back, ending in a ROLLBACK. The trigger puts both
+-- changes in the same statement, so that MySQL logs them together
+drop table if exists rollback_log;
+create table rollback_log(a int primary key) engine=MyISAM;
+drop table if exists rollback_items;
+create table rollback_items(a int primary key, b int) engine=InnoDB;
+create trigger rollback_items_log after insert on rollback_items
+    for each row insert into rollback_log values (new.a);
+
+-- Only the rollback_log row stays
+begin;
+insert into rollback_items values (1, 10);
+rollback;
+
+-- Not logged at all
+begin;
+update rollback_items set b = b + 1;
+rollback;
+
+-- Must not be merged with the rolled back transaction
+begin;
+insert into rollback_items values (2, 20);
+commit;
+
+begin;
+insert into rollback_items values (3, 30), (4, 40);
+delete from rollback_items where a = 3;
+rollback;
+insert into rollback_items values (5, 50);
@@ -16,7 +16,8 @@
 # the .sql file on the MySQL side. It splits up the queries in the
 # binlog, and runs chunks at a time, killing the proccess after a
 # certain number of queries and re-resuming until the queries are
-# done.
+# done. This is done once per checkpoint policy, checking the binlog
+# position ditto records every time it is killed.
 
 import subprocess, threading
 from memsql import common, tools
@@ -50,18 +51,48 @@ class Command(object):
             thread.join()
         return self.process.returncode
 
-# The first invocation needs to tell ditto to start from the beginning
-# of the binlog. After that it should resume from where it was
-# interrupted.
-startcommand = Command(["python", "../scripts/test_replication.py", dbname,
-                   "--no-dump", "--no-blocking", "--resume-from-start",
-                    "--ignore-ditto-lock", "--log="+loglevel])
-command = Command(["python", "../scripts/test_replication.py", dbname,
-                   "--no-dump", "--no-blocking",
-                   "--ignore-ditto-lock", "--log="+loglevel])
+mysql_conn = tools.Connection(user='root', host='127.0.0.1:3307', database='')
+memsql_conn = tools.Connection(user='root', host='127.0.0.1:3306', database='')
+master = mysql_conn.get('show master status')
+master_pos = (master['File'], int(master['Position']))
+
+def recorded_pos():
+    """Returns the binlog position recorded in ditto_info"""
+    row = memsql_conn.get('select file, pos from %s.ditto_info' % dbname)
+    return (row['file'], int(row['pos']))
+
+# Checkpoint policies to interrupt: the position recorded with every
+# transaction, or only every so many events or milliseconds, in which
+# case a killed ditto still has to record its last commit
+policies = [[],
+            ["--checkpoint-events=50", "--apply-mode=upsert"],
+            ["--checkpoint-ms=500", "--apply-mode=upsert"]]
 
 timelimit = 3
-# Keeps running the command until the exit code is 0
-ret = startcommand.run(timelimit)
-while ret != 0:
-    ret = command.run(timelimit)
+for policy in policies:
+    logging.debug('checkpoint policy: %s' % (' '.join(policy) or 'default'))
+    memsql_conn.execute('drop database if exists %s' % dbname)
+    memsql_conn.execute('create database %s' % dbname)
+
+    # The first invocation needs to tell ditto to start from the beginning
+    # of the binlog. After that it should resume from where it was
+    # interrupted.
+    startcommand = Command(["python", "../scripts/test_replication.py", dbname,
+                       "--no-dump", "--no-blocking", "--resume-from-start",
+                        "--ignore-ditto-lock", "--log="+loglevel] + policy)
+    command = Command(["python", "../scripts/test_replication.py", dbname,
+                       "--no-dump", "--no-blocking",
+                       "--ignore-ditto-lock", "--log="+loglevel] + policy)
+
+    # Keeps running the command until the exit code is 0
+    ret = startcommand.run(timelimit)
+    log_pos = recorded_pos()
+    while ret != 0:
+        ret = command.run(timelimit)
+        # An interrupted ditto never records an earlier position than
+        # the one it resumed from
+        assert recorded_pos() >= log_pos, \
+            'Position went back from %s:%d to %s:%d' % (log_pos + recorded_pos())
+        log_pos = recorded_pos()
+    assert log_pos == master_pos, \
+        'Recorded %s:%d instead of the master position %s:%d' % (log_pos + master_pos)
@@ -0,0 +1,376 @@
+# Copyright 2013 MemSQL, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use
+# this file except in compliance with the License.  You may obtain a copy of the
+# License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations under the License.
+
+# Unit tests of the parallel appliers. The lanes run on stub MemSQL
+# connections that log the queries they get, so neither MySQL nor MemSQL
+# is needed: python test_parallel.py
+
+import os
+import sys
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+import replication_parallel
+from replication_parallel import *
+from replication_compaction import CompactionWindow
+
+class Column(object):
+    def __init__(self, name):
+        self.name = name
+
+def rows_event(cls, table, rows, names=('id', 'data'), primary_key=('id',)):
+    """Returns a row event of `table' carrying the given row images, as
+    the stream decodes them with tuple_rows"""
+    binlogevent = object.__new__(cls)
+    binlogevent.schema = 'db'
+    binlogevent.table = table
+    binlogevent.columns = [Column(name) for name in names]
+    binlogevent.column_index = dict((name, i) for i, name in enumerate(names))
+    binlogevent.primary_key = tuple(primary_key)
+    binlogevent._RowsEvent__rows = list(rows)
+    binlogevent._RowsEvent__rows_future = None
+    return binlogevent
+
+def statement(query):
+    binlogevent = object.__new__(QueryEvent)
+    binlogevent.schema = 'db'
+    binlogevent.query = query
+    return binlogevent
+
+class QueryLog(object):
+    """The queries run on the stub connections, in the order they ran"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = []
+
+    def add(self, conn, query, parameters):
+        with self.lock:
+            self.entries.append((conn, query, tuple(parameters)))
+
+    def writes(self, table=''):
+        """Yields (index, id, data) for every row written by an INSERT
+        (into tables whose name starts with `table')"""
+        for i, (conn, query, parameters) in enumerate(self.entries):
+            if query.startswith('INSERT INTO ' + table):
+                for j in range(0, len(parameters), 2):
+                    yield i, parameters[j], parameters[j + 1]
+
+    def index(self, query):
+        return [entry[1] for entry in self.entries].index(query)
+
+class StubConnection(object):
+    """Stands for the MemSQL connection of a lane. Queries writing the
+    row with the id in `fail' raise a fatal error, and queries wait for
+    `gate' to be set if there is one"""
+    log = None
+    fail = None
+    gate = None
+
+    def __init__(self, **settings):
+        pass
+
+    def set_print_queries(self, print_queries):
+        pass
+
+    def set_print_function(self, print_function):
+        pass
+
+    def close(self):
+        pass
+
+    def execute(self, query, *parameters):
+        # Lets the other lanes get ahead
+        time.sleep(0.001)
+        if StubConnection.gate is not None:
+            StubConnection.gate.wait()
+        if StubConnection.fail is not None and parameters[:1] == (StubConnection.fail,):
+            raise MySQLdb.DatabaseError(list(FATAL_ERROR_CODES)[0], 'Lost connection')
+        StubConnection.log.add(self, query, parameters)
+
+class StubSerial(object):
+    """Stands for the SerialApplier behind the parallel ones"""
+
+    def __init__(self, log, checkpointer):
+        self.log = log
+        self.settings = dict(DEFAULT_APPLY_SETTINGS, apply_mode='upsert')
+        self.checkpointer = checkpointer
+        self.applied_pos = None
+
+    def apply_transaction(self, binlogevents, log_pos):
+        for query, parameters in process_binlogevents(binlogevents, self.settings):
+            self.log.add(self, query, parameters)
+        self.checkpoint(len(binlogevents), log_pos)
+        self.applied_pos = log_pos
+
+    def apply_window(self, window):
+        for query, parameters in window.queries(self.settings):
+            self.log.add(self, query, parameters)
+        self.checkpoint(len(window), window.log_pos)
+        self.applied_pos = window.log_pos
+
+    def apply_ddl(self, binlogevent):
+        self.log.add(self, binlogevent.query, [])
+
+    def checkpoint(self, events, log_pos):
+        self.log.add(self, 'checkpoint', [log_pos])
+        self.checkpointer.committed(events, log_pos, True)
+
+    def committed_pos(self):
+        return self.applied_pos
+
+    def finish(self):
+        pass
+
+class ParallelTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.log = QueryLog()
+        StubConnection.log = self.log
+        StubConnection.fail = None
+        StubConnection.gate = None
+        self.connection = replication_parallel.memsql_database.Connection
+        replication_parallel.memsql_database.Connection = StubConnection
+        self.serial = StubSerial(self.log, Checkpointer(10, 0))
+        self.applier = None
+
+    def tearDown(self):
+        if self.applier is not None:
+            self.applier.close()
+            lanes = self.applier.workers if isinstance(self.applier, WritesetApplier) \
+                else self.applier.lanes
+            for lane in lanes:
+                lane.join()
+        replication_parallel.memsql_database.Connection = self.connection
+
+    def assertCheckpointsFollowWrites(self):
+        """Every recorded position comes after the rows written before it.
+        Rows written by the transaction ending at position n carry n"""
+        checkpoints = [(i, parameters[0]) for i, (conn, query, parameters)
+                       in enumerate(self.log.entries) if query == 'checkpoint']
+        self.assertTrue(checkpoints)
+        for i, log_pos in checkpoints:
+            for j, key, data in self.log.writes():
+                if data <= log_pos:
+                    self.assertLess(j, i)
+
+class LaneApplierTest(ParallelTestCase):
+
+    def test_route_by_table(self):
+        self.applier = LaneApplier(self.serial, {}, 3, False)
+        for n in range(1, 31):
+            self.applier.apply_transaction(
+                [rows_event(WriteRowsEvent, 't%d' % table, [(n, n)]) for table in range(6)], n)
+        self.applier.apply_transaction(
+            [statement('INSERT INTO s VALUES (1)'), rows_event(WriteRowsEvent, 't0', [(31, 31)])], 31)
+        self.applier.finish()
+
+        lanes = {}
+        for conn, query, parameters in self.log.entries:
+            if query.startswith('INSERT INTO t'):
+                lanes.setdefault(query.split('(')[0], set()).add(conn)
+        self.assertEqual(len(lanes), 6)
+        for table, conns in lanes.items():
+            self.assertEqual(len(conns), 1, table)
+        # Statements run alone on the first lane
+        index = self.log.index('INSERT INTO s VALUES (1)')
+        self.assertIs(self.log.entries[index][0], self.applier.lanes[0].memsql_conn)
+        self.assertCheckpointsFollowWrites()
+
+    def test_route_by_key_keeps_key_order(self):
+        # No checkpoint (and barrier) is due once the window is handed over
+        self.serial.checkpointer.max_events = 40
+        self.applier = LaneApplier(self.serial, {}, 4, True)
+        window = CompactionWindow(1000, 60000)
+        for n in range(1, 61):
+            binlogevents = [rows_event(WriteRowsEvent, 't', [(key, n) for key in range(8)])]
+            if n == 20:
+                # Barriers in the middle of a source transaction
+                binlogevents.insert(0, statement('INSERT INTO s VALUES (20)'))
+                binlogevents.append(rows_event(UpdateRowsEvent, 't', [((50, 19), (51, 20))]))
+            if 30 <= n < 35:
+                window.add_transaction(binlogevents, n)
+                if n == 34:
+                    self.applier.apply_window(window)
+                    # What binlog_listen does right away
+                    window.clear()
+            else:
+                self.applier.apply_transaction(binlogevents, n)
+        self.applier.finish()
+
+        applied = {}
+        for i, key, data in self.log.writes():
+            applied.setdefault(key, []).append(data)
+        for key in range(8):
+            self.assertEqual(applied[key], sorted(applied[key]))
+            self.assertEqual(applied[key][-1], 60)
+            # Compacted to the last transaction of the window
+            self.assertIn(34, applied[key])
+            self.assertNotIn(33, applied[key])
+        self.assertEqual(applied[51], [20])
+
+        for query in ('INSERT INTO s VALUES (20)', 'DELETE FROM t WHERE `id`=%s'):
+            index = self.log.index(query)
+            for i, key, data in self.log.writes():
+                if data < 20 or data > 20:
+                    self.assertEqual(i < index, data < 20, query)
+        self.assertCheckpointsFollowWrites()
+
+    def test_committed_pos(self):
+        StubConnection.gate = threading.Event()
+        # Handed over without a checkpoint, and its barrier
+        self.serial.checkpointer.max_events = 100
+        self.applier = LaneApplier(self.serial, {}, 2, False)
+        for n in range(1, 4):
+            self.applier.apply_transaction([rows_event(WriteRowsEvent, 't%d' % n, [(n, n)])], n)
+        self.assertIsNone(self.applier.committed_pos())
+        StubConnection.gate.set()
+        self.applier.barrier()
+        self.assertEqual(self.applier.committed_pos(), 3)
+
+class WritesetTest(unittest.TestCase):
+
+    def test_rows(self):
+        binlogevents = [rows_event(WriteRowsEvent, 't', [(1, 'a'), (2, 'b')]),
+                        rows_event(DeleteRowsEvent, 't', [(3, 'c')])]
+        self.assertEqual(writeset(binlogevents), set([('t', (1,)), ('t', (2,)), ('t', (3,))]))
+
+    def test_key_change(self):
+        binlogevents = [rows_event(UpdateRowsEvent, 't', [((1, 'a'), (5, 'a'))])]
+        self.assertEqual(writeset(binlogevents), set([('t', (1,)), ('t', (5,))]))
+
+    def test_keyless_table(self):
+        binlogevents = [rows_event(WriteRowsEvent, 't', [(1, 'a')]),
+                        rows_event(WriteRowsEvent, 'k', [(1, 'a'), (2, 'b')], primary_key=())]
+        self.assertEqual(writeset(binlogevents), set([('t', (1,)), ('k',)]))
+
+    def test_statement(self):
+        binlogevents = [rows_event(WriteRowsEvent, 't', [(1, 'a')]),
+                        statement('INSERT INTO s VALUES (1)')]
+        self.assertIsNone(writeset(binlogevents))
+
+class WritesetApplierTest(ParallelTestCase):
+
+    def setUp(self):
+        ParallelTestCase.setUp(self)
+        self.serial.checkpointer = Checkpointer(0, 0)
+
+    def checkpoints(self):
+        return [parameters[0] for conn, query, parameters in self.log.entries
+                if query == 'checkpoint']
+
+    def test_watermark(self):
+        # Without workers, transactions are only marked applied by hand
+        self.applier = WritesetApplier(self.serial, {}, 0)
+        for n in range(1, 5):
+            self.applier.apply_transaction([rows_event(WriteRowsEvent, 't', [(n, n)])], n)
+        transactions = list(self.applier.scheduled)
+
+        for transaction in transactions[1:3]:
+            self.applier.applied(transaction)
+        self.applier.advance()
+        self.assertEqual(self.checkpoints(), [])
+
+        self.applier.applied(transactions[0])
+        self.applier.advance()
+        self.assertEqual(self.checkpoints(), [3])
+
+        self.applier.applied(transactions[3])
+        self.applier.advance()
+        self.assertEqual(self.checkpoints(), [3, 4])
+
+    def test_committed_pos(self):
+        self.applier = WritesetApplier(self.serial, {}, 0)
+        for n in range(1, 4):
+            self.applier.apply_transaction([rows_event(WriteRowsEvent, 't', [(n, n)])], n)
+        transactions = list(self.applier.scheduled)
+        self.assertIsNone(self.applier.committed_pos())
+        # Committed up to the first gap, before the watermark moves
+        for transaction in (transactions[0], transactions[2]):
+            self.applier.applied(transaction)
+        self.assertEqual(self.applier.committed_pos(), 1)
+        self.applier.applied(transactions[1])
+        self.assertEqual(self.applier.committed_pos(), 3)
+        self.applier.advance()
+        self.assertEqual(self.applier.committed_pos(), 3)
+
+    def test_conflicts_apply_in_order(self):
+        self.applier = WritesetApplier(self.serial, {}, 4)
+        for n in range(1, 41):
+            rows = [(n % 5, n), (10 + n % 3, n)]
+            self.applier.apply_transaction([rows_event(WriteRowsEvent, 't', rows)], n)
+            if n % 10 == 0:
+                self.applier.apply_transaction(
+                    [rows_event(WriteRowsEvent, 'k', [(n, n)], primary_key=())], n + 0.5)
+        self.applier.finish()
+
+        applied = {}
+        for i, key, data in self.log.writes('t('):
+            applied.setdefault(key, []).append(data)
+        for key in range(5) + range(10, 13):
+            self.assertEqual(applied[key], sorted(applied[key]))
+        self.assertEqual(self.checkpoints()[-1], 40.5)
+        self.assertEqual(self.checkpoints(), sorted(self.checkpoints()))
+        self.assertCheckpointsFollowWrites()
+
+    def test_failed_transaction(self):
+        StubConnection.fail = 1
+        self.applier = WritesetApplier(self.serial, {}, 2)
+        with self.assertRaises(MySQLdb.DatabaseError):
+            for n in range(1, 6):
+                self.applier.apply_transaction([rows_event(WriteRowsEvent, 't', [(n, n)])], n)
+            self.applier.finish()
+        # Nothing is recorded past the transaction that failed, even once
+        # later ones committed on the other worker
+        self.applier.queue.join()
+        self.assertFalse(self.applier.scheduled[0].applied)
+        self.applier.advance()
+        self.assertEqual(self.checkpoints(), [])
+
+class ReplicationLagTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pending = None
+        self.committed = None
+        self.lag = ReplicationLag(lambda: (self.pending, self.committed), 0.05)
+
+    def tearDown(self):
+        self.lag.close()
+
+    def test_lag(self):
+        self.assertIsNone(self.lag.lag())
+        self.lag.received()
+        self.committed = time.time() - 5
+        self.assertAlmostEqual(self.lag.lag(), 5, 0)
+        # A heartbeat doesn't hide what is handed over but not committed
+        self.lag.received(True)
+        self.pending = time.time() - 3
+        self.assertAlmostEqual(self.lag.lag(), 3, 0)
+        self.pending = None
+        self.assertEqual(self.lag.lag(), 0)
+
+    def test_stalled(self):
+        self.lag.received(True)
+        self.assertIsNone(self.lag.stalled())
+        time.sleep(0.15)
+        self.assertGreater(self.lag.stalled(), 0.1)
+        self.assertIsNone(self.lag.lag())
+        # Unless something is left to commit
+        self.pending = time.time() - 3
+        self.assertAlmostEqual(self.lag.lag(), 3, 0)
+
+if __name__ == '__main__':
+    unittest.main()
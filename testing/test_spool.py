@@ -0,0 +1,176 @@
+# Copyright 2013 MemSQL, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not use
+# this file except in compliance with the License.  You may obtain a copy of the
+# License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software distributed
+# under the License is distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied.  See the License for the
+# specific language governing permissions and limitations under the License.
+
+# Unit tests of the binlog spool. The spool is filled from a stub stream
+# handing out made up events, so MySQL isn't needed: python test_spool.py
+
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'scripts'))
+
+import replication_spool
+from replication_spool import *
+
+def event(log_pos):
+    """Returns the packet of an event ending at `log_pos' in bin.1"""
+    body = struct.pack('<Q', log_pos)
+    return '\0' + struct.pack('<IBIIIH', 0, 16, 1, 19 + len(body), log_pos, 0) + body
+
+class StubPacket(object):
+    def __init__(self, data):
+        self.data = data
+
+    def get_all_data(self):
+        return self.data
+
+    def is_ok_packet(self):
+        return True
+
+class StubStream(object):
+    """Stands for the BinLogStreamReader, handing out the events ending at
+    `positions' and then the end of the stream"""
+
+    def __init__(self, start, positions):
+        (self.log_file, self.log_pos) = start
+        self.packets = [StubPacket(event(log_pos)) for log_pos in positions]
+        self.connected = None
+
+    def connect_to_stream(self, custom_log_pos, custom_log_file):
+        self.connected = (custom_log_file, custom_log_pos)
+
+    def read_packet(self):
+        if self.packets:
+            return self.packets.pop(0)
+        return None
+
+class RecordingSpool(Spool):
+    """Notes the segments whose records were read through"""
+
+    def records(self, number):
+        self.scanned.append(number)
+        return Spool.records(self, number)
+
+def positions(spool):
+    """Reads the spool to its end, returning where its events end"""
+    return [struct.unpack_from('<I', pkt.get_all_data(), 14)[0]
+            for pkt in iter(spool.read_packet, None)]
+
+class SpoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.spools = []
+        self.expire_seconds = replication_spool.EXPIRE_SECONDS
+        replication_spool.EXPIRE_SECONDS = 0.01
+
+    def tearDown(self):
+        for spool in self.spools:
+            spool.close()
+        replication_spool.EXPIRE_SECONDS = self.expire_seconds
+        shutil.rmtree(self.directory)
+
+    def spool(self, start, positions, segment_bytes=60, compress_level=1,
+              retention_bytes=0, retention_seconds=0):
+        RecordingSpool.scanned = []
+        spool = RecordingSpool(StubStream(start, positions), self.directory, segment_bytes,
+                               compress_level, retention_bytes, retention_seconds)
+        self.spools.append(spool)
+        return spool
+
+    def fill(self, **settings):
+        """Spools the events ending at 110 to 180. With the default
+        segment_bytes, they go two to a segment, the segments starting at
+        100, 120, 140, 160 and, empty, 180"""
+        spool = self.spool(('bin.1', 100), range(110, 190, 10), **settings)
+        self.assertEqual(positions(spool), range(110, 190, 10))
+        return spool
+
+    def test_resume_inside(self):
+        self.assertEqual(self.fill().segment_numbers(), range(1, 6))
+        spool = self.spool(('bin.1', 130), [190])
+        self.assertEqual(spool.stream.connected, ('bin.1', 180))
+        self.assertEqual(positions(spool), [140, 150, 160, 170, 180, 190])
+        # Only the segment holding the start and the last one
+        self.assertEqual(spool.scanned, [2, 5])
+
+    def test_resume_at_segment_end(self):
+        self.fill()
+        spool = self.spool(('bin.1', 160), [190])
+        self.assertEqual(spool.stream.connected, ('bin.1', 180))
+        self.assertEqual(positions(spool), [170, 180, 190])
+
+    def test_resume_at_end(self):
+        self.fill()
+        spool = self.spool(('bin.1', 180), [190])
+        self.assertEqual(spool.stream.connected, ('bin.1', 180))
+        self.assertEqual(positions(spool), [190])
+        self.assertEqual(spool.segment_numbers(), range(1, 7))
+
+    def test_resume_before(self):
+        self.fill()
+        spool = self.spool(('bin.1', 50), [60])
+        self.assertEqual(spool.stream.connected, ('bin.1', 50))
+        self.assertEqual(positions(spool), [60])
+        self.assertEqual(spool.segment_numbers(), [1])
+
+    def test_resume_after(self):
+        self.fill()
+        spool = self.spool(('bin.1', 300), [310])
+        self.assertEqual(spool.stream.connected, ('bin.1', 300))
+        self.assertEqual(positions(spool), [310])
+        self.assertEqual(spool.segment_numbers(), [1])
+
+    def test_truncated_record(self):
+        spool = self.fill(segment_bytes=1 << 20, compress_level=0)
+        spool.close()
+        # Cut short by a crash while writing the event ending at 190
+        with open(os.path.join(self.directory, SEGMENT_NAME % 1), 'ab') as segment:
+            segment.write(RECORD_LENGTH.pack(len(event(190))) + event(190)[:10])
+        spool = self.spool(('bin.1', 150), [190])
+        self.assertEqual(spool.stream.connected, ('bin.1', 180))
+        self.assertEqual(positions(spool), [160, 170, 180, 190])
+
+    def wait_for(self, condition):
+        deadline = time.time() + 5
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_expire_by_size(self):
+        spool = self.fill(retention_bytes=1)
+        # Nothing goes before it is checkpointed
+        time.sleep(0.1)
+        self.assertEqual(spool.segment_numbers(), range(1, 6))
+
+        spool.checkpointed(('bin.1', 150))
+        self.wait_for(lambda: spool.segment_numbers() == range(3, 6))
+        # Not the segment holding the checkpointed position
+        self.assertEqual(spool.segment_numbers(), range(3, 6))
+        time.sleep(0.1)
+        self.assertEqual(spool.segment_numbers(), range(3, 6))
+
+    def test_expire_by_age(self):
+        spool = self.fill(retention_seconds=60)
+        spool.checkpointed(('bin.1', 180))
+        for number in (1, 2):
+            os.utime(spool.segment_path(number), (time.time() - 120, time.time() - 120))
+        self.wait_for(lambda: spool.segment_numbers() == range(3, 6))
+        self.assertEqual(spool.segment_numbers(), range(3, 6))
+
+if __name__ == '__main__':
+    unittest.main()